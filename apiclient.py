@@ -2,7 +2,7 @@ import argparse
 import requests
 import sys
 from requests.auth import HTTPBasicAuth
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Union
 
 
 class APIException(Exception):
@@ -97,14 +97,30 @@ def send_message(
 
 
 class Message:
-    def __init__(self, msgtype: str, timestamp: int, name: Optional[str], message: str) -> None:
+    def __init__(self, msgtype: str, timestamp: int, name: Optional[str], message: str, msgid: Optional[int] = None) -> None:
         self.msgtype = msgtype
         self.timestamp = timestamp
         self.name = name
         self.message = message
+        self.msgid = msgid
 
     def __repr__(self) -> str:
-        return f"Message(msgtype={self.msgtype!r}, timestamp={self.timestamp!r}, name={self.name!r}, message={self.message!r})"
+        return f"Message(msgtype={self.msgtype!r}, timestamp={self.timestamp!r}, name={self.name!r}, message={self.message!r}, msgid={self.msgid!r})"
+
+
+class MessagePage(List[Message]):
+    """
+    A page of messages, which is a list like any other. When the server had more messages than fit on
+    the page, more is True and next_url is the request that fetches the next page in the same direction.
+    """
+
+    def __init__(self, messages: List[Message], next_url: Optional[str] = None) -> None:
+        super().__init__(messages)
+        self.next_url = next_url
+
+    @property
+    def more(self) -> bool:
+        return self.next_url is not None
 
 
 def get_messages(
@@ -114,15 +130,33 @@ def get_messages(
     *,
     limit: Optional[int] = None,
     last_stream_only: Optional[bool] = None,
-) -> List[Message]:
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    types: Optional[List[str]] = None,
+) -> MessagePage:
+    """
+    Fetches a single page of messages, in the order they were sent. The server caps how many messages
+    come back at once, so check more on the returned page and use before or after with the msgid of a
+    message you already have to page backwards or forwards from it, or use iter_messages() to page
+    through everything.
+    """
+
     if limit is not None and limit < 0:
         raise APIException("Cannot request a negative limit!")
+    if types is not None and any(t not in {"message", "action", "broadcast"} for t in types):
+        raise APIException("Unrecognized message type requested!")
 
     params: Dict[str, str] = {}
     if limit is not None:
         params["limit"] = str(limit)
     if last_stream_only is not None:
         params["lastStreamOnly"] = "true" if last_stream_only else "false"
+    if before is not None:
+        params["before"] = str(before)
+    if after is not None:
+        params["after"] = str(after)
+    if types is not None:
+        params["types"] = ",".join(types)
 
     resp = requests.get(f"{domain}/api/messages", auth=HTTPBasicAuth(streamer, streamkey), params=params)
     if resp.status_code == 401:
@@ -133,9 +167,123 @@ def get_messages(
     jsondata = resp.json()
 
     def convert_message(m: Dict[str, Any]) -> Message:
-        return Message(m["type"], m["timestamp"], m.get("name"), m["message"])
+        return Message(m["type"], m["timestamp"], m.get("name"), m["message"], m.get("id"))
+
+    nextpage = resp.links.get("next")
+    return MessagePage([convert_message(m) for m in jsondata], nextpage["url"] if nextpage else None)
+
+
+def iter_messages(
+    domain: str,
+    streamer: str,
+    streamkey: str,
+    *,
+    last_stream_only: Optional[bool] = None,
+    types: Optional[List[str]] = None,
+    page_size: Optional[int] = None,
+) -> Iterator[Message]:
+    """
+    Yields every message, oldest first, fetching them a page at a time as they're needed.
+    """
+
+    after = 0
+    while True:
+        messages = get_messages(
+            domain,
+            streamer,
+            streamkey,
+            limit=page_size,
+            last_stream_only=last_stream_only,
+            after=after,
+            types=types,
+        )
+        if not messages:
+            return
+
+        yield from messages
+        if not messages.more:
+            return
+        last = messages[-1].msgid
+        if last is None:
+            raise APIException("Server does not support paging through messages")
+        after = last
+
+
+class StreamSession:
+    def __init__(
+        self,
+        sessionid: int,
+        started: int,
+        stopped: Optional[int],
+        peak: int,
+        mean: float,
+        messages: int,
+        actions: int,
+        drawings: int,
+        chatters: int,
+    ) -> None:
+        self.sessionid = sessionid
+        self.started = started
+        self.stopped = stopped
+        self.peak = peak
+        self.mean = mean
+        self.messages = messages
+        self.actions = actions
+        self.drawings = drawings
+        self.chatters = chatters
+
+    @property
+    def live(self) -> bool:
+        return self.stopped is None
+
+    def __repr__(self) -> str:
+        return f"StreamSession(sessionid={self.sessionid!r}, started={self.started!r}, stopped={self.stopped!r}, peak={self.peak!r}, mean={self.mean!r}, messages={self.messages!r}, actions={self.actions!r}, drawings={self.drawings!r}, chatters={self.chatters!r})"
+
+
+def get_sessions(
+    domain: str,
+    streamer: str,
+    streamkey: str,
+    *,
+    limit: Optional[int] = None,
+    before: Optional[int] = None,
+) -> List[StreamSession]:
+    """
+    Fetches a single page of stream sessions, newest first. Use before with the sessionid of the oldest
+    session you already have to fetch the page before it.
+    """
+
+    if limit is not None and limit < 0:
+        raise APIException("Cannot request a negative limit!")
+
+    params: Dict[str, str] = {}
+    if limit is not None:
+        params["limit"] = str(limit)
+    if before is not None:
+        params["before"] = str(before)
+
+    resp = requests.get(f"{domain}/api/sessions", auth=HTTPBasicAuth(streamer, streamkey), params=params)
+    if resp.status_code == 401:
+        raise APIException(f"You are not authorized to make requests on behalf of {streamer}")
+    if resp.status_code != 200:
+        raise APIException("Server returned error response")
+
+    jsondata = resp.json()
 
-    return [convert_message(m) for m in jsondata]
+    def convert_session(s: Dict[str, Any]) -> StreamSession:
+        return StreamSession(
+            sessionid=int(s["id"]),
+            started=int(s["started"]),
+            stopped=int(s["stopped"]) if s["stopped"] is not None else None,
+            peak=int(s["peak"]),
+            mean=float(s["mean"]),
+            messages=int(s["messages"]),
+            actions=int(s["actions"]),
+            drawings=int(s["drawings"]),
+            chatters=int(s["chatters"]),
+        )
+
+    return [convert_session(s) for s in jsondata]
 
 
 class CLIException(Exception):
@@ -245,6 +393,27 @@ if __name__ == "__main__":
         default=None,
         help="limit to only the last LIMIT messages sent to the chat",
     )
+    getmessages_parser.add_argument(
+        "-a",
+        "--all",
+        action="store_true",
+        help="page through and retrieve every message instead of only the most recent page",
+    )
+
+    # Retrieve a summary of each stream.
+    getsessions_parser = commands.add_parser(
+        "getsessions",
+        help="retrieve a summary of each of the streamer's streams",
+        description="Retrieve a summary of each of the streamer's streams, newest first.",
+    )
+    getsessions_parser.add_argument(
+        "-l",
+        "--limit",
+        metavar="LIMIT",
+        type=int,
+        default=None,
+        help="limit to only the last LIMIT streams",
+    )
 
     args = parser.parse_args()
 
@@ -269,9 +438,20 @@ if __name__ == "__main__":
             print("Message sent on behalf of streamer!")
 
         elif args.operation == "getmessages":
-            messages = get_messages(args.domain, args.username, args.key, limit=args.limit, last_stream_only=args.last_stream_only)
-            for message in messages:
-                print(message)
+            if args.all:
+                for message in iter_messages(args.domain, args.username, args.key, last_stream_only=args.last_stream_only):
+                    print(message)
+            else:
+                messages = get_messages(args.domain, args.username, args.key, limit=args.limit, last_stream_only=args.last_stream_only)
+                for message in messages:
+                    print(message)
+                if messages.more:
+                    print("More messages are available, use --all to retrieve them.", file=sys.stderr)
+
+        elif args.operation == "getsessions":
+            sessions = get_sessions(args.domain, args.username, args.key, limit=args.limit)
+            for session in sessions:
+                print(session)
 
         else:
             raise CLIException(f"Unrecognized operation {args.operation}")
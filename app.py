@@ -10,7 +10,8 @@ from typing import Any, Dict, cast
 
 app = Flask(__name__)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins='*')
+# Attached to the app once the config is loaded, since that decides whether we're one of several workers.
+socketio = SocketIO(cors_allowed_origins='*')
 config: Dict[str, Any] = {}
 
 
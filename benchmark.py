@@ -0,0 +1,481 @@
+import argparse
+import base64
+import gevent  # type: ignore
+import io
+import random
+import string
+import sys
+import time
+import tracemalloc
+import urllib.request
+import yaml
+from PIL import Image, ImageDraw
+from typing import Any, Callable, Dict, List, Tuple
+
+from data import Data
+from drawings import drawing_validator
+from helpers import PICTOCHAT_IMAGE_WIDTH, PICTOCHAT_IMAGE_HEIGHT, EmoteRegistry, emotes
+import presence
+
+
+class CLIException(Exception):
+    pass
+
+
+def timed(func: Callable[[], object], iterations: int) -> float:
+    """
+    Runs a function the given number of times, returning the average cost of one call in microseconds.
+    """
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1000000.0
+
+
+def random_alias(rng: random.Random) -> str:
+    return "".join(rng.choice(string.ascii_lowercase + string.digits + "_-") for _ in range(rng.randint(4, 16)))
+
+
+def emotesbench(count: int, iterations: int) -> None:
+    """
+    Compares the per-message cost of collapsing custom emotes for message length checks using
+    one str.replace per configured emote against the single-pass emote registry.
+    """
+
+    rng = random.Random(1337)
+    aliases: Dict[str, str] = {}
+    while len(aliases) < count:
+        alias = random_alias(rng)
+        aliases[alias] = f"/static/emotes/{alias}.png"
+    chosen = rng.sample(sorted(aliases), 3)
+
+    messages: List[str] = [
+        "NewName",
+        f"hello :{chosen[0]}: world :smile:",
+        f":{chosen[1]}::{chosen[2]}: that was amazing :thumbs_up: :not_an_emote: lol",
+        "a perfectly normal chat message that doesn't contain any emotes at all, but is long",
+    ]
+
+    registry = EmoteRegistry()
+    registry.update(aliases)
+    ordered = sorted(aliases)
+
+    def replace_loop(msg: str) -> int:
+        msg = emotes(msg)
+        for alias in ordered:
+            msg = msg.replace(f":{alias}:", "*")
+        return len(msg)
+
+    def single_pass(msg: str) -> int:
+        return len(registry.substitute(emotes(msg), "*"))
+
+    print(f"Custom emotes configured: {count}, iterations per message: {iterations}")
+    for msg in messages:
+        if replace_loop(msg) != single_pass(msg):
+            raise Exception(f"Length mismatch for message {msg!r}!")
+
+        old = timed(lambda: replace_loop(msg), iterations)
+        new = timed(lambda: single_pass(msg), iterations)
+        print(f"{len(msg):4} chars: replace loop {old:9.1f}us, single pass {new:7.1f}us ({old / new:5.1f}x) {msg[:40]!r}")
+
+
+def random_drawing(rng: random.Random) -> str:
+    img = Image.new("RGBA", (PICTOCHAT_IMAGE_WIDTH, PICTOCHAT_IMAGE_HEIGHT))
+    draw = ImageDraw.Draw(img)
+    for _ in range(rng.randint(20, 60)):
+        points = [(rng.randrange(PICTOCHAT_IMAGE_WIDTH), rng.randrange(PICTOCHAT_IMAGE_HEIGHT)) for _ in range(2)]
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256), 255)
+        draw.line(points, fill=color, width=rng.randint(1, 6))
+
+    bio = io.BytesIO()
+    img.save(bio, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(bio.getvalue()).decode("ascii")
+
+
+def inline_validate(src: str) -> None:
+    # How drawings were validated before, inside the greenlet that received them.
+    with urllib.request.urlopen(src) as fp:
+        img = Image.open(fp)
+        img.load()
+        if img.size != (PICTOCHAT_IMAGE_WIDTH, PICTOCHAT_IMAGE_HEIGHT):
+            raise ValueError("Invalid image size")
+
+
+def burst(validate: Callable[[str], object], drawings: List[str]) -> Tuple[float, float]:
+    """
+    Submits every drawing at once, each on its own greenlet, returning how long it took for all of them
+    to be validated and the longest that an unrelated greenlet was kept from running, both in seconds.
+    """
+
+    stall = 0.0
+    done = False
+
+    def ticker() -> None:
+        nonlocal stall
+        while not done:
+            start = time.perf_counter()
+            gevent.sleep(0.001)
+            stall = max(stall, time.perf_counter() - start - 0.001)
+
+    tick = gevent.spawn(ticker)
+    gevent.sleep(0.01)
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(validate, src) for src in drawings], raise_error=True)
+    elapsed = time.perf_counter() - start
+
+    done = True
+    tick.join()
+    return elapsed, stall
+
+
+def drawingsbench(count: int) -> None:
+    """
+    Compares a burst of simultaneous pictochat drawing submissions validated inline on the event loop
+    against the same burst validated by the drawing validator's thread pool.
+    """
+
+    rng = random.Random(1337)
+    drawings = [random_drawing(rng) for _ in range(count)]
+    size = sum(len(src) for src in drawings) // len(drawings)
+
+    # Also make sure that bad drawings are turned away before being decoded.
+    oversized = "data:image/png;base64," + base64.b64encode(b"\0" * drawing_validator.max_bytes).decode("ascii")
+    wrong = drawings[0].replace("data:image/png;base64,", "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAPEAAAB4", 1)
+    for src in [oversized, wrong]:
+        try:
+            drawing_validator.validate(src)
+        except ValueError:
+            pass
+        else:
+            raise Exception("Invalid drawing was accepted!")
+
+    print(f"Drawings submitted at once: {count}, average data URI size: {size} bytes")
+    for name, validate in [("inline", inline_validate), ("thread pool", drawing_validator.validate)]:
+        elapsed, stall = burst(validate, drawings)
+        print(f"{name:>12}: {elapsed * 1000.0:8.1f}ms total, {count / elapsed:8.1f} drawings/s, longest event loop stall {stall * 1000.0:7.1f}ms")
+
+
+# The scratch table that the events benchmark seeds, created with the index layout from before the
+# composite indexes were added and then switched over to the current layout.
+_EVENTS_TABLE = "events_benchmark"
+_EVENTS_OLD_INDEXES = [
+    f"CREATE INDEX ix_{_EVENTS_TABLE}_username ON {_EVENTS_TABLE} (username)",
+    f"CREATE INDEX ix_{_EVENTS_TABLE}_type ON {_EVENTS_TABLE} (type)",
+]
+_EVENTS_NEW_INDEXES = [
+    f"DROP INDEX ix_{_EVENTS_TABLE}_type ON {_EVENTS_TABLE}",
+    f"CREATE INDEX ix_{_EVENTS_TABLE}_username_type_id ON {_EVENTS_TABLE} (username, type, id)",
+    f"CREATE INDEX ix_{_EVENTS_TABLE}_type_timestamp ON {_EVENTS_TABLE} (type, timestamp)",
+]
+
+# Roughly how often each type of event shows up on a busy network.
+_EVENTS_MIX: List[Tuple[str, int]] = [
+    ("viewer_count", 55),
+    ("send_message", 25),
+    ("join_chat", 6),
+    ("leave_chat", 6),
+    ("send_action", 3),
+    ("change_name", 2),
+    ("send_broadcast", 1),
+    ("send_drawing", 1),
+    ("start_streaming", 1),
+]
+
+
+def seed_events(data: Data, rows: int, streamers: int, rng: random.Random) -> None:
+    names = [f"streamer{i}" for i in range(streamers)]
+    types = [etype for etype, weight in _EVENTS_MIX for _ in range(weight)]
+    start = int(time.time()) - (365 * 24 * 60 * 60)
+    step = (365 * 24 * 60 * 60) / rows
+
+    batch = 5000
+    for offset in range(0, rows, batch):
+        values: List[str] = []
+        params: Dict[str, Any] = {}
+        for i in range(min(batch, rows - offset)):
+            etype = rng.choice(types)
+            values.append(f"(:ts{i}, :username{i}, :type{i}, :meta{i})")
+            params[f"ts{i}"] = start + int((offset + i) * step)
+            params[f"username{i}"] = rng.choice(names)
+            params[f"type{i}"] = etype
+            params[f"meta{i}"] = '{"viewers": 5}' if etype == "viewer_count" else '{"name": "viewer", "message": "hello there"}'
+        data.execute(f"INSERT INTO {_EVENTS_TABLE} (timestamp, username, type, meta) VALUES " + ", ".join(values), params)
+        print(f"\rSeeded {offset + len(values)} of {rows} events", end="", flush=True)
+    print()
+
+
+def explain_events(data: Data, iterations: int) -> None:
+    cutoff = int(time.time()) - (180 * 24 * 60 * 60)
+    middle = data.execute(f"SELECT MAX(id) AS id FROM {_EVENTS_TABLE}").fetchone()["id"] // 2
+    queries: List[Tuple[str, str, Dict[str, Any]]] = [
+        (
+            "latest messages",
+            f"SELECT * FROM {_EVENTS_TABLE} WHERE username = :streamer AND type IN :types ORDER BY id DESC LIMIT 100",
+            {'streamer': "streamer1", 'types': ["send_message", "send_action", "send_broadcast"]},
+        ),
+        (
+            "page of messages",
+            f"SELECT * FROM {_EVENTS_TABLE} WHERE username = :streamer AND type IN :types AND id > :id ORDER BY id ASC LIMIT 100",
+            {'streamer': "streamer1", 'types': ["send_message", "send_action", "send_broadcast"], 'id': middle},
+        ),
+        (
+            "last stream start",
+            f"SELECT * FROM {_EVENTS_TABLE} WHERE username = :streamer AND type IN :types ORDER BY id DESC LIMIT 1",
+            {'streamer': "streamer1", 'types': ["start_streaming"]},
+        ),
+        (
+            "all recent events",
+            f"SELECT * FROM {_EVENTS_TABLE} WHERE username = :streamer ORDER BY id DESC LIMIT 100",
+            {'streamer': "streamer1"},
+        ),
+        (
+            "old viewer counts",
+            f"SELECT id FROM {_EVENTS_TABLE} WHERE type = :type AND timestamp < :cutoff ORDER BY timestamp LIMIT 1000",
+            {'type': "viewer_count", 'cutoff': cutoff},
+        ),
+    ]
+
+    for name, sql, params in queries:
+        for plan in data.execute("EXPLAIN " + sql, params):
+            print(f"  {name:>18}: key={plan['key']}, rows={plan['rows']}, extra={plan['Extra']}")
+        elapsed = timed(lambda: data.execute(sql, params).fetchall(), iterations)
+        print(f"  {'':>18}  {elapsed / 1000.0:9.2f}ms per query")
+
+
+def eventsbench(config: Dict[str, Any], rows: int, streamers: int, iterations: int, keep: bool) -> None:
+    """
+    Seeds a scratch events table and compares the query plans and latencies of the lookups that the
+    server and manage script do with the old single column indexes against the composite indexes.
+    """
+
+    config['database']['engine'] = Data.create_engine(config)
+    data = Data(config)
+    data.execute(f"DROP TABLE IF EXISTS {_EVENTS_TABLE}")
+    data.execute(
+        f"CREATE TABLE {_EVENTS_TABLE} ("
+        "id INTEGER NOT NULL AUTO_INCREMENT, "
+        "timestamp INTEGER NOT NULL, "
+        "username VARCHAR(256) NOT NULL, "
+        "type VARCHAR(32) NOT NULL, "
+        "meta JSON NOT NULL, "
+        "PRIMARY KEY (id)"
+        ") DEFAULT CHARSET=utf8mb4"
+    )
+
+    try:
+        for sql in _EVENTS_OLD_INDEXES:
+            data.execute(sql)
+        seed_events(data, rows, streamers, random.Random(1337))
+        data.execute(f"ANALYZE TABLE {_EVENTS_TABLE}")
+
+        print("Single column indexes on username and type:")
+        explain_events(data, iterations)
+
+        print("Adding composite indexes, this can take a while...")
+        for sql in _EVENTS_NEW_INDEXES:
+            data.execute(sql)
+        data.execute(f"ANALYZE TABLE {_EVENTS_TABLE}")
+
+        print("Composite indexes on username, type and id and on type and timestamp:")
+        explain_events(data, iterations)
+    finally:
+        if not keep:
+            data.execute(f"DROP TABLE IF EXISTS {_EVENTS_TABLE}")
+        data.close()
+
+
+def reset_presence() -> None:
+    presence.socket_to_info.clear()
+    presence.socket_to_presence.clear()
+    presence.room_to_info.clear()
+    presence.room_to_names.clear()
+    presence.room_to_viewers.clear()
+    presence.room_to_legacy.clear()
+    presence.room_to_unbatched.clear()
+    presence.room_to_seq.clear()
+    presence.all_viewers = presence.ViewerWindow(presence.PRESENCE_TIMEOUT)
+    presence.presence_limit.local = 0
+
+
+def simulate_sockets(count: int, rooms: int, chatters: float, rng: random.Random) -> None:
+    """
+    Connects the given number of sockets the way the server does, spreading them over rooms as viewers
+    and logging some fraction of them into chat.
+    """
+
+    for i in range(count):
+        sid = f"{i:020x}"
+        streamer = f"streamer{rng.randrange(rooms)}"
+        with presence.presence_lock:
+            presence.admit(sid)
+            presence.set_presence(sid, None)
+            presence.set_presence(sid, streamer)
+        if rng.random() < chatters:
+            presence.add_user(presence.SocketInfo(sid, f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", streamer, f"user{i}", False, False, False, rng.randrange(0xFFFFFF), True, True))
+
+
+def presencebench(sizes: List[int], rooms: int, chatters: float) -> None:
+    """
+    Connects increasing numbers of simulated sockets, comparing the memory that presence tracking
+    actually allocates against what the metrics endpoint estimates, and checks that the socket limit
+    turns new sockets away once it's reached.
+    """
+
+    for count in sizes:
+        reset_presence()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        simulate_sockets(count, rooms, chatters, random.Random(1337))
+        elapsed = time.perf_counter() - start
+        allocated = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        memory = presence.presence_memory()
+        print(
+            f"{count} sockets, {memory['chatters']} in chat: {allocated / 1048576:.1f}MiB allocated "
+            f"({allocated / count:.0f} bytes per socket), {memory['bytes'] / 1048576:.1f}MiB estimated "
+            f"({memory['bytes_per_socket']} bytes per socket), {elapsed / count * 1000000.0:.1f}us per connect"
+        )
+
+        # Nobody is idle yet, so a full server has to turn the next socket away.
+        presence.presence_limit.configure(count)
+        with presence.presence_lock:
+            admitted, _ = presence.admit("overflow")
+        presence.presence_limit.configure(0)
+        print(f"  With a limit of {count} sockets the next socket is {'admitted' if admitted else 'rejected'}")
+
+    reset_presence()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for hot paths in the streaming backend.")
+    commands = parser.add_subparsers(dest="operation")
+
+    # A few params for this one
+    emotes_parser = commands.add_parser(
+        "emotes",
+        help="measure the per-message cost of custom emote lookups",
+        description="Measure the per-message cost of custom emote lookups.",
+    )
+    emotes_parser.add_argument(
+        "-n",
+        "--count",
+        type=int,
+        default=1000,
+        help="number of synthetic custom emotes to configure (defaults to 1000)",
+    )
+    emotes_parser.add_argument(
+        "-i",
+        "--iterations",
+        type=int,
+        default=200,
+        help="number of times to process each sample message (defaults to 200)",
+    )
+
+    drawings_parser = commands.add_parser(
+        "drawings",
+        help="measure a burst of simultaneous pictochat drawing submissions",
+        description="Measure a burst of simultaneous pictochat drawing submissions.",
+    )
+    drawings_parser.add_argument(
+        "-n",
+        "--count",
+        type=int,
+        default=100,
+        help="number of drawings to submit at once (defaults to 100)",
+    )
+
+    events_parser = commands.add_parser(
+        "events",
+        help="compare events table query plans before and after the composite indexes",
+        description="Compare events table query plans before and after the composite indexes. This seeds a scratch table in the configured database.",
+    )
+    events_parser.add_argument(
+        "-c",
+        "--config",
+        type=str,
+        default="config.yaml",
+        help="config file pointing at the database to benchmark against (defaults to config.yaml)",
+    )
+    events_parser.add_argument(
+        "-n",
+        "--rows",
+        type=int,
+        default=2000000,
+        help="number of synthetic events to seed (defaults to 2000000)",
+    )
+    events_parser.add_argument(
+        "-s",
+        "--streamers",
+        type=int,
+        default=50,
+        help="number of synthetic streamers to spread the events over (defaults to 50)",
+    )
+    events_parser.add_argument(
+        "-i",
+        "--iterations",
+        type=int,
+        default=20,
+        help="number of times to run each query (defaults to 20)",
+    )
+    events_parser.add_argument(
+        "-k",
+        "--keep",
+        action="store_true",
+        help="keep the seeded table around afterwards instead of dropping it",
+    )
+
+    presence_parser = commands.add_parser(
+        "presence",
+        help="measure presence tracking memory with many simulated sockets",
+        description="Measure presence tracking memory with many simulated sockets.",
+    )
+    presence_parser.add_argument(
+        "-n",
+        "--sockets",
+        type=int,
+        action="append",
+        help="number of sockets to simulate, can be given more than once (defaults to 10000, 50000 and 100000)",
+    )
+    presence_parser.add_argument(
+        "-r",
+        "--rooms",
+        type=int,
+        default=50,
+        help="number of streamers to spread the sockets over (defaults to 50)",
+    )
+    presence_parser.add_argument(
+        "-c",
+        "--chatters",
+        type=float,
+        default=0.2,
+        help="fraction of sockets that log into chat (defaults to 0.2)",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        if args.operation is None:
+            raise CLIException("Unuspecified operation!")
+        elif args.operation == "emotes":
+            emotesbench(args.count, args.iterations)
+        elif args.operation == "drawings":
+            drawingsbench(args.count)
+        elif args.operation == "events":
+            eventsbench(yaml.safe_load(open(args.config)), args.rows, args.streamers, args.iterations, args.keep)
+        elif args.operation == "presence":
+            presencebench(args.sockets or [10000, 50000, 100000], args.rooms, args.chatters)
+        else:
+            raise CLIException(f"Unknown operation '{args.operation}'")
+    except CLIException as e:
+        print(str(e), file=sys.stderr)
+        print(file=sys.stderr)
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
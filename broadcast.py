@@ -0,0 +1,119 @@
+import time
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from app import socketio
+from presence import unbatched_users
+
+
+# Events that can be delayed and sent together, since they only add a line to chat.
+BATCHABLE_EVENTS: Set[str] = {
+    'message received',
+    'action received',
+    'drawing received',
+    'server',
+}
+
+
+class RoomStats:
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.events = 0
+        self.frames = 0
+        self.largest = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record(self, size: int, latencies: Iterable[float]) -> None:
+        self.events += size
+        self.frames += 1
+        self.largest = max(self.largest, size)
+        for latency in latencies:
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def snapshot(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self.started, 1.0)
+        return {
+            'events': self.events,
+            'frames': self.frames,
+            'events_per_second': round(self.events / elapsed, 2),
+            'average_batch': round(self.events / self.frames, 2) if self.frames else 0,
+            'largest_batch': self.largest,
+            'latency_avg_ms': round(self.latency_total / self.events * 1000.0, 2) if self.events else 0,
+            'latency_max_ms': round(self.latency_max * 1000.0, 2),
+        }
+
+
+class RoomBroadcaster:
+    """
+    Sends events to everyone in a streamer's chat. For rooms that opted into batching, chat lines
+    are gathered for a short window and sent as a single ordered 'batch' frame, so a busy room costs
+    one socket write per viewer per window instead of one per message. Anything else sent to a
+    batched room goes out right after whatever was gathered so far, to keep everything in order.
+    """
+
+    def __init__(self) -> None:
+        self.window = 0.075
+        self.rooms: Set[str] = set()
+        self.__pending: Dict[str, List[Tuple[str, Dict[str, Any], float]]] = {}
+
+        # Which gathering each room is on, so a timer for one that was already flushed early does nothing.
+        self.__generation: Dict[str, int] = {}
+        self.__stats: Dict[str, RoomStats] = {}
+
+    def configure(self, window_ms: int, rooms: Iterable[str]) -> None:
+        self.window = window_ms / 1000.0
+        self.rooms = set(room.lower() for room in rooms)
+
+    def emit(self, event: str, payload: Dict[str, Any], room: str) -> None:
+        if room not in self.rooms:
+            socketio.emit(event, payload, room=room)
+            return
+
+        if event not in BATCHABLE_EVENTS:
+            self.flush(room)
+            socketio.emit(event, payload, room=room)
+            return
+
+        if room not in self.__pending:
+            self.__pending[room] = []
+            generation = self.__generation.get(room, 0) + 1
+            self.__generation[room] = generation
+            socketio.start_background_task(self.__flush_later, room, generation)
+        self.__pending[room].append((event, payload, time.monotonic()))
+
+    def __flush_later(self, room: str, generation: int) -> None:
+        socketio.sleep(self.window)
+        if self.__generation.get(room) == generation:
+            self.flush(room)
+
+    def flush(self, room: str) -> None:
+        """
+        Sends anything gathered for a room right away.
+        """
+
+        pending = self.__pending.pop(room, None)
+        if not pending:
+            return
+
+        if unbatched_users(room):
+            # Somebody is running a client from before batching existed, so send things one at a time.
+            for event, payload, _ in pending:
+                socketio.emit(event, payload, room=room)
+        else:
+            socketio.emit('batch', {'events': [{'event': event, 'data': payload} for event, payload, _ in pending]}, room=room)
+
+        sent = time.monotonic()
+        if room not in self.__stats:
+            self.__stats[room] = RoomStats()
+        self.__stats[room].record(len(pending), (sent - queued for _, _, queued in pending))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'window_ms': round(self.window * 1000.0),
+            'rooms': {room: stats.snapshot() for room, stats in self.__stats.items()},
+        }
+
+
+# Process-wide broadcaster for chat rooms.
+broadcaster = RoomBroadcaster()
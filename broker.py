@@ -0,0 +1,288 @@
+import argparse
+import fcntl
+import gevent  # type: ignore
+import json
+import os
+import socket
+import struct
+import sys
+import yaml
+from gevent import socket as gsocket
+from gevent.lock import Semaphore  # type: ignore
+from gevent.queue import Queue  # type: ignore
+from gevent.server import StreamServer  # type: ignore
+from socketio import PubSubManager  # type: ignore
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+# Every message on the broker socket is a JSON object prefixed with its length.
+_FRAME_HEADER = struct.Struct("!I")
+
+
+def read_frame(sock: Any) -> Optional[bytes]:
+    """
+    Reads a single frame from a stream socket, returning None once the other end hangs up.
+    """
+
+    header = b""
+    while len(header) < _FRAME_HEADER.size:
+        chunk = sock.recv(_FRAME_HEADER.size - len(header))
+        if not chunk:
+            return None
+        header += chunk
+
+    length = _FRAME_HEADER.unpack(header)[0]
+    body = b""
+    while len(body) < length:
+        chunk = sock.recv(min(length - len(body), 65536))
+        if not chunk:
+            return None
+        body += chunk
+    return body
+
+
+def write_frame(sock: Any, body: bytes) -> None:
+    sock.sendall(_FRAME_HEADER.pack(len(body)) + body)
+
+
+class Broker:
+    """
+    A minimal local message broker. Every frame that any worker sends is fanned out to every
+    connected worker, including the sender, and each worker decides what it cares about by the
+    channel named in the frame. Each worker gets its own outbound queue so that one slow worker
+    can't hold up the rest.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.__path = path
+        self.__clients: Dict[Any, Any] = {}
+
+    def serve_forever(self) -> None:
+        # A previous broker that didn't shut down cleanly could have left its socket behind.
+        try:
+            os.unlink(self.__path)
+        except FileNotFoundError:
+            pass
+
+        listener = gsocket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.__path)
+        listener.listen(128)
+        print(f"Broker listening on {self.__path}")
+        try:
+            StreamServer(listener, self.__handle).serve_forever()
+        finally:
+            os.unlink(self.__path)
+
+    def __handle(self, sock: Any, address: Any) -> None:
+        outbound = Queue()
+        self.__clients[sock] = outbound
+        writer = gevent.spawn(self.__write, sock, outbound)
+        print(f"Worker connected, {len(self.__clients)} connected")
+
+        try:
+            while True:
+                frame = read_frame(sock)
+                if frame is None:
+                    break
+                for queue in self.__clients.values():
+                    queue.put(frame)
+        except OSError:
+            pass
+        finally:
+            del self.__clients[sock]
+            writer.kill()
+            sock.close()
+            print(f"Worker disconnected, {len(self.__clients)} connected")
+
+    def __write(self, sock: Any, outbound: Any) -> None:
+        try:
+            while True:
+                write_frame(sock, outbound.get())
+        except OSError:
+            sock.close()
+
+
+class BrokerClient:
+    """
+    A worker's connection to the broker. Messages published on a channel reach every worker, this one
+    included. Incoming messages are either handed to a subscribed callback or queued for a listener,
+    depending on how the channel was registered. The connection is retried in the background for as
+    long as the broker is down, and anything published in the meantime is dropped.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.__path = path
+        self.__sock: Optional[Any] = None
+        self.__lock = Semaphore()
+        self.__queues: Dict[str, Any] = {}
+        self.__handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+        self.__on_connect: List[Callable[[], None]] = []
+
+    @property
+    def connected(self) -> bool:
+        return self.__sock is not None
+
+    def subscribe(self, channel: str, handler: Callable[[Dict[str, Any]], None]) -> None:
+        self.__handlers[channel] = handler
+
+    def on_connect(self, callback: Callable[[], None]) -> None:
+        """
+        Registers a callback to run every time we (re)connect to the broker.
+        """
+
+        self.__on_connect.append(callback)
+
+    def listen(self, channel: str) -> Iterator[Dict[str, Any]]:
+        """
+        Yields every message published on a channel, forever.
+        """
+
+        queue = self.__queues.setdefault(channel, Queue())
+        while True:
+            yield queue.get()
+
+    def publish(self, channel: str, data: Dict[str, Any]) -> None:
+        sock = self.__sock
+        if sock is None:
+            return
+
+        body = json.dumps({'channel': channel, 'data': data}).encode('utf-8')
+        try:
+            with self.__lock:
+                write_frame(sock, body)
+        except OSError as e:
+            print(f"Failed to publish to broker: {e}")
+
+    def start(self) -> None:
+        gevent.spawn(self.__run)
+
+    def __run(self) -> None:
+        while True:
+            sock = gsocket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.__path)
+            except OSError as e:
+                print(f"Failed to connect to broker, retrying: {e}")
+                sock.close()
+                gevent.sleep(1.0)
+                continue
+
+            self.__sock = sock
+            for callback in self.__on_connect:
+                callback()
+
+            try:
+                while True:
+                    frame = read_frame(sock)
+                    if frame is None:
+                        break
+                    self.__dispatch(json.loads(frame.decode('utf-8')))
+            except OSError as e:
+                print(f"Lost connection to broker: {e}")
+            finally:
+                self.__sock = None
+                sock.close()
+            gevent.sleep(1.0)
+
+    def __dispatch(self, message: Dict[str, Any]) -> None:
+        channel: str = message['channel']
+        if channel in self.__queues:
+            self.__queues[channel].put(message['data'])
+        handler = self.__handlers.get(channel)
+        if handler is not None:
+            try:
+                handler(message['data'])
+            except Exception as e:
+                print(f"Failed to handle {channel} message: {e}")
+
+
+class BrokerManager(PubSubManager):  # type: ignore
+    """
+    A Socket.IO client manager that relays emits between workers through the local broker, so that
+    an emit to a room reaches the sockets in that room no matter which worker they're connected to.
+    """
+
+    name = 'pystreaming'
+
+    def __init__(self, client: BrokerClient, channel: str = 'socketio') -> None:
+        super().__init__(channel=channel)
+        self.__client = client
+
+    def _publish(self, data: Dict[str, Any]) -> None:
+        self.__client.publish(self.channel, data)
+
+    def _listen(self) -> Iterator[Dict[str, Any]]:
+        yield from self.__client.listen(self.channel)
+
+
+class LeaderLock:
+    """
+    Decides which worker on this host runs the server-wide background work, by way of an exclusive
+    lock on a file. The lock is released by the kernel when the worker holding it exits, so another
+    worker picks the work up on its next attempt. With no lock file configured we're the only worker,
+    and so always the leader.
+    """
+
+    def __init__(self) -> None:
+        self.__path: Optional[str] = None
+        self.__fd: Optional[int] = None
+
+    def configure(self, path: Optional[str]) -> None:
+        self.__path = path
+
+    @property
+    def leader(self) -> bool:
+        return self.__path is None or self.__fd is not None
+
+    def try_acquire(self) -> bool:
+        """
+        Attempts to become the leader without waiting, returning whether we are the leader.
+        """
+
+        if self.leader or self.__path is None:
+            return True
+
+        fd = os.open(self.__path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode('utf-8'))
+        self.__fd = fd
+        return True
+
+
+# Process-wide leader lock.
+leader_lock = LeaderLock()
+
+
+def default_lock_path(config_filename: str) -> str:
+    """
+    Given the filename of the config that a server was started with, returns the path of the leader
+    lock file that lives next to it.
+    """
+
+    return os.path.join(os.path.dirname(os.path.abspath(config_filename)), ".pystreaming.lock")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="A local message broker for running more than one streaming server worker.")
+    parser.add_argument("-c", "--config", help="Config file to parse for instance settings. Defaults to config.yaml", type=str, default="config.yaml")
+    parser.add_argument("-s", "--socket", help="Socket to listen on. Defaults to the broker_socket config setting", type=str, default=None)
+    args = parser.parse_args()
+
+    path = args.socket
+    if path is None:
+        path = yaml.safe_load(open(args.config)).get('broker_socket')
+    if not path:
+        print("No broker socket configured!", file=sys.stderr)
+        sys.exit(1)
+
+    Broker(path).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
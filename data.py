@@ -1,15 +1,18 @@
 import os
+import time
+from gevent import getcurrent  # type: ignore
 from typing import Any, Dict, Optional
 
 import alembic.config
 from alembic.migration import MigrationContext
 from alembic.autogenerate import compare_metadata
-from sqlalchemy import Table, Column, MetaData, create_engine
+from sqlalchemy import Table, Column, Index, MetaData, PrimaryKeyConstraint, create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.engine import Engine, Result  # type: ignore
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import text
 from sqlalchemy.exc import ProgrammingError
-from sqlalchemy.types import String, Integer, JSON
+from sqlalchemy.types import BigInteger, Float, String, Integer, JSON
 
 
 metadata = MetaData()
@@ -27,6 +30,7 @@ streamersettings = Table(
     Column('description', String(512)),
     Column('streampass', String(256)),
     Column('mastodon', String(256)),
+    Column('backlog', Integer),
     mysql_charset="utf8mb4",
 )
 
@@ -52,8 +56,67 @@ events = Table(
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('timestamp', Integer, nullable=False),
     Column('username', String(256), nullable=False, index=True),
-    Column('type', String(32), nullable=False, index=True),
+    Column('type', String(32), nullable=False),
     Column('meta', JSON, nullable=False),
+    # Looking up a streamer's events of certain types, newest or oldest first, walks this index directly.
+    Index('ix_events_username_type_id', 'username', 'type', 'id'),
+    # Finding events of a certain type that are older than a given age, for retention and archival.
+    Index('ix_events_type_timestamp', 'type', 'timestamp'),
+    mysql_charset="utf8mb4",
+)
+
+
+"""
+Table for storing audit events that have aged out of the events table. Rows keep the ID they
+had in the events table, so they can be moved back if needed.
+"""
+events_archive = Table(
+    'events_archive',
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('timestamp', Integer, nullable=False, index=True),
+    Column('username', String(256), nullable=False, index=True),
+    Column('type', String(32), nullable=False),
+    Column('meta', JSON, nullable=False),
+    mysql_charset="utf8mb4",
+)
+
+
+"""
+Table for storing a rollup of every stream, kept up to date as its events are written.
+"""
+sessions = Table(
+    'sessions',
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('username', String(256), nullable=False),
+    Column('start_id', Integer),
+    Column('started', Integer, nullable=False),
+    Column('stopped', Integer),
+    Column('viewers', Integer, nullable=False),
+    Column('viewers_since', Integer, nullable=False),
+    Column('viewer_seconds', BigInteger, nullable=False),
+    Column('peak', Integer, nullable=False),
+    Column('mean', Float),
+    Column('messages', Integer, nullable=False),
+    Column('actions', Integer, nullable=False),
+    Column('drawings', Integer, nullable=False),
+    Column('chatters', Integer, nullable=False),
+    # Looking up a streamer's sessions newest first, as well as the one they're live with.
+    Index('ix_sessions_username_id', 'username', 'id'),
+    mysql_charset="utf8mb4",
+)
+
+
+"""
+Table for storing who chatted during each stream, so that unique chatters can be counted.
+"""
+session_chatters = Table(
+    'session_chatters',
+    metadata,
+    Column('session_id', Integer, nullable=False),
+    Column('name', String(256), nullable=False),
+    PrimaryKeyConstraint('session_id', 'name'),
     mysql_charset="utf8mb4",
 )
 
@@ -76,6 +139,68 @@ class DBCreateException(Exception):
     pass
 
 
+class PoolMetrics:
+    """
+    Running counters for the shared connection pool, so that the pool size and overflow
+    settings in the config can be tuned against real traffic.
+    """
+
+    def __init__(self) -> None:
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_connect(self) -> None:
+        self.connects += 1
+
+    def record_checkout(self) -> None:
+        self.checkouts += 1
+        self.checked_out += 1
+        self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def record_checkin(self) -> None:
+        self.checkins += 1
+        self.checked_out = max(self.checked_out - 1, 0)
+
+    def record_wait(self, seconds: float) -> None:
+        self.waits += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            'connects': self.connects,
+            'checkouts': self.checkouts,
+            'checkins': self.checkins,
+            'checked_out': self.checked_out,
+            'peak_checked_out': self.peak_checked_out,
+            'wait_avg_ms': (self.wait_total / self.waits * 1000.0) if self.waits else 0.0,
+            'wait_max_ms': self.wait_max * 1000.0,
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    A regular queue pool that additionally records how long each caller waited to be handed
+    a connection, which is the number that tells us whether the pool is undersized.
+    """
+
+    def _do_get(self) -> Any:
+        start = time.monotonic()
+        try:
+            return super()._do_get()  # type: ignore
+        finally:
+            pool_metrics.record_wait(time.monotonic() - start)
+
+
 class Data:
     """
     An object that is meant to be used as a singleton, in order to hold
@@ -83,21 +208,23 @@ class Data:
     and storing data.
     """
 
+    # Session factories, created once per engine and shared by every data object using that engine.
+    __sessions: Dict[Engine, scoped_session] = {}
+
     def __init__(self, config: Dict[str, Any]) -> None:
         """
         Initializes the data object.
 
         Parameters:
             config - A config structure with a 'database' section which is used
-                     to initialize an internal DB connection.
+                     to initialize an internal DB connection. The session factory
+                     is created once and shared by every data object using the same engine.
         """
-        session_factory = sessionmaker(
-            bind=config['database']['engine'],
-            autoflush=True,
-            autocommit=True,
-        )
+        engine = config['database']['engine']
+        if engine not in Data.__sessions:
+            Data.__sessions[engine] = Data.create_session(config)
         self.__config = config
-        self.__session: Optional[scoped_session] = scoped_session(session_factory)
+        self.__session: scoped_session = Data.__sessions[engine]
         self.__url = Data.sqlalchemy_url(config)
 
     @classmethod
@@ -106,21 +233,37 @@ class Data:
 
     @classmethod
     def create_engine(cls, config: Dict[str, Any]) -> Engine:
-        return create_engine(
+        engine = create_engine(
             Data.sqlalchemy_url(config),
+            poolclass=MeteredQueuePool,
             pool_recycle=3600,
+            pool_size=int(config['database'].get('pool_size', 10)),
+            max_overflow=int(config['database'].get('max_overflow', 20)),
+            pool_timeout=int(config['database'].get('pool_timeout', 30)),
+        )
+        event.listen(engine, 'connect', lambda *args: pool_metrics.record_connect())  # type: ignore
+        event.listen(engine, 'checkout', lambda *args: pool_metrics.record_checkout())  # type: ignore
+        event.listen(engine, 'checkin', lambda *args: pool_metrics.record_checkin())  # type: ignore
+        return engine
+
+    @classmethod
+    def create_session(cls, config: Dict[str, Any]) -> scoped_session:
+        # Scope sessions to the current greenlet rather than the current thread, since under
+        # gevent every socket event and web request runs on its own greenlet in one thread.
+        session_factory = sessionmaker(
+            bind=config['database']['engine'],
+            autoflush=True,
+            autocommit=True,
         )
+        return scoped_session(session_factory, scopefunc=getcurrent)
 
     def __exists(self) -> bool:
         # See if the DB was already created
-        if self.__session is not None:
-            try:
-                cursor = self.__session.execute(text('SELECT COUNT(version_num) AS count FROM alembic_version'))
-                return bool(cursor.fetchone()['count'] == 1)
-            except ProgrammingError:
-                return False
-        else:
-            raise Exception("Our connection to the DB was closed!")
+        try:
+            cursor = self.__session.execute(text('SELECT COUNT(version_num) AS count FROM alembic_version'))
+            return bool(cursor.fetchone()['count'] == 1)
+        except ProgrammingError:
+            return False
 
     def __alembic_cmd(self, command: str, *args: str) -> None:
         base_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), './')
@@ -190,12 +333,11 @@ class Data:
 
     def close(self) -> None:
         """
-        Close any open data connection.
+        Release the session owned by the current greenlet, returning its connection to the pool.
+        The data object itself stays usable and will transparently start a new session.
         """
         # Make sure we don't leak connections between web requests
-        if self.__session is not None:
-            self.__session.close()
-            self.__session = None
+        self.__session.remove()  # type: ignore
 
     def execute(self, sql: str, params: Optional[Dict[str, Any]] = None, safe_write_operation: bool = False) -> Result:
         """
@@ -217,10 +359,7 @@ class Data:
             ]:
                 if write_statement in sql.lower() and not safe_write_operation:
                     raise Exception('Read-only mode is active!')
-        if self.__session is not None:
-            return self.__session.execute(
-                text(sql),
-                params if params is not None else {},
-            )
-        else:
-            raise Exception("Our connection to the DB was closed!")
+        return self.__session.execute(
+            text(sql),
+            params if params is not None else {},
+        )
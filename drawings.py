@@ -0,0 +1,196 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+import struct
+from gevent.threadpool import ThreadPool  # type: ignore
+from PIL import Image
+from typing import Optional, Tuple
+
+from app import config
+from helpers import PICTOCHAT_IMAGE_WIDTH, PICTOCHAT_IMAGE_HEIGHT
+
+
+# Every PNG starts with this signature, followed by the IHDR chunk which holds the dimensions.
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_IHDR = struct.Struct("!I4sII")
+
+# The only kind of data URI that the pictochat canvas produces.
+_DATA_URI_HEADER = "data:image/png;base64"
+
+
+def png_dimensions(png: bytes) -> Tuple[int, int]:
+    """
+    Returns the width and height that a PNG declares in its header, without decoding any of it.
+    """
+
+    if len(png) < len(_PNG_SIGNATURE) + _PNG_IHDR.size or not png.startswith(_PNG_SIGNATURE):
+        raise ValueError("Not a PNG image")
+
+    length, chunk, width, height = _PNG_IHDR.unpack_from(png, len(_PNG_SIGNATURE))
+    if chunk != b"IHDR" or length != 13:
+        raise ValueError("Invalid PNG header")
+    return width, height
+
+
+def drawing_payload(src: str) -> str:
+    """
+    Given a pictochat drawing as a data URI, returns the base64 encoded PNG it contains, raising
+    ValueError if the URI isn't a PNG of the right dimensions. The dimensions are checked using just
+    the first few bytes of the image, so most bad drawings are rejected before doing any real work.
+    """
+
+    header, data = src.split(",", 1)
+    if header != _DATA_URI_HEADER:
+        raise ValueError("Invalid image header")
+
+    # 32 base64 characters is 24 bytes, enough for the signature and IHDR chunk.
+    try:
+        width, height = png_dimensions(base64.b64decode(data[:32], validate=True))
+    except binascii.Error:
+        raise ValueError("Invalid image encoding")
+    if width != PICTOCHAT_IMAGE_WIDTH or height != PICTOCHAT_IMAGE_HEIGHT:
+        raise ValueError("Invalid image size")
+    return data
+
+
+def decode_payload(data: str) -> Optional[bytes]:
+    """
+    Decodes a base64 encoded PNG, returning None if it isn't actually a valid image.
+    """
+
+    try:
+        png = base64.b64decode(data, validate=True)
+        with Image.open(io.BytesIO(png)) as img:
+            img.load()
+    except Exception:
+        return None
+    return png
+
+
+def decode_drawing(src: str) -> bytes:
+    """
+    Given a pictochat drawing as a data URI, returns the PNG it contains, raising ValueError if it
+    isn't a valid PNG of the right dimensions.
+    """
+
+    png = decode_payload(drawing_payload(src))
+    if png is None:
+        raise ValueError("Invalid image data")
+    return png
+
+
+class DrawingValidator:
+    """
+    Validates pictochat drawings on a small pool of native threads, so that decoding a drawing only
+    holds up the greenlet that received it instead of every socket on the server. Drawings over the
+    size cap are rejected without being looked at, and when too many drawings are already waiting
+    new ones are turned away instead of piling up.
+    """
+
+    def __init__(self) -> None:
+        self.__pool: Optional[ThreadPool] = None
+        self.__waiting = 0
+
+    @property
+    def max_bytes(self) -> int:
+        return int(config.get('drawing_max_bytes', 262144))
+
+    def __get_pool(self) -> ThreadPool:
+        if self.__pool is None:
+            self.__pool = ThreadPool(int(config.get('drawing_workers', 2)))
+        return self.__pool
+
+    def validate(self, src: str) -> bytes:
+        """
+        Returns the PNG contained in a drawing's data URI, raising ValueError if it is invalid. This
+        only blocks the calling greenlet.
+        """
+
+        if len(src) > self.max_bytes:
+            raise ValueError("Image too large")
+        data = drawing_payload(src)
+        if self.__waiting >= int(config.get('drawing_queue_limit', 100)):
+            raise ValueError("Too many drawings waiting")
+
+        self.__waiting += 1
+        try:
+            png: Optional[bytes] = self.__get_pool().apply(decode_payload, (data,))
+        finally:
+            self.__waiting -= 1
+
+        if png is None:
+            raise ValueError("Invalid image data")
+        return png
+
+
+# Process-wide drawing validator.
+drawing_validator = DrawingValidator()
+
+
+def default_drawings_dir(config_filename: str) -> str:
+    """
+    Given the filename of the config that a server or the manage script was started with, returns
+    the directory that drawings are stored in by default, which lives next to it.
+    """
+
+    return os.path.join(os.path.dirname(os.path.abspath(config_filename)), "drawings")
+
+
+def drawing_url(digest: str) -> str:
+    return f"/drawings/{digest}.png"
+
+
+class DrawingStore:
+    """
+    Pictochat drawings on disk, named after the SHA-256 hash of their contents. A drawing that gets
+    sent more than once is only stored once, and since a stored drawing never changes it can be
+    cached forever by anybody that fetches it.
+    """
+
+    def __init__(self) -> None:
+        self.path = "drawings"
+
+    def configure(self, path: str) -> None:
+        self.path = path
+
+    def filename(self, digest: str) -> Optional[str]:
+        """
+        Returns the file a drawing with the given hash lives in, or None if the hash isn't valid.
+        """
+
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            return None
+        return os.path.join(self.path, f"{digest}.png")
+
+    def save(self, png: bytes) -> str:
+        """
+        Stores a drawing if it isn't already stored, returning its hash. Raises OSError if the drawing
+        couldn't be written.
+        """
+
+        digest = hashlib.sha256(png).hexdigest()
+        filename = os.path.join(self.path, f"{digest}.png")
+        if os.path.isfile(filename):
+            return digest
+
+        # Write somewhere else first so nobody ever sees half of a drawing.
+        os.makedirs(self.path, exist_ok=True)
+        partial = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(partial, "wb") as bfp:
+                bfp.write(png)
+            os.replace(partial, filename)
+        except OSError:
+            # Don't leave a half written drawing behind, such as when the disk fills up.
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            raise
+        return digest
+
+
+# Process-wide drawing store.
+drawing_store = DrawingStore()
@@ -1,6 +1,9 @@
 from abc import ABC
 import json
-from typing import Dict, List, Optional, Type
+import time
+from gevent.event import Event as GeventEvent  # type: ignore
+from gevent.lock import RLock  # type: ignore
+from typing import Any, Callable, Dict, Iterator, List, Optional, Type
 
 from data import Data
 
@@ -28,7 +31,7 @@ class Event(ABC):
 class StartStreamingEvent(Event):
     __TYPE__ = "start_streaming"
 
-    def __init__(self, timestamp: int, streamer: str, description: str, password: str) -> None:
+    def __init__(self, timestamp: int, streamer: str, description: Optional[str], password: Optional[str]) -> None:
         super().__init__(None, timestamp, streamer, self.__TYPE__, {"description": description, "password": password})
 
     @staticmethod
@@ -103,16 +106,21 @@ class SendMessageEvent(Event):
 class SendDrawingEvent(Event):
     __TYPE__ = "send_drawing"
 
-    def __init__(self, timestamp: int, streamer: str, name: str, drawing: str) -> None:
-        super().__init__(None, timestamp, streamer, self.__TYPE__, {"name": name, "drawing": drawing})
+    def __init__(self, timestamp: int, streamer: str, name: str, digest: str) -> None:
+        super().__init__(None, timestamp, streamer, self.__TYPE__, {"name": name, "hash": digest})
 
     @property
     def name(self) -> str:
         return str(self.meta["name"])
 
     @property
-    def drawing(self) -> str:
-        return str(self.meta["drawing"])
+    def digest(self) -> str:
+        """
+        The hash of the drawing in the drawing store. Drawings sent before the drawing store existed
+        have an empty hash until they are backfilled with the manage script.
+        """
+
+        return str(self.meta["hash"])
 
     @staticmethod
     def __from_db__(
@@ -125,7 +133,7 @@ class SendDrawingEvent(Event):
             timestamp,
             streamer,
             str(meta["name"]),
-            str(meta["drawing"]),
+            str(meta.get("hash", "")),
         )
         event.id = eid
         return event
@@ -261,6 +269,10 @@ class ViewerCountEvent(Event):
     def __init__(self, timestamp: int, streamer: str, viewers: int) -> None:
         super().__init__(None, timestamp, streamer, self.__TYPE__, {"viewers": viewers})
 
+    @property
+    def viewers(self) -> int:
+        return int(str(self.meta["viewers"]))
+
     @staticmethod
     def __from_db__(
         eid: int,
@@ -277,6 +289,63 @@ class ViewerCountEvent(Event):
         return event
 
 
+class StreamSummaryEvent(Event):
+    __TYPE__ = "stream_summary"
+
+    def __init__(
+        self,
+        timestamp: int,
+        streamer: str,
+        *,
+        start_id: Optional[int],
+        started: int,
+        peak: int,
+        average: float,
+        messages: int,
+        actions: int,
+        drawings: int,
+        chatters: int,
+    ) -> None:
+        super().__init__(
+            None,
+            timestamp,
+            streamer,
+            self.__TYPE__,
+            {
+                "start_id": start_id,
+                "started": started,
+                "peak": peak,
+                "average": average,
+                "messages": messages,
+                "actions": actions,
+                "drawings": drawings,
+                "chatters": chatters,
+            },
+        )
+
+    @staticmethod
+    def __from_db__(
+        eid: int,
+        timestamp: int,
+        streamer: str,
+        meta: Dict[str, object]
+    ) -> "StreamSummaryEvent":
+        event = StreamSummaryEvent(
+            timestamp,
+            streamer,
+            start_id=int(str(meta["start_id"])) if meta["start_id"] is not None else None,
+            started=int(str(meta["started"])),
+            peak=int(str(meta["peak"])),
+            average=float(str(meta["average"])),
+            messages=int(str(meta["messages"])),
+            actions=int(str(meta["actions"])),
+            drawings=int(str(meta["drawings"])),
+            chatters=int(str(meta["chatters"])),
+        )
+        event.id = eid
+        return event
+
+
 class ModUserEvent(Event):
     __TYPE__ = "mod_user"
 
@@ -417,6 +486,7 @@ __VALID_EVENTS: List[Type[Event]] = [
     StartStreamingEvent,
     StopStreamingEvent,
     ViewerCountEvent,
+    StreamSummaryEvent,
     SetDescriptionEvent,
     SetViewerPasswordEvent,
     JoinChatEvent,
@@ -432,17 +502,269 @@ __VALID_EVENTS: List[Type[Event]] = [
     UnmuteUserEvent,
 ]
 
+# The names of every event type, as they're stored in the DB.
+EVENT_TYPES: List[str] = [cls.__TYPE__ for cls in __VALID_EVENTS]
+
+
+class EventSink:
+    """
+    A buffer of events that have been broadcast but not yet written to the DB. Events are written
+    in batches with a single multi-row insert, either when enough of them pile up or when the oldest
+    one has waited long enough, so that chat handlers never wait on the DB to log what happened.
+    """
+
+    def __init__(self) -> None:
+        self.__pending: List[Event] = []
+        self.__oldest: Optional[float] = None
+        self.__wakeup = GeventEvent()
+        self.__lock = RLock()
+        self.batch_size = 100
+        self.flush_interval = 1.0
+        self.queue_limit = 10000
+
+        # Whether a multi-row insert is known to get consecutive IDs, see check_ids().
+        self.consecutive_ids = True
+
+        # Counters for the metrics endpoint.
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.delayed = 0
+        self.dropped = 0
+        self.failures = 0
+
+    def configure(self, batch_size: int, flush_interval: float, queue_limit: int) -> None:
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.queue_limit = max(self.batch_size, queue_limit)
+
+    @property
+    def pending(self) -> int:
+        return len(self.__pending)
+
+    def queue(self, data: Data, event: Event) -> None:
+        """
+        Add an event to the buffer. If the buffer is full then the caller pays for writing it out
+        synchronously, which is counted as a delayed event.
+        """
+
+        if event.id is not None:
+            raise Exception("Cannot re-insert existing event!")
+
+        event.streamer = event.streamer.lower()
+        if len(self.__pending) >= self.queue_limit:
+            self.delayed += 1
+            self.flush(data)
+
+            if len(self.__pending) >= self.queue_limit:
+                # The DB is unavailable, so make room by giving up on the oldest event.
+                del self.__pending[0]
+                self.dropped += 1
+
+        if not self.__pending:
+            self.__oldest = time.monotonic()
+        self.__pending.append(event)
+        self.queued += 1
+
+        if len(self.__pending) >= self.batch_size:
+            self.__wakeup.set()
+
+    def due(self) -> bool:
+        """
+        Returns whether the buffer should be written out now.
+        """
+
+        if not self.__pending or self.__oldest is None:
+            return False
+        return len(self.__pending) >= self.batch_size or (time.monotonic() - self.__oldest) >= self.flush_interval
+
+    def wait(self) -> None:
+        """
+        Block the calling greenlet until the buffer might be due to be written out.
+        """
+
+        self.__wakeup.wait(timeout=self.flush_interval)
+        self.__wakeup.clear()
+
+    def flush(self, data: Data) -> None:
+        """
+        Write every buffered event to the DB, in the order they were queued. On success every event
+        gets its ID assigned just as if insert_event() had been called on it, except that when
+        check_ids() found that batched IDs can't be trusted only stream starts get theirs. On failure
+        the events are put back to be retried, and if that would go over the queue limit the oldest
+        are dropped.
+        """
+
+        # Only one greenlet may write at a time, otherwise batches could land out of order.
+        with self.__lock:
+            self.__flush(data)
+
+    def check_ids(self, data: Data) -> None:
+        """
+        Works out whether a multi-row insert is guaranteed to be handed consecutive IDs, which is
+        only the case when InnoDB's auto-increment lock mode is traditional (0) or consecutive (1).
+        In interleaved mode (2), the default since MySQL 8, inserts from other workers can take IDs
+        in the middle of ours. Sessions and the last stream lookup only need the IDs of stream starts,
+        so in that mode those are inserted on their own to learn their real IDs and everything else
+        is still batched without being given an ID.
+        """
+
+        mode = data.execute("SELECT @@innodb_autoinc_lock_mode AS mode").fetchone()['mode']
+        self.consecutive_ids = int(mode) in {0, 1}
+        if not self.consecutive_ids:
+            print(f"InnoDB auto-increment lock mode is {mode}, so stream starts will be written one row at a time.")
+
+    def __insert_batch(self, data: Data, batch: List[Event]) -> None:
+        values: List[str] = []
+        params: Dict[str, object] = {}
+        for i, event in enumerate(batch):
+            values.append(f"(:ts{i}, :streamer{i}, :type{i}, :meta{i})")
+            params[f"ts{i}"] = event.timestamp
+            params[f"streamer{i}"] = event.streamer
+            params[f"type{i}"] = event.type
+            params[f"meta{i}"] = json.dumps(event.meta)
+
+        cursor = data.execute(
+            "INSERT INTO events (`timestamp`, `username`, `type`, `meta`) VALUES " + ", ".join(values),
+            params,
+        )
+
+        # A multi-row insert returns the ID of the first row, which only tells us the rest when
+        # check_ids() made sure that InnoDB hands out consecutive IDs. A single row is always safe.
+        if self.consecutive_ids or len(batch) == 1:
+            for i, event in enumerate(batch):
+                event.id = cursor.lastrowid + i
+
+    def __split(self, batch: List[Event]) -> List[List[Event]]:
+        """
+        Splits a batch into the inserts it is written with, which is a single insert unless stream
+        starts need their own to learn their IDs.
+        """
+
+        if self.consecutive_ids:
+            return [batch]
+
+        inserts: List[List[Event]] = []
+        run: List[Event] = []
+        for event in batch:
+            if isinstance(event, StartStreamingEvent):
+                if run:
+                    inserts.append(run)
+                    run = []
+                inserts.append([event])
+            else:
+                run.append(event)
+        if run:
+            inserts.append(run)
+        return inserts
+
+    def __flush(self, data: Data) -> None:
+        while self.__pending:
+            batch = self.__pending[:self.batch_size]
+            del self.__pending[:self.batch_size]
+
+            done = 0
+            try:
+                for rows in self.__split(batch):
+                    self.__insert_batch(data, rows)
+                    done += len(rows)
+            except Exception as e:
+                print(f"Failed to write {len(batch) - done} events: {e}")
+                self.failures += 1
+                if done:
+                    self.written += done
+                    _notify_written(data, batch[:done])
+
+                # Put the rest of the batch back in front of anything queued while we were writing.
+                self.__pending[:0] = batch[done:]
+                overflow = len(self.__pending) - self.queue_limit
+                if overflow > 0:
+                    del self.__pending[:overflow]
+                    self.dropped += overflow
+                return
+
+            self.written += len(batch)
+            self.batches += 1
+            _notify_written(data, batch)
+
+        self.__oldest = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'pending': len(self.__pending),
+            'queued': self.queued,
+            'written': self.written,
+            'batches': self.batches,
+            'delayed': self.delayed,
+            'dropped': self.dropped,
+            'failures': self.failures,
+        }
+
+
+# Process-wide event buffer, configured once the config has been loaded.
+event_sink = EventSink()
+
+
+# Called with every event as it is logged, before it is written to the DB.
+observers: List[Callable[[Event], None]] = []
+
+
+def observe_events(callback: Callable[[Event], None]) -> None:
+    """
+    Starts showing every event that gets logged to the given callback.
+    """
+
+    observers.append(callback)
+
+
+def _notify(event: Event) -> None:
+    for observer in observers:
+        observer(event)
+
+
+# Called with every batch of events right after it is written to the DB, in the order they were written.
+writers: List[Callable[[Data, List[Event]], None]] = []
+
+
+def observe_writes(callback: Callable[[Data, List[Event]], None]) -> None:
+    """
+    Starts showing every batch of events that gets written to the DB to the given callback, once the
+    events have their IDs.
+    """
+
+    writers.append(callback)
+
+
+def _notify_written(data: Data, written: List[Event]) -> None:
+    for writer in writers:
+        writer(data, written)
+
 
 def insert_event(data: Data, event: Event) -> None:
     if event.id is not None:
         raise Exception("Cannot re-insert existing event!")
 
+    # Anything we buffered happened before this, so it needs to land first to keep IDs in order.
+    event_sink.flush(data)
+
     cursor = data.execute(
         "INSERT INTO events (`timestamp`, `username`, `type`, `meta`) VALUES (:ts, :streamer, :type, :meta)",
         {'ts': event.timestamp, 'streamer': event.streamer.lower(), 'type': event.type, 'meta': json.dumps(event.meta)}
     )
     event.streamer = event.streamer.lower()
     event.id = cursor.lastrowid
+    _notify(event)
+    _notify_written(data, [event])
+
+
+def queue_event(data: Data, event: Event) -> None:
+    """
+    Log an event without waiting on the DB. The event gets its ID once the event sink writes it out,
+    which happens before any other event is inserted or any events are looked up.
+    """
+
+    event_sink.queue(data, event)
+    _notify(event)
 
 
 def get_events(
@@ -453,6 +775,9 @@ def get_events(
     after: Optional[Event] = None,
     limit: Optional[int] = None,
 ) -> List[Event]:
+    # Make sure anything we've buffered is visible to the lookup.
+    event_sink.flush(data)
+
     sql = "SELECT * FROM events WHERE username = :streamer"
     params: Dict[str, object] = {
         'streamer': streamer.lower(),
@@ -476,22 +801,74 @@ def get_events(
         sql += " LIMIT :limit"
         params['limit'] = limit
 
-    results: List[Event] = []
-
     cursor = data.execute(sql, params)
-    for row in cursor:
-        etype = row["type"]
-
-        for cls in __VALID_EVENTS:
-            if cls.__TYPE__ == etype:
-                results.append(cls.__from_db__(
-                    int(row["id"]),
-                    int(row["timestamp"]),
-                    str(row["username"]),
-                    json.loads(row["meta"]),
-                ))
-                break
-        else:
-            raise Exception(f"Invalid type {etype} found in database!")
-
+    results = [event_from_row(row) for row in cursor]
     return results[::-1]
+
+
+def page_events(
+    data: Data,
+    *,
+    streamer: str,
+    types: Optional[List[Type[Event]]] = None,
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+    since: Optional[int] = None,
+    limit: int,
+) -> Iterator[Event]:
+    """
+    Looks up a single page of at most limit events, in the order they happened. Given an after event ID
+    this is the page starting right after that event, otherwise it is the page ending right before the
+    before event ID, or the most recent events if neither is given. Pages are found by walking the ID
+    index from the given event, so every page costs the same no matter how far back in history it is.
+    Given a since event ID, nothing at or before that event is returned.
+    """
+
+    # Make sure anything we've buffered is visible to the lookup.
+    event_sink.flush(data)
+
+    sql = "SELECT id, timestamp, username, type, meta FROM events WHERE username = :streamer"
+    params: Dict[str, object] = {
+        'streamer': streamer.lower(),
+        'limit': limit,
+    }
+
+    if types is not None:
+        # Couldn't be an empty list.
+        if not types:
+            return
+
+        sql += " AND type IN :types"
+        params['types'] = [t.__TYPE__ for t in types]
+    if after is not None:
+        sql += " AND id > :after"
+        params['after'] = after
+    if before is not None:
+        sql += " AND id < :before"
+        params['before'] = before
+    if since is not None:
+        sql += " AND id > :since"
+        params['since'] = since
+
+    if after is not None:
+        # Walking forward already gives us the page in order.
+        for row in data.execute(sql + " ORDER BY id ASC LIMIT :limit", params):
+            yield event_from_row(row)
+    else:
+        rows = list(data.execute(sql + " ORDER BY id DESC LIMIT :limit", params))
+        for row in reversed(rows):
+            yield event_from_row(row)
+
+
+def event_from_row(row: Any) -> Event:
+    etype = row["type"]
+    for cls in __VALID_EVENTS:
+        if cls.__TYPE__ == etype:
+            return cls.__from_db__(
+                int(row["id"]),
+                int(row["timestamp"]),
+                str(row["username"]),
+                json.loads(row["meta"]),
+            )
+
+    raise Exception(f"Invalid type {etype} found in database!")
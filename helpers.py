@@ -1,13 +1,17 @@
 import calendar
 import datetime
 import emoji
+import functools
 import os
 import random
+import re
+import unicodedata
 import webcolors  # type: ignore
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from app import config
 from data import Data
+from streamers import StreamerSettingsCache
 
 
 # Pictochat width/height, shared in a couple places.
@@ -15,8 +19,61 @@ PICTOCHAT_IMAGE_WIDTH: int = 240
 PICTOCHAT_IMAGE_HEIGHT: int = 120
 
 
+# Process-wide data handle, created on first use once the config has been loaded.
+_mysql: Optional[Data] = None
+
+
 def mysql() -> Data:
-    return Data(config)
+    """
+    Returns the shared data handle. Sessions are scoped to the calling greenlet, so callers
+    should release them with release_mysql() once their request or event is finished.
+    """
+
+    global _mysql
+    if _mysql is None:
+        _mysql = Data(config)
+    return _mysql
+
+
+# Process-wide streamer settings cache, created on first use once the config has been loaded.
+_streamer_settings: Optional[StreamerSettingsCache] = None
+
+
+def streamer_settings() -> StreamerSettingsCache:
+    """
+    Returns the shared streamer settings cache. Edits made outside of this process show up
+    within the configured refresh interval, which defaults to 5 seconds.
+    """
+
+    global _streamer_settings
+    if _streamer_settings is None:
+        _streamer_settings = StreamerSettingsCache(mysql(), float(config.get('settings_refresh_interval', 5)))
+    return _streamer_settings
+
+
+def release_mysql() -> None:
+    """
+    Returns the calling greenlet's connection to the pool, if it has checked one out.
+    """
+
+    if _mysql is not None:
+        _mysql.close()
+
+
+def releases_mysql(func: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Wraps a Socket.IO event handler so that whatever connection it used is handed back to
+    the pool when the handler returns, regardless of how it returns.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_mysql()
+
+    return wrapper
 
 
 def now() -> int:
@@ -50,28 +107,6 @@ def first_quality() -> Optional[str]:
     return None
 
 
-def stream_live(streamkey: str, quality: Optional[str] = None) -> bool:
-    """
-    Looks up a stream by the stream key and quality, returning True if the stream was last published to
-    within the configured indicator delay, and False otherwise.
-    """
-
-    if quality:
-        filename = f"{streamkey}_{quality}.m3u8"
-    else:
-        filename = streamkey + '.m3u8'
-    m3u8 = os.path.join(config['hls_dir'], filename)
-    if not os.path.isfile(m3u8):
-        # There isn't a playlist file, we aren't live.
-        return False
-
-    delta = now() - modified(m3u8)
-    if delta >= int(config.get('live_indicator_delay', 5)):
-        return False
-
-    return True
-
-
 def get_color(color: str) -> Optional[int]:
     """
     Given either a hex color (in HTML style) or a CSS3 color name, attempts to return the actual RGB
@@ -105,25 +140,6 @@ def get_color(color: str) -> Optional[int]:
     return intval
 
 
-def fetch_m3u8(streamkey: str, quality: Optional[str] = None) -> Optional[str]:
-    """
-    Given a stream key and an optional quality, fetches the M3U8 contents corresponding to
-    those details. If the streamer isn't live, this returns None instead.
-    """
-
-    if quality:
-        filename = f"{streamkey}_{quality}"
-    else:
-        filename = streamkey
-    m3u8 = os.path.join(config['hls_dir'], filename) + '.m3u8'
-    if not os.path.isfile(m3u8):
-        # There isn't a playlist file, we aren't live.
-        return None
-
-    with open(m3u8, "rb") as bfp:
-        return bfp.read().decode('utf-8')
-
-
 def fetch_ts(filename: str) -> Optional[bytes]:
     """
     Given a ts filename, grabs the data for that file. This is a debug function only, normally
@@ -153,28 +169,6 @@ def symlink(oldname: str, newname: str) -> None:
         pass
 
 
-def clean_symlinks() -> None:
-    """
-    Removes any previously created symlinks that no longer point at a valid file. This happens when
-    the stream advances past an older file name and the file is deleted, leaving the symlink dangling.
-    """
-
-    try:
-        for name in os.listdir(config['hls_dir']):
-            if name not in (os.curdir, os.pardir):
-                full = os.path.join(config['hls_dir'], name)
-                if os.path.islink(full):
-                    real = os.readlink(full)
-                    if not os.path.isfile(real):
-                        # This symlink points at an old file that nginx has removed.
-                        # So, let's clean up!
-                        os.remove(full)
-    except Exception:
-        # We don't want to interrupt playlist fetching due to a failure to
-        # clean. If this happens the stream will pause.
-        pass
-
-
 _EMOJI_UNICODE: Dict[str, Any] = {lang: None for lang in emoji.LANGUAGES}  # Cache for the language dicts
 _ALIASES_UNICODE: Dict[str, str] = {}  # Cache for the aliases dict
 
@@ -208,20 +202,130 @@ def get_aliases_unicode_dict() -> Dict[str, str]:
     return _ALIASES_UNICODE
 
 
+# Anything that could be an emoji shortcode, the actual decision is made by looking the name up.
+_EMOJI_PATTERN = re.compile(r":[^\s:]+:")
+
+
+@functools.lru_cache(maxsize=4096)
 def emotes(msg: str) -> str:
-    return emoji.emojize(emoji.emojize(msg, language="alias"), language="en")
+    """
+    Expands emoji shortcodes, both the standard names and their aliases, into their unicode
+    equivalents in a single scan over the message. Results are memoized since the same strings,
+    such as stream descriptions, get expanded over and over.
+    """
+
+    names = get_aliases_unicode_dict()
+    pieces: List[str] = []
+    start = 0
+    pos = 0
+    while True:
+        match = _EMOJI_PATTERN.search(msg, pos)
+        if match is None:
+            break
+
+        name = match.group(0)
+        emj = names.get(name)
+        if emj is None:
+            emj = names.get(unicodedata.normalize('NFKC', name))
+
+        if emj is not None:
+            pieces.append(msg[start:match.start()])
+            pieces.append(emj)
+            start = pos = match.end()
+        else:
+            # The closing colon could be the opening colon of a real shortcode, so resume there.
+            pos = match.end() - 1
+
+    pieces.append(msg[start:])
+    return "".join(pieces)
+
+
+# Custom emote aliases may only contain letters, numbers, underscores and dashes.
+_EMOTE_PATTERN = re.compile(r":([\w-]+):")
+
+
+class EmoteRegistry:
+    """
+    The set of custom emotes configured on the network, loaded once and kept up to date by the
+    background thread's emote delta check. Lookups happen in a single scan over the message no
+    matter how many emotes are configured.
+    """
+
+    def __init__(self) -> None:
+        self.__emotes: Dict[str, str] = {}
+
+    @property
+    def emotes(self) -> Dict[str, str]:
+        """
+        Returns a mapping of ":alias:" keys to URIs, sorted by alias, as the frontend expects them.
+        """
+
+        return {f":{alias}:": self.__emotes[alias] for alias in sorted(self.__emotes)}
+
+    def update(self, emotes: Dict[str, str]) -> Tuple[Dict[str, str], List[str]]:
+        """
+        Replace the registry with a new mapping of aliases to URIs. Returns a tuple of the added
+        emotes as a mapping of ":alias:" keys to URIs and the removed emotes as a list of ":alias:" keys.
+        """
+
+        added = {f":{alias}:": uri for alias, uri in emotes.items() if alias not in self.__emotes}
+        removed = [f":{alias}:" for alias in self.__emotes if alias not in emotes]
+        self.__emotes = dict(emotes)
+        return added, removed
+
+    def refresh(self, data: Data) -> Tuple[Dict[str, str], List[str]]:
+        """
+        Reload the registry from the DB, returning the delta in the same format as update().
+        """
+
+        cursor = data.execute(
+            "SELECT alias, uri FROM emotes",
+        )
+        return self.update({result['alias']: result['uri'] for result in cursor})
+
+    def substitute(self, msg: str, replacement: str) -> str:
+        """
+        Replace every custom emote in a message with the replacement text.
+        """
+
+        pieces: List[str] = []
+        start = 0
+        pos = 0
+        while True:
+            match = _EMOTE_PATTERN.search(msg, pos)
+            if match is None:
+                break
+
+            if match.group(1) in self.__emotes:
+                pieces.append(msg[start:match.start()])
+                pieces.append(replacement)
+                start = pos = match.end()
+            else:
+                # The closing colon could be the opening colon of a real emote, so resume there.
+                pos = match.end() - 1
+
+        pieces.append(msg[start:])
+        return "".join(pieces)
+
+
+# Process-wide emote registry, loaded on first use once the config has been loaded.
+_custom_emotes: Optional[EmoteRegistry] = None
+
+
+def custom_emotes() -> EmoteRegistry:
+    global _custom_emotes
+    if _custom_emotes is None:
+        _custom_emotes = EmoteRegistry()
+        _custom_emotes.refresh(mysql())
+    return _custom_emotes
 
 
-def message_length(data: Data, msg: str) -> int:
+def message_length(msg: str) -> int:
     # First, easy conversions.
     msg = emotes(msg)
 
-    # Now, look up configured emoji aliases.
-    cursor = data.execute(
-        "SELECT alias FROM emotes ORDER BY alias",
-    )
-    for result in cursor:
-        msg = msg.replace(f":{result['alias']}:", "*")
+    # Now, collapse configured emoji aliases.
+    msg = custom_emotes().substitute(msg, "*")
 
     # Now, return the length, where each emoji and emote counts as one character.
     return len(msg)
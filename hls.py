@@ -0,0 +1,374 @@
+import ctypes
+import ctypes.util
+import os
+import socket
+import struct
+from gevent.socket import wait_read  # type: ignore
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from app import config, socketio
+from helpers import modified, now, symlink
+from sessions import session_tracker
+
+
+class SymlinkRegistry:
+    """
+    The symlinks that we created in the HLS directory to hide stream keys. Once a segment drops out
+    of its playlist it is retired, and retired links are removed by a periodic collection once nginx
+    deletes the segment they point at. Only links we know about get looked at, so collection costs
+    nothing when nothing has been retired.
+    """
+
+    def __init__(self) -> None:
+        self.__active: Set[str] = set()
+        self.__retired: Set[str] = set()
+
+    def link(self, oldname: str, newname: str) -> None:
+        symlink(oldname, newname)
+        self.__active.add(newname)
+        self.__retired.discard(newname)
+
+    def retire(self, names: Iterable[str]) -> None:
+        for name in names:
+            self.__active.discard(name)
+            self.__retired.add(name)
+
+    def collect(self) -> int:
+        """
+        Removes every retired symlink whose segment no longer exists, returning how many were removed.
+        """
+
+        removed = 0
+        for name in list(self.__retired):
+            full = os.path.join(config['hls_dir'], name)
+            try:
+                if os.path.isfile(full):
+                    # Still around, so somebody that's behind could still be fetching it.
+                    continue
+                os.remove(full)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Failed to remove symlink {name}: {e}")
+                continue
+
+            self.__retired.discard(name)
+            removed += 1
+        return removed
+
+    def reconcile(self) -> None:
+        """
+        Scans the whole HLS directory for symlinks, which is only necessary on startup since a previous
+        server could have left some behind. Dangling ones are removed and the rest are retired so they
+        get collected once nginx cleans up after them.
+        """
+
+        try:
+            names = os.listdir(config['hls_dir'])
+        except OSError as e:
+            print(f"Failed to scan HLS directory: {e}")
+            return
+
+        for name in names:
+            full = os.path.join(config['hls_dir'], name)
+            if os.path.islink(full) and name not in self.__active:
+                self.__retired.add(name)
+        self.collect()
+
+
+# Process-wide registry of symlinks that we've created.
+symlink_registry = SymlinkRegistry()
+
+
+# The inotify flags we care about, from <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_DELETE = 0x00000200
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o0004000
+
+# Every inotify event starts with the watch descriptor, mask, cookie and the length of the name.
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    A minimal wrapper around Linux inotify for a single directory, waited on cooperatively.
+    """
+
+    def __init__(self, path: str) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.__fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.__fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_DELETE
+        if libc.inotify_add_watch(self.__fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.__fd)
+            raise OSError(errno, os.strerror(errno))
+
+    def wait(self, timeout: float) -> Set[str]:
+        """
+        Wait up to timeout seconds for changes, returning the names of the files that changed.
+        """
+
+        try:
+            wait_read(self.__fd, timeout=timeout)
+        except socket.timeout:
+            return set()
+
+        names: Set[str] = set()
+        while True:
+            try:
+                buf = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                return names
+
+            pos = 0
+            while pos + _INOTIFY_EVENT.size <= len(buf):
+                _, _, _, length = _INOTIFY_EVENT.unpack_from(buf, pos)
+                pos += _INOTIFY_EVENT.size
+                name = buf[pos:(pos + length)].rstrip(b"\0")
+                pos += length
+                if name:
+                    names.add(os.fsdecode(name))
+
+    def close(self) -> None:
+        os.close(self.__fd)
+
+
+class HLSWatcher:
+    """
+    A table of when each playlist in the HLS directory was last written, kept up to date by watching
+    the directory instead of statting playlists on every request.
+    """
+
+    def __init__(self) -> None:
+        self.__writes: Dict[str, int] = {}
+        self.running = False
+
+    def update(self, name: str) -> None:
+        """
+        Records a change to a single file in the HLS directory, ignoring anything that isn't a playlist.
+        """
+
+        if not name.endswith(".m3u8"):
+            return
+
+        m3u8 = os.path.join(config['hls_dir'], name)
+        try:
+            self.__writes[name[:-5]] = int(os.stat(m3u8).st_mtime)
+        except FileNotFoundError:
+            self.__writes.pop(name[:-5], None)
+        playlist_cache.changed(m3u8)
+
+    def scan(self) -> None:
+        """
+        Rebuilds the table from scratch by looking at every playlist in the HLS directory.
+        """
+
+        names = set(name for name in os.listdir(config['hls_dir']) if name.endswith(".m3u8"))
+        for stem in [stem for stem in self.__writes if f"{stem}.m3u8" not in names]:
+            self.update(f"{stem}.m3u8")
+        for name in names:
+            self.update(name)
+
+    def live(self, filename: str, delay: int) -> Optional[bool]:
+        """
+        Returns whether the playlist with the given name, minus its extension, was written to within the
+        given number of seconds. Returns None if we aren't watching, in which case the caller should
+        look at the file itself.
+        """
+
+        if not self.running:
+            return None
+
+        written = self.__writes.get(filename)
+        if written is None:
+            return False
+        return (now() - written) < delay
+
+
+# Process-wide table of playlist writes.
+hls_watcher = HLSWatcher()
+
+
+def stream_live(streamkey: str, quality: Optional[str] = None) -> bool:
+    """
+    Looks up a stream by the stream key and quality, returning True if the stream was last published to
+    within the configured indicator delay, and False otherwise. When we saw the stream start, a quality
+    that has already been playable gets the longer session grace period instead, so that a slow write
+    doesn't flicker the indicator, while a transcoder that died without nginx noticing still goes offline.
+    """
+
+    delay = int(config.get('live_indicator_delay', 5))
+    session = session_tracker.by_key(streamkey)
+    if session is not None:
+        if not session.live:
+            return False
+        if quality in session.playable:
+            delay = max(delay, int(config.get('live_session_grace', 30)))
+
+    if quality:
+        filename = f"{streamkey}_{quality}"
+    else:
+        filename = streamkey
+
+    live = hls_watcher.live(filename, delay)
+    if live is None:
+        m3u8 = os.path.join(config['hls_dir'], filename) + '.m3u8'
+        if not os.path.isfile(m3u8):
+            # There isn't a playlist file, we aren't live.
+            live = False
+        else:
+            live = (now() - modified(m3u8)) < delay
+
+    if session is not None:
+        if live:
+            session.playable.add(quality)
+        else:
+            # The playlist stopped being written, so hold it to the normal delay until it comes back.
+            session.playable.discard(quality)
+    return live
+
+
+class CachedPlaylist:
+    def __init__(self, version: Tuple[str, int, int, int], playlist: str, segments: Set[str]) -> None:
+        self.version = version
+        self.playlist = playlist
+        self.segments = segments
+
+        # Set when the watcher sees the file change, so we know to look at it again.
+        self.stale = False
+
+
+class PlaylistCache:
+    """
+    The rewritten playlists that we hand out to viewers, keyed by streamer and quality. A playlist
+    is only read and rewritten when nginx writes a new version of it, which we notice by comparing
+    the path, inode, modification time and size of the file against the version we rewrote.
+    """
+
+    def __init__(self) -> None:
+        self.__playlists: Dict[Tuple[str, Optional[str]], CachedPlaylist] = {}
+
+    def invalidate(self, streamer: str, quality: Optional[str] = None) -> None:
+        cached = self.__playlists.pop((streamer, quality), None)
+        if cached is not None:
+            symlink_registry.retire(cached.segments)
+
+    def changed(self, m3u8: str) -> None:
+        """
+        Called by the watcher when a playlist file changes, so the next fetch looks at it again.
+        """
+
+        for cached in self.__playlists.values():
+            if cached.version[0] == m3u8:
+                cached.stale = True
+
+    def fetch(self, streamer: str, streamkey: str, quality: Optional[str] = None) -> Optional[str]:
+        """
+        Given a streamer, their stream key and an optional quality, returns the playlist with all
+        segments renamed to hide the stream key. If the streamer isn't live, this returns None instead.
+        """
+
+        if quality:
+            filename = f"{streamkey}_{quality}"
+        else:
+            filename = streamkey
+        m3u8 = os.path.join(config['hls_dir'], filename) + '.m3u8'
+
+        # Go by the same rules as the live indicator, so the player never gets turned away from a stream
+        # that the page says is live.
+        if not stream_live(streamkey, quality):
+            return None
+
+        # When the directory is being watched, we already know whether anything changed.
+        cached = self.__playlists.get((streamer, quality))
+        if hls_watcher.running and cached is not None and cached.version[0] == m3u8 and not cached.stale:
+            return cached.playlist
+
+        try:
+            stat = os.stat(m3u8)
+        except FileNotFoundError:
+            # The playlist went away since we looked, we aren't live.
+            self.invalidate(streamer, quality)
+            return None
+
+        version = (m3u8, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if cached is not None and cached.version == version:
+            cached.stale = False
+            return cached.playlist
+
+        with open(m3u8, "rb") as bfp:
+            lines = bfp.read().decode('utf-8').splitlines()
+
+        newprefix = f"{streamer}_{quality}" if quality else streamer
+        segments: Set[str] = set()
+        for i in range(len(lines)):
+            if lines[i].startswith(filename) and lines[i][-3:] == ".ts":
+                # We need to rewrite this, and link it if we didn't already for the last version.
+                oldname = lines[i]
+                newname = newprefix + lines[i][len(filename):]
+                if cached is None or newname not in cached.segments:
+                    symlink_registry.link(oldname, newname)
+                segments.add(newname)
+                lines[i] = "/hls/" + newname
+            if streamkey in lines[i]:
+                raise Exception("Possible stream key leak!")
+
+        # Anything that fell out of the playlist window can be cleaned up once nginx deletes it.
+        if cached is not None:
+            symlink_registry.retire(cached.segments - segments)
+
+        playlist = "\n".join(lines)
+        self.__playlists[(streamer, quality)] = CachedPlaylist(version, playlist, segments)
+        return playlist
+
+
+# Process-wide cache of rewritten playlists.
+playlist_cache = PlaylistCache()
+
+
+def symlink_gc_thread_proc() -> None:
+    """
+    The background thread that removes symlinks to segments that nginx has deleted.
+    """
+
+    interval = float(config.get('symlink_gc_interval', 5))
+    while True:
+        socketio.sleep(interval)
+        symlink_registry.collect()
+
+
+def hls_watch_thread_proc() -> None:
+    """
+    The background thread that keeps the playlist write table current, using inotify where it's
+    available and falling back to looking at the directory periodically where it isn't.
+    """
+
+    try:
+        inotify: Optional[Inotify] = Inotify(config['hls_dir'])
+    except (OSError, AttributeError) as e:
+        print(f"Watching HLS directory by polling since inotify is unavailable: {e}")
+        inotify = None
+
+    interval = float(config.get('hls_poll_interval', 1))
+    hls_watcher.scan()
+    hls_watcher.running = True
+
+    try:
+        while True:
+            if inotify is not None:
+                for name in inotify.wait(interval):
+                    hls_watcher.update(name)
+            else:
+                socketio.sleep(interval)
+                hls_watcher.scan()
+    finally:
+        hls_watcher.running = False
+        if inotify is not None:
+            inotify.close()
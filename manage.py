@@ -1,11 +1,16 @@
 import argparse
+import gzip
+import json
 import sys
 import yaml
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from data import Data, DBCreateException
-from events import SetDescriptionEvent, SetViewerPasswordEvent, insert_event
+from drawings import DrawingStore, decode_drawing, default_drawings_dir
+from events import EVENT_TYPES, SetDescriptionEvent, SetViewerPasswordEvent, event_from_row, insert_event
 from helpers import now
+from notify import default_socket_path, poke
+from sessions import SessionRollup
 
 
 class CLIException(Exception):
@@ -64,6 +69,9 @@ def addstreamer(config: Dict[str, Any], username: str, key: str) -> None:
     )
     data.close()
 
+    # Let a running server know so that it picks up the change right away.
+    poke(config, "streamers")
+
 
 def dropstreamer(config: Dict[str, Any], username: str) -> None:
     """
@@ -77,6 +85,7 @@ def dropstreamer(config: Dict[str, Any], username: str) -> None:
         {'username': username},
     )
     data.close()
+    poke(config, "streamers")
 
 
 def liststreamers(config: Dict[str, Any]) -> None:
@@ -116,6 +125,7 @@ def streamdescription(config: Dict[str, Any], username: str, description: Option
         )
     )
     data.close()
+    poke(config, "streamers")
 
 
 def streampassword(config: Dict[str, Any], username: str, password: Optional[str]) -> None:
@@ -141,6 +151,7 @@ def streampassword(config: Dict[str, Any], username: str, password: Optional[str
         )
     )
     data.close()
+    poke(config, "streamers")
 
 
 def streamerkey(config: Dict[str, Any], username: str, key: Optional[str]) -> None:
@@ -157,6 +168,7 @@ def streamerkey(config: Dict[str, Any], username: str, key: Optional[str]) -> No
         {'username': username, 'key': key},
     )
     data.close()
+    poke(config, "streamers")
 
 
 def streammastodonurl(config: Dict[str, Any], username: str, url: Optional[str]) -> None:
@@ -173,6 +185,7 @@ def streammastodonurl(config: Dict[str, Any], username: str, url: Optional[str])
         {'username': username, 'url': url},
     )
     data.close()
+    poke(config, "streamers")
 
 
 def streamchatsetting(config: Dict[str, Any], username: str, state: Optional[str]) -> None:
@@ -195,6 +208,25 @@ def streamchatsetting(config: Dict[str, Any], username: str, state: Optional[str
         {'username': username, 'state': state},
     )
     data.close()
+    poke(config, "streamers")
+
+
+def streambacklog(config: Dict[str, Any], username: str, lines: Optional[int]) -> None:
+    """
+    Given a valid config and a number of lines, updates how many recent chat lines that streamer's
+    chatters see when they join, where 0 turns the backlog off and None goes back to the server default.
+    """
+
+    if lines is not None and lines < 0:
+        raise CLIException("You must provide a backlog size of zero or more lines!")
+
+    data = Data(config)
+    data.execute(
+        "UPDATE streamersettings SET `backlog` = :lines WHERE username = :username",
+        {'username': username, 'lines': lines},
+    )
+    data.close()
+    poke(config, "streamers")
 
 
 def addemote(config: Dict[str, Any], alias: str, uri: str) -> None:
@@ -275,12 +307,280 @@ def sendmessage(config: Dict[str, Any], username: str, messagetype: str, message
             # Successfully queued message.
             sent = True
 
+        if sent:
+            # Let a server on this host know so it can deliver right away.
+            poke(config, "pending")
+
         if not sent:
             raise CommandException(f"Could not find streamer {username} on this network!")
     finally:
         data.close()
 
 
+def backfilldrawings(config: Dict[str, Any], batch: int) -> None:
+    """
+    Given a valid config, moves every drawing that was stored inline in a send_drawing event into the
+    drawing store, replacing the inline copy with the drawing's hash. Events are converted in batches
+    ordered by ID, so this can be stopped and restarted at any point.
+    """
+
+    store = DrawingStore()
+    store.configure(config['drawings_dir'])
+    data = Data(config)
+
+    last = 0
+    converted = 0
+    invalid = 0
+    while True:
+        cursor = data.execute(
+            "SELECT id, meta FROM events WHERE type = 'send_drawing' AND id > :last ORDER BY id LIMIT :limit",
+            {'last': last, 'limit': batch},
+        )
+        rows = [(row['id'], json.loads(row['meta'])) for row in cursor]
+        if not rows:
+            break
+
+        for eid, meta in rows:
+            last = eid
+            if 'hash' in meta:
+                continue
+
+            try:
+                digest = store.save(decode_drawing(str(meta.get('drawing', ''))))
+            except ValueError as e:
+                print(f"Skipping event {eid} with invalid drawing: {e}")
+                invalid += 1
+                continue
+
+            data.execute(
+                "UPDATE events SET meta = :meta WHERE id = :id",
+                {'id': eid, 'meta': json.dumps({'name': meta['name'], 'hash': digest})},
+            )
+            converted += 1
+
+        print(f"Converted {converted} drawings so far, up to event {last}")
+        data.close()
+
+    data.close()
+    print(f"Converted {converted} drawings, skipped {invalid} invalid drawings.")
+
+
+def __event_filter(days: int, types: Optional[List[str]]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Given an age in days and an optional list of event types, returns the WHERE clause and parameters
+    that select matching events.
+    """
+
+    if days < 0:
+        raise CLIException("You must provide a non-negative number of days!")
+
+    sql = "timestamp < :cutoff"
+    params: Dict[str, Any] = {'cutoff': now() - (days * 24 * 60 * 60)}
+    if types:
+        sql += " AND type IN :types"
+        params['types'] = types
+    return sql, params
+
+
+def pruneevents(config: Dict[str, Any], days: int, types: Optional[List[str]], archive: bool, batch: int, dry_run: bool) -> None:
+    """
+    Given a valid config, deletes every event older than the given number of days, optionally only of
+    certain types. When archive is set, events are moved into the events archive table instead. Events
+    are handled in batches so that no single statement holds locks on the table for long, and this can
+    be stopped and restarted at any point.
+    """
+
+    where, params = __event_filter(days, types)
+    verb = "archive" if archive else "delete"
+    data = Data(config)
+
+    if dry_run:
+        count = data.execute(f"SELECT COUNT(*) AS count FROM events WHERE {where}", params).fetchone()['count']
+        data.close()
+        print(f"Would {verb} {count} events older than {days} days.")
+        return
+
+    handled = 0
+    while True:
+        cursor = data.execute(f"SELECT id FROM events WHERE {where} LIMIT :limit", {**params, 'limit': batch})
+        ids = [row['id'] for row in cursor]
+        if not ids:
+            break
+
+        if archive:
+            # Copying ignores anything already archived by a previous run that got interrupted.
+            data.execute(
+                "INSERT IGNORE INTO events_archive (id, timestamp, username, type, meta) "
+                "SELECT id, timestamp, username, type, meta FROM events WHERE id IN :ids",
+                {'ids': ids},
+            )
+        data.execute("DELETE FROM events WHERE id IN :ids", {'ids': ids})
+        data.close()
+
+        handled += len(ids)
+        print(f"{verb.capitalize()}d {handled} events so far")
+
+    data.close()
+    print(f"{verb.capitalize()}d {handled} events older than {days} days.")
+
+
+def compactevents(config: Dict[str, Any], days: int, batch: int, dry_run: bool) -> None:
+    """
+    Given a valid config, downsamples viewer count events older than the given number of days to at
+    most one per streamer per minute. The event that is kept is moved to the start of its minute and
+    records the peak viewer count over that minute, along with how many samples went into it. Running
+    this again over already compacted events leaves them alone.
+    """
+
+    where, params = __event_filter(days, None)
+    data = Data(config)
+    streamers = [row['username'] for row in data.execute("SELECT DISTINCT username FROM events")]
+
+    samples = 0
+    kept = 0
+    for streamer in streamers:
+        last = 0
+        carried: List[Tuple[int, int, Dict[str, Any]]] = []
+        while True:
+            # Walking the username, type and ID index means every batch picks up right where the last left off.
+            cursor = data.execute(
+                f"SELECT id, timestamp, meta FROM events WHERE username = :streamer AND type = 'viewer_count' AND {where} AND id > :last ORDER BY id LIMIT :limit",
+                {**params, 'streamer': streamer, 'last': last, 'limit': batch},
+            )
+            rows = carried + [(row['id'], row['timestamp'], json.loads(row['meta'])) for row in cursor]
+            done = len(rows) - len(carried) < batch
+            if len(rows) > len(carried):
+                last = rows[-1][0]
+
+            # Group samples by minute. The last minute might continue in the next batch, so hold onto it.
+            minutes: Dict[int, List[Tuple[int, int, Dict[str, Any]]]] = {}
+            for row in rows:
+                minutes.setdefault(row[1] // 60, []).append(row)
+            carried = []
+            if not done and minutes:
+                carried = minutes.pop(max(minutes))
+
+            doomed: List[int] = []
+            for minute, group in minutes.items():
+                samples += sum(int(meta.get('samples', 1)) for _, _, meta in group)
+                kept += 1
+                if len(group) == 1:
+                    continue
+
+                meta = {
+                    'viewers': max(int(meta['viewers']) for _, _, meta in group),
+                    'samples': sum(int(meta.get('samples', 1)) for _, _, meta in group),
+                }
+                doomed.extend(eid for eid, _, _ in group[1:])
+                if not dry_run:
+                    data.execute(
+                        "UPDATE events SET timestamp = :ts, meta = :meta WHERE id = :id",
+                        {'id': group[0][0], 'ts': minute * 60, 'meta': json.dumps(meta)},
+                    )
+
+            if doomed and not dry_run:
+                data.execute("DELETE FROM events WHERE id IN :ids", {'ids': doomed})
+            data.close()
+
+            if done:
+                break
+
+        print(f"Compacted viewer counts for {streamer}, {samples} samples into {kept} events so far")
+
+    data.close()
+    if dry_run:
+        print(f"Would compact {samples} viewer count samples older than {days} days into {kept} events.")
+    else:
+        print(f"Compacted {samples} viewer count samples older than {days} days into {kept} events.")
+
+
+def exportevents(config: Dict[str, Any], output: str, days: int, types: Optional[List[str]], archived: bool, batch: int, dry_run: bool) -> None:
+    """
+    Given a valid config, writes every event older than the given number of days, optionally only of
+    certain types, to a gzip compressed file with one JSON object per line. Events are read in batches
+    by ID, so the export never holds more than one batch in memory.
+    """
+
+    where, params = __event_filter(days, types)
+    table = "events_archive" if archived else "events"
+    data = Data(config)
+
+    if dry_run:
+        count = data.execute(f"SELECT COUNT(*) AS count FROM {table} WHERE {where}", params).fetchone()['count']
+        data.close()
+        print(f"Would export {count} events older than {days} days to {output}.")
+        return
+
+    last = 0
+    exported = 0
+    with gzip.open(output, "wt", encoding="utf-8") as fp:
+        while True:
+            cursor = data.execute(
+                f"SELECT id, timestamp, username, type, meta FROM {table} WHERE {where} AND id > :last ORDER BY id LIMIT :limit",
+                {**params, 'last': last, 'limit': batch},
+            )
+            rows = cursor.fetchall()
+            data.close()
+            if not rows:
+                break
+
+            for row in rows:
+                fp.write(json.dumps({
+                    'id': row['id'],
+                    'timestamp': row['timestamp'],
+                    'username': row['username'],
+                    'type': row['type'],
+                    'meta': json.loads(row['meta']),
+                }) + "\n")
+            exported += len(rows)
+            last = rows[-1]['id']
+            print(f"Exported {exported} events so far, up to event {last}")
+
+    print(f"Exported {exported} events older than {days} days to {output}.")
+
+
+def backfillsessions(config: Dict[str, Any], archived: bool, batch: int) -> None:
+    """
+    Given a valid config, rebuilds the sessions table from scratch by replaying every event that affects
+    a session, optionally including archived events. Events are read in batches by ID and rolled up a
+    batch at a time, so this never holds more than one batch in memory. This should be run while the
+    server is stopped, since anything it writes while we're replaying would be counted twice.
+    """
+
+    data = Data(config)
+    data.execute("DELETE FROM session_chatters")
+    data.execute("DELETE FROM sessions")
+
+    sql = "SELECT id, timestamp, username, type, meta FROM events WHERE type IN :types AND id > :last"
+    if archived:
+        sql = (
+            f"({sql}) UNION ALL "
+            "(SELECT id, timestamp, username, type, meta FROM events_archive WHERE type IN :types AND id > :last)"
+        )
+
+    rollup = SessionRollup()
+    last = 0
+    replayed = 0
+    while True:
+        cursor = data.execute(
+            f"{sql} ORDER BY id LIMIT :limit",
+            {'types': SessionRollup.TYPES, 'last': last, 'limit': batch},
+        )
+        events = [event_from_row(row) for row in cursor]
+        if not events:
+            break
+
+        rollup.apply(data, events)
+        replayed += len(events)
+        last = events[-1].id or last
+        print(f"Replayed {replayed} events so far, up to event {last}")
+        data.close()
+
+    count = data.execute("SELECT COUNT(*) AS count FROM sessions").fetchone()['count']
+    data.close()
+    print(f"Rebuilt {count} sessions from {replayed} events.")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="A utility for initializing and updating the streaming backend DB.")
     parser.add_argument(
@@ -490,6 +790,27 @@ def main() -> None:
         help="the updated chat setting, where enabled is visible on page load, disabled is fully disabled, and hidden is hidden but enabled on page load",
     )
 
+    # A few params for this one
+    backlog_parser = streamer_commands.add_parser(
+        "backlog",
+        help="change how many recent chat lines new chatters see for a streamer",
+        description="Change how many recent chat lines new chatters see for a streamer.",
+    )
+    backlog_parser.add_argument(
+        "-u",
+        "--username",
+        type=str,
+        required=True,
+        help="streamer username to modify the backlog for",
+    )
+    backlog_parser.add_argument(
+        "-l",
+        "--lines",
+        type=int,
+        default=None,
+        help="the number of lines to keep, where 0 turns the backlog off (defaults to the chat_backlog config setting)",
+    )
+
     # Another subcommand here.
     emote_parser = commands.add_parser(
         "emote",
@@ -578,9 +899,137 @@ def main() -> None:
         help="actual message to send to the chat of the streamer",
     )
 
+    # Another subcommand here.
+    drawing_parser = commands.add_parser(
+        "drawing",
+        help="manage pictochat drawings sent on the network",
+        description="Manage pictochat drawings sent on the network.",
+    )
+    drawing_commands = drawing_parser.add_subparsers(dest="drawing")
+
+    # A few params for this one
+    backfill_parser = drawing_commands.add_parser(
+        "backfill",
+        help="move drawings stored inline in chat events into the drawing store",
+        description="Move drawings stored inline in chat events into the drawing store.",
+    )
+    backfill_parser.add_argument(
+        "-b",
+        "--batch",
+        type=int,
+        default=500,
+        help="number of events to convert at once (defaults to 500)",
+    )
+
+    # Another subcommand here.
+    events_parser = commands.add_parser(
+        "events",
+        help="manage the event log for the network",
+        description="Manage the event log for the network.",
+    )
+    events_commands = events_parser.add_subparsers(dest="events")
+
+    # A few params for this one
+    prune_parser = events_commands.add_parser(
+        "prune",
+        help="delete or archive old events",
+        description="Delete or archive old events.",
+    )
+    compact_parser = events_commands.add_parser(
+        "compact",
+        help="downsample old viewer count events to one per streamer per minute",
+        description="Downsample old viewer count events to one per streamer per minute.",
+    )
+    export_parser = events_commands.add_parser(
+        "export",
+        help="export old events to a compressed JSONL file",
+        description="Export old events to a compressed JSONL file.",
+    )
+    for events_command in [prune_parser, compact_parser, export_parser]:
+        events_command.add_argument(
+            "-d",
+            "--days",
+            type=int,
+            required=True,
+            help="only operate on events older than this many days",
+        )
+        events_command.add_argument(
+            "-b",
+            "--batch",
+            type=int,
+            default=1000,
+            help="number of events to operate on at once (defaults to 1000)",
+        )
+        events_command.add_argument(
+            "-n",
+            "--dry-run",
+            action="store_true",
+            help="report what would be done without changing or writing anything",
+        )
+    for events_command in [prune_parser, export_parser]:
+        events_command.add_argument(
+            "-t",
+            "--type",
+            type=str,
+            action="append",
+            dest="types",
+            metavar="TYPE",
+            choices=EVENT_TYPES,
+            help=f"only operate on events of this type, can be given more than once (defaults to all types, which are {', '.join(EVENT_TYPES)})",
+        )
+    prune_parser.add_argument(
+        "-a",
+        "--archive",
+        action="store_true",
+        help="move events to the events archive table instead of deleting them",
+    )
+    export_parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=True,
+        help="file to write the events to, which will be gzip compressed",
+    )
+    export_parser.add_argument(
+        "-a",
+        "--archived",
+        action="store_true",
+        help="export events from the events archive table instead of the events table",
+    )
+
+    # Another subcommand here.
+    sessions_parser = commands.add_parser(
+        "sessions",
+        help="manage the per-stream session rollups",
+        description="Manage the per-stream session rollups.",
+    )
+    sessions_commands = sessions_parser.add_subparsers(dest="sessions")
+
+    # A few params for this one
+    sessions_backfill_parser = sessions_commands.add_parser(
+        "backfill",
+        help="rebuild session rollups from the event log, which should be done with the server stopped",
+        description="Rebuild session rollups from the event log, which should be done with the server stopped.",
+    )
+    sessions_backfill_parser.add_argument(
+        "-a",
+        "--archived",
+        action="store_true",
+        help="include events from the events archive table",
+    )
+    sessions_backfill_parser.add_argument(
+        "-b",
+        "--batch",
+        type=int,
+        default=1000,
+        help="number of events to replay at once (defaults to 1000)",
+    )
+
     args = parser.parse_args()
 
     config = yaml.safe_load(open(args.config))
+    config.setdefault('notify_socket', default_socket_path(args.config))
+    config.setdefault('drawings_dir', default_drawings_dir(args.config))
     config['database']['engine'] = Data.create_engine(config)
     try:
         if args.operation is None:
@@ -617,6 +1066,8 @@ def main() -> None:
                 streammastodonurl(config, args.username, args.url)
             elif args.streamer == "chat":
                 streamchatsetting(config, args.username, args.setting)
+            elif args.streamer == "backlog":
+                streambacklog(config, args.username, args.lines)
             else:
                 raise CLIException(f"Unknown streamer operation '{args.streamer}'")
 
@@ -640,6 +1091,34 @@ def main() -> None:
             else:
                 raise CLIException(f"Unknown message operation '{args.message}'")
 
+        elif args.operation == "drawing":
+            if args.drawing is None:
+                raise CLIException("Unuspecified drawing operation!")
+            elif args.drawing == "backfill":
+                backfilldrawings(config, args.batch)
+            else:
+                raise CLIException(f"Unknown drawing operation '{args.drawing}'")
+
+        elif args.operation == "events":
+            if args.events is None:
+                raise CLIException("Unuspecified events operation!")
+            elif args.events == "prune":
+                pruneevents(config, args.days, args.types, args.archive, args.batch, args.dry_run)
+            elif args.events == "compact":
+                compactevents(config, args.days, args.batch, args.dry_run)
+            elif args.events == "export":
+                exportevents(config, args.output, args.days, args.types, args.archived, args.batch, args.dry_run)
+            else:
+                raise CLIException(f"Unknown events operation '{args.events}'")
+
+        elif args.operation == "sessions":
+            if args.sessions is None:
+                raise CLIException("Unuspecified sessions operation!")
+            elif args.sessions == "backfill":
+                backfillsessions(config, args.archived, args.batch)
+            else:
+                raise CLIException(f"Unknown sessions operation '{args.sessions}'")
+
         else:
             raise CLIException(f"Unknown operation '{args.operation}'")
     except CLIException as e:
@@ -0,0 +1,76 @@
+import os
+import socket
+from gevent.socket import wait_read  # type: ignore
+from typing import Any, Dict, List
+
+
+def default_socket_path(config_filename: str) -> str:
+    """
+    Given the filename of the config that a server or the manage script was started with, returns
+    the path of the notification socket that lives next to it.
+    """
+
+    return os.path.join(os.path.dirname(os.path.abspath(config_filename)), ".pystreaming.sock")
+
+
+def poke(config: Dict[str, Any], channel: str) -> None:
+    """
+    Tell a server running on this host that something on the given channel changed. This silently
+    does nothing if no server is listening, since the server will notice the change on its next
+    fallback poll anyway.
+    """
+
+    path = config.get('notify_socket')
+    if not path:
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(channel.encode('utf-8'), path)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+class NotificationListener:
+    """
+    The receiving end of poke(), a UNIX datagram socket that the server waits on cooperatively.
+    """
+
+    def __init__(self, path: str) -> None:
+        # A previous server that didn't shut down cleanly could have left its socket behind.
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        self.__path = path
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.__sock.bind(path)
+        self.__sock.setblocking(False)
+
+    def wait(self, timeout: float) -> List[str]:
+        """
+        Wait up to timeout seconds for any pokes, returning the list of channels that were poked.
+        An empty list means that we timed out without hearing anything.
+        """
+
+        try:
+            wait_read(self.__sock.fileno(), timeout=timeout)
+        except socket.timeout:
+            return []
+
+        channels: List[str] = []
+        while True:
+            try:
+                channels.append(self.__sock.recv(1024).decode('utf-8'))
+            except BlockingIOError:
+                return channels
+
+    def close(self) -> None:
+        self.__sock.close()
+        try:
+            os.unlink(self.__path)
+        except FileNotFoundError:
+            pass
@@ -1,11 +1,21 @@
-from threading import Lock
-from typing import Any, Dict, List, Optional
+import sys
+import uuid
+from collections import deque
+from gevent.lock import RLock  # type: ignore
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
 
 from helpers import now
 
 
+# Identifies the sockets connected to this worker when more than one worker shares presence.
+HOST_ID: str = uuid.uuid4().hex
+
+
 class SocketInfo:
-    def __init__(self, sid: Any, ip: str, streamer: str, username: str, admin: bool, moderator: bool, muted: bool, color: int) -> None:
+    # There's one of these for every socket logged into chat, so don't pay for a dict on each of them.
+    __slots__ = ('sid', 'ip', 'streamer', 'username', 'admin', 'moderator', 'muted', 'color', 'deltas', 'batches', 'host')
+
+    def __init__(self, sid: Any, ip: str, streamer: str, username: str, admin: bool, moderator: bool, muted: bool, color: int, deltas: bool = False, batches: bool = False, host: str = HOST_ID) -> None:
         self.sid = sid
         self.ip = ip
         self.streamer = streamer
@@ -15,6 +25,30 @@ class SocketInfo:
         self.muted = muted
         self.color = color
 
+        # Whether this client understands userlist deltas, or still expects the full list on every change.
+        self.deltas = deltas
+
+        # Whether this client understands batched chat lines.
+        self.batches = batches
+
+        # The worker that this socket is connected to.
+        self.host = host
+
+    def serialize(self) -> Dict[str, Any]:
+        return {
+            'sid': self.sid,
+            'ip': self.ip,
+            'streamer': self.streamer,
+            'username': self.username,
+            'admin': self.admin,
+            'moderator': self.moderator,
+            'muted': self.muted,
+            'color': self.color,
+            'deltas': self.deltas,
+            'batches': self.batches,
+            'host': self.host,
+        }
+
     @property
     def htmlcolor(self) -> str:
         color = hex(self.color)[2:]
@@ -38,23 +72,490 @@ class SocketInfo:
 
 
 class PresenceInfo:
-    def __init__(self, sid: Any, streamer: Optional[str]) -> None:
+    # There's one of these for every connected socket, so don't pay for a dict on each of them.
+    __slots__ = ('sid', 'streamer', 'timestamp', 'host', 'replicated')
+
+    def __init__(self, sid: Any, streamer: Optional[str], timestamp: int, host: str = HOST_ID) -> None:
         self.sid = sid
         self.streamer = streamer
-        self.timestamp = now()
+        self.timestamp = timestamp
+        self.host = host
+
+        # When we last told other workers about this socket.
+        self.replicated = 0
+
+
+class ViewerWindow:
+    """
+    Counts the sockets seen within the last window seconds. Sightings are kept in a ring of one
+    second buckets, so a socket that checks in repeatedly costs one set insert per check in, and
+    expiring old sightings only ever looks at buckets that fell out of the window.
+    """
+
+    def __init__(self, window: int) -> None:
+        self.window = window
+        self.__last_seen: Dict[Any, int] = {}
+        self.__buckets: Deque[Tuple[int, Set[Any]]] = deque()
+
+    def touch(self, sid: Any, timestamp: int) -> None:
+        self.__last_seen[sid] = timestamp
+        if self.__buckets and self.__buckets[-1][0] == timestamp:
+            self.__buckets[-1][1].add(sid)
+        else:
+            self.__buckets.append((timestamp, {sid}))
+
+    def discard(self, sid: Any) -> None:
+        # Any bucket still holding this sid gets skipped when it expires.
+        self.__last_seen.pop(sid, None)
+
+    def expire(self, timestamp: int) -> List[Any]:
+        """
+        Drops every socket not seen since the window before the given timestamp, returning them.
+        """
+
+        expired: List[Any] = []
+        oldest = timestamp - self.window
+        while self.__buckets and self.__buckets[0][0] < oldest:
+            seen, sids = self.__buckets.popleft()
+            for sid in sids:
+                # Only forget sockets whose most recent sighting was in this bucket.
+                if self.__last_seen.get(sid) == seen:
+                    del self.__last_seen[sid]
+                    expired.append(sid)
+        return expired
+
+    def count(self, timestamp: int) -> int:
+        self.expire(timestamp)
+        return len(self.__last_seen)
+
+    def memory(self) -> int:
+        """
+        Returns roughly how many bytes this window takes up, not counting the sids themselves.
+        """
+
+        size = sys.getsizeof(self.__last_seen) + sys.getsizeof(self.__buckets)
+        return size + sum(sys.getsizeof(sids) for _, sids in self.__buckets)
 
 
-presence_lock: Lock = Lock()
+# How long a socket counts as a viewer after it last interacted with a stream.
+PRESENCE_TIMEOUT: int = 30
+
+
+# Replicating a change to other workers can wait on the broker socket while this is held, so this has
+# to be a gevent lock. A thread lock would block the whole hub when another greenlet tried to take it.
+presence_lock = RLock()
 socket_to_info: Dict[Any, SocketInfo] = {}
 socket_to_presence: Dict[Any, PresenceInfo] = {}
 
+# Secondary indexes over the above, kept up to date by the functions below so that per-room lookups
+# never have to walk every socket connected to the server.
+room_to_info: Dict[str, Dict[Any, SocketInfo]] = {}
+room_to_names: Dict[str, Dict[str, SocketInfo]] = {}
+room_to_viewers: Dict[str, ViewerWindow] = {}
+
+# How many users in each room are running clients that don't understand userlist deltas or batched
+# chat lines, so that checking for them doesn't have to walk the room.
+room_to_legacy: Dict[str, int] = {}
+room_to_unbatched: Dict[str, int] = {}
+all_viewers: ViewerWindow = ViewerWindow(PRESENCE_TIMEOUT)
+
+# The sequence number of the last userlist change sent to each room.
+room_to_seq: Dict[str, int] = {}
+
+
+class PresenceLimit:
+    """
+    A ceiling on how many sockets this worker keeps track of. Once it's reached, sockets that haven't
+    been heard from within the presence timeout are forgotten to make room, and if that doesn't make
+    room then new sockets are turned away. With no ceiling configured every socket is let in.
+    """
+
+    def __init__(self) -> None:
+        self.limit = 0
+        self.rejected = 0
+        self.evicted = 0
+
+        # How many of the tracked sockets are connected to this worker, which is what the limit applies to.
+        self.local = 0
+
+    def configure(self, limit: int) -> None:
+        self.limit = max(limit, 0)
+
+
+# Process-wide limit on tracked sockets, configured once the config has been loaded.
+presence_limit = PresenceLimit()
+
+# How often a socket that keeps interacting with the same stream is re-announced to other workers.
+PRESENCE_REPLICATE_INTERVAL: int = 5
+
+# When running more than one worker, this is called with every change that this worker makes to the
+# tables above so that the other workers can apply it with apply_change().
+replicator: Optional[Callable[[Dict[str, Any]], None]] = None
+
+# When we last heard anything from each of the other workers.
+host_to_seen: Dict[str, int] = {}
+
+# Rooms where two workers handed out the same userlist sequence number.
+seq_conflicts: Set[str] = set()
+
+
+def replicate_with(callback: Callable[[Dict[str, Any]], None]) -> None:
+    """
+    Starts telling other workers about every change we make, by way of the given callback.
+    """
+
+    global replicator
+    replicator = callback
+
+
+def _replicate(op: str, **args: Any) -> None:
+    if replicator is not None:
+        replicator({'op': op, 'host': HOST_ID, **args})
+
+
+def add_user(info: SocketInfo) -> None:
+    """
+    Tracks a socket that successfully logged into a streamer's chat.
+    """
+
+    _add_user(info)
+    _replicate('add_user', info=info.serialize())
+
+
+def _add_user(info: SocketInfo) -> None:
+    _remove_user(info.sid)
+    socket_to_info[info.sid] = info
+    room_to_info.setdefault(info.streamer, {})[info.sid] = info
+    room_to_names.setdefault(info.streamer, {})[info.username.lower()] = info
+    if not info.deltas:
+        room_to_legacy[info.streamer] = room_to_legacy.get(info.streamer, 0) + 1
+    if not info.batches:
+        room_to_unbatched[info.streamer] = room_to_unbatched.get(info.streamer, 0) + 1
+
+
+def _uncount(counts: Dict[str, int], streamer: str) -> None:
+    remaining = counts.get(streamer, 0) - 1
+    if remaining > 0:
+        counts[streamer] = remaining
+    else:
+        counts.pop(streamer, None)
+
+
+def remove_user(sid: Any) -> Optional[SocketInfo]:
+    """
+    Stops tracking a socket in chat, returning the info for the socket if it was logged in.
+    """
+
+    info = _remove_user(sid)
+    if info is not None:
+        _replicate('remove_user', sid=sid)
+    return info
+
+
+def _remove_user(sid: Any) -> Optional[SocketInfo]:
+    info = socket_to_info.pop(sid, None)
+    if info is None:
+        return None
+
+    room = room_to_info.get(info.streamer, {})
+    room.pop(sid, None)
+    if not room:
+        room_to_info.pop(info.streamer, None)
+
+    names = room_to_names.get(info.streamer, {})
+    if names.get(info.username.lower()) is info:
+        del names[info.username.lower()]
+    if not names:
+        room_to_names.pop(info.streamer, None)
+
+    if not info.deltas:
+        _uncount(room_to_legacy, info.streamer)
+    if not info.batches:
+        _uncount(room_to_unbatched, info.streamer)
+
+    return info
+
+
+def rename_user(info: SocketInfo, username: str) -> None:
+    """
+    Changes the name of a user in chat.
+    """
+
+    _rename_user(info, username)
+    _replicate('rename_user', sid=info.sid, username=username)
+
+
+def _rename_user(info: SocketInfo, username: str) -> None:
+    names = room_to_names.setdefault(info.streamer, {})
+    if names.get(info.username.lower()) is info:
+        del names[info.username.lower()]
+    info.username = username
+    names[username.lower()] = info
+
+
+def update_user(info: SocketInfo, *, moderator: Optional[bool] = None, muted: Optional[bool] = None, color: Optional[int] = None) -> None:
+    """
+    Changes the moderator status, muted status or color of a user in chat.
+    """
+
+    changes: Dict[str, Any] = {}
+    if moderator is not None:
+        info.moderator = changes['moderator'] = moderator
+    if muted is not None:
+        info.muted = changes['muted'] = muted
+    if color is not None:
+        info.color = changes['color'] = color
+    _replicate('update_user', sid=info.sid, **changes)
+
+
+def find_user(streamer: str, username: str) -> Optional[SocketInfo]:
+    """
+    Looks up a user in a given room by their name, ignoring case.
+    """
+
+    return room_to_names.get(streamer, {}).get(username.lower())
+
+
+def users(streamer: str) -> List[SocketInfo]:
+    """
+    Looks up the info for every user in a given room, in the order they joined.
+    """
+
+    return list(room_to_info.get(streamer, {}).values())
+
+
+def chat_rooms() -> List[str]:
+    """
+    Returns the streamers who have at least one user in their chat.
+    """
+
+    return list(room_to_info.keys())
+
+
+def user_seq(streamer: str) -> int:
+    """
+    Returns the sequence number of the last userlist change in a given room.
+    """
+
+    return room_to_seq.get(streamer, 0)
+
+
+def next_user_seq(streamer: str) -> int:
+    """
+    Allocates the sequence number for a new userlist change in a given room.
+    """
+
+    seq = room_to_seq.get(streamer, 0) + 1
+    room_to_seq[streamer] = seq
+    _replicate('user_seq', streamer=streamer, seq=seq)
+    return seq
+
+
+def legacy_users(streamer: str) -> bool:
+    """
+    Returns whether any user in a given room is running a client that needs the full userlist
+    with every change instead of deltas.
+    """
+
+    return room_to_legacy.get(streamer, 0) > 0
+
+
+def unbatched_users(streamer: str) -> bool:
+    """
+    Returns whether any user in a given room is running a client that can't handle batched chat lines.
+    """
+
+    return room_to_unbatched.get(streamer, 0) > 0
+
 
 def users_in_room(streamer: str) -> List[Dict[str, str]]:
     """
     Looks up all the users in a given room, where a room is dictated by the streamer handle.
     """
 
-    return [{'username': i.username, 'type': i.type, 'color': i.htmlcolor} for i in socket_to_info.values() if i.streamer == streamer]
+    return [{'username': i.username, 'type': i.type, 'color': i.htmlcolor} for i in room_to_info.get(streamer, {}).values()]
+
+
+def set_presence(sid: Any, streamer: Optional[str]) -> None:
+    """
+    Marks a socket as having just interacted with a streamer, or with the server in general if the
+    streamer is None. Must be called with presence_lock held.
+    """
+
+    timestamp = now()
+    old = socket_to_presence.get(sid)
+    presence = _set_presence(sid, streamer, timestamp, HOST_ID)
+    if old is not None and old.streamer == streamer and timestamp - old.replicated < PRESENCE_REPLICATE_INTERVAL:
+        # Other workers only need to hear about this often enough to keep the socket counted.
+        presence.replicated = old.replicated
+    else:
+        presence.replicated = timestamp
+        _replicate('set_presence', sid=sid, streamer=streamer, timestamp=timestamp)
+
+
+def _set_presence(sid: Any, streamer: Optional[str], timestamp: int, host: str) -> PresenceInfo:
+    presence = socket_to_presence.get(sid)
+    if presence is not None and presence.streamer and presence.streamer != streamer:
+        _remove_presence(sid)
+        presence = None
+
+    if presence is None:
+        presence = PresenceInfo(sid, streamer, timestamp, host)
+        socket_to_presence[sid] = presence
+        if host == HOST_ID:
+            presence_limit.local += 1
+    else:
+        # Sockets check in constantly, so reuse the record instead of making a new one each time.
+        if presence.host != host:
+            presence_limit.local += 1 if host == HOST_ID else -1
+        presence.streamer = streamer
+        presence.timestamp = timestamp
+        presence.host = host
+    all_viewers.touch(sid, presence.timestamp)
+    if streamer:
+        if streamer not in room_to_viewers:
+            room_to_viewers[streamer] = ViewerWindow(PRESENCE_TIMEOUT)
+        room_to_viewers[streamer].touch(sid, presence.timestamp)
+    return presence
+
+
+def remove_presence(sid: Any) -> None:
+    """
+    Forgets a socket's presence entirely. Must be called with presence_lock held.
+    """
+
+    if sid in socket_to_presence:
+        _replicate('remove_presence', sid=sid)
+    _remove_presence(sid)
+
+
+def _remove_presence(sid: Any) -> None:
+    presence = socket_to_presence.pop(sid, None)
+    all_viewers.discard(sid)
+    if presence is not None and presence.host == HOST_ID:
+        presence_limit.local -= 1
+    if presence is None or not presence.streamer:
+        return
+
+    window = room_to_viewers.get(presence.streamer)
+    if window is not None:
+        window.discard(sid)
+
+
+def has_presence() -> bool:
+    """
+    Returns whether any socket has interacted with the server recently. Call expire_presence() first
+    to forget about any that haven't. Must be called with presence_lock held.
+    """
+
+    return bool(socket_to_presence)
+
+
+def expire_presence() -> List[Any]:
+    """
+    Forgets every socket that hasn't interacted with the server recently. When a socket limit is
+    configured, returns the ones connected to this worker so that the caller can disconnect them,
+    since they would otherwise stay connected without counting towards the limit. Must be called
+    with presence_lock held.
+    """
+
+    expired = _expire_presence()
+    if not presence_limit.limit:
+        return []
+    presence_limit.evicted += len(expired)
+    return expired
+
+
+def _expire_presence() -> List[Any]:
+    """
+    Forgets every socket that hasn't interacted with us recently, returning the ones that are
+    connected to this worker.
+    """
+
+    expired: List[Any] = []
+    for sid in all_viewers.expire(now()):
+        presence = socket_to_presence.pop(sid, None)
+        if presence is not None and presence.host == HOST_ID:
+            presence_limit.local -= 1
+            expired.append(sid)
+    return expired
+
+
+def admit(sid: Any) -> Tuple[bool, List[Any]]:
+    """
+    Returns whether a newly connected socket can be tracked without going over the configured limit,
+    forgetting idle sockets to make room if needed. Only sockets connected to this worker count
+    towards the limit. Also returns the idle sockets that were forgotten, which the caller should
+    disconnect since we no longer keep track of them. Must be called with presence_lock held.
+    """
+
+    if not presence_limit.limit or sid in socket_to_presence or presence_limit.local < presence_limit.limit:
+        return True, []
+
+    evicted = _expire_presence()
+    presence_limit.evicted += len(evicted)
+    if presence_limit.local < presence_limit.limit:
+        return True, evicted
+
+    presence_limit.rejected += 1
+    return False, evicted
+
+
+def _record_size(record: Any) -> int:
+    size = sys.getsizeof(record)
+    for attr in record.__slots__:
+        value = getattr(record, attr)
+        if attr == 'host' or isinstance(value, bool):
+            # Shared with every other record.
+            continue
+        if isinstance(value, str) or (isinstance(value, int) and not -5 <= value <= 256):
+            size += sys.getsizeof(value)
+    return size
+
+
+def presence_memory() -> Dict[str, Any]:
+    """
+    Returns an estimate of how much memory the tables above take up, both in total and per tracked
+    socket, along with how the configured limit has been doing. This walks every record, so it's
+    meant for the metrics endpoint and not for anything that happens often.
+    """
+
+    with presence_lock:
+        presence = sum(_record_size(p) for p in socket_to_presence.values())
+        presence += sys.getsizeof(socket_to_presence)
+        presence += all_viewers.memory()
+        presence += sum(window.memory() for window in room_to_viewers.values())
+
+    chat = sum(_record_size(i) for i in socket_to_info.values())
+    chat += sys.getsizeof(socket_to_info)
+    chat += sum(sys.getsizeof(room) for room in room_to_info.values())
+    chat += sum(sys.getsizeof(names) for names in room_to_names.values())
+    chat += sys.getsizeof(room_to_legacy) + sys.getsizeof(room_to_unbatched)
+
+    sockets = len(socket_to_presence)
+    return {
+        'sockets': sockets,
+        'local_sockets': presence_limit.local,
+        'chatters': len(socket_to_info),
+        'presence_bytes': presence,
+        'chat_bytes': chat,
+        'bytes': presence + chat,
+        'bytes_per_socket': round((presence + chat) / sockets) if sockets else 0,
+        'limit': presence_limit.limit,
+        'rejected': presence_limit.rejected,
+        'evicted': presence_limit.evicted,
+    }
+
+
+def presence_rooms() -> List[str]:
+    """
+    Returns the streamers who have at least one viewer. Must be called with presence_lock held.
+    """
+
+    timestamp = now()
+    for streamer in [streamer for streamer, window in room_to_viewers.items() if window.count(timestamp) == 0]:
+        del room_to_viewers[streamer]
+    return list(room_to_viewers.keys())
 
 
 def stream_count(streamer: str) -> int:
@@ -63,6 +564,110 @@ def stream_count(streamer: str) -> int:
     stream in any manner (pulling info, chat connection, etc) in the last 30 seconds.
     """
 
-    oldest = now() - 30
     with presence_lock:
-        return len([None for x in socket_to_presence.values() if x.streamer == streamer and x.timestamp >= oldest])
+        window = room_to_viewers.get(streamer)
+        return window.count(now()) if window is not None else 0
+
+
+def announce() -> None:
+    """
+    Tells the other workers about every socket connected to this worker, so that a worker that just
+    started or lost track of things can catch up.
+    """
+
+    for info in list(socket_to_info.values()):
+        if info.host == HOST_ID:
+            _replicate('add_user', info=info.serialize())
+    # Don't hold up everybody else waiting on the lock while we send all of these.
+    with presence_lock:
+        presences = [
+            (presence.sid, presence.streamer, presence.timestamp)
+            for presence in socket_to_presence.values()
+            if presence.host == HOST_ID
+        ]
+    for sid, streamer, timestamp in presences:
+        _replicate('set_presence', sid=sid, streamer=streamer, timestamp=timestamp)
+    for streamer, seq in list(room_to_seq.items()):
+        _replicate('sync_seq', streamer=streamer, seq=seq)
+
+
+def apply_change(change: Dict[str, Any]) -> None:
+    """
+    Applies a change to the tables above that was made by another worker.
+    """
+
+    host = change['host']
+    if host == HOST_ID:
+        # Our own changes come back to us, and we already made them.
+        return
+    host_to_seen[host] = now()
+
+    op = change['op']
+    if op == 'add_user':
+        _add_user(SocketInfo(**change['info']))
+    elif op == 'remove_user':
+        _remove_user(change['sid'])
+    elif op == 'rename_user':
+        info = socket_to_info.get(change['sid'])
+        if info is not None:
+            _rename_user(info, change['username'])
+    elif op == 'update_user':
+        info = socket_to_info.get(change['sid'])
+        if info is not None:
+            for attr in ('moderator', 'muted', 'color'):
+                if attr in change:
+                    setattr(info, attr, change[attr])
+    elif op == 'user_seq':
+        if change['seq'] <= room_to_seq.get(change['streamer'], 0):
+            seq_conflicts.add(change['streamer'])
+        room_to_seq[change['streamer']] = max(change['seq'], room_to_seq.get(change['streamer'], 0))
+    elif op == 'sync_seq':
+        room_to_seq[change['streamer']] = max(change['seq'], room_to_seq.get(change['streamer'], 0))
+    elif op == 'set_presence':
+        with presence_lock:
+            _set_presence(change['sid'], change['streamer'], change['timestamp'], host)
+    elif op == 'remove_presence':
+        with presence_lock:
+            _remove_presence(change['sid'])
+    elif op == 'sync':
+        announce()
+
+
+def request_sync() -> None:
+    """
+    Asks every other worker to announce their sockets to us.
+    """
+
+    _replicate('sync')
+
+
+def send_heartbeat() -> None:
+    """
+    Lets the other workers know that we're still around, even if nothing changed.
+    """
+
+    _replicate('heartbeat')
+
+
+def expire_hosts(timeout: int) -> List[SocketInfo]:
+    """
+    Forgets every socket belonging to a worker that we haven't heard from in the given number of
+    seconds, returning the info for any of them that were logged into chat.
+    """
+
+    oldest = now() - timeout
+    dead = {host for host, seen in host_to_seen.items() if seen < oldest}
+    if not dead:
+        return []
+
+    for host in dead:
+        del host_to_seen[host]
+
+    removed: List[SocketInfo] = []
+    for info in [info for info in socket_to_info.values() if info.host in dead]:
+        _remove_user(info.sid)
+        removed.append(info)
+    with presence_lock:
+        for presence in [presence for presence in socket_to_presence.values() if presence.host in dead]:
+            _remove_presence(presence.sid)
+    return removed
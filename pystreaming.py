@@ -1,9 +1,20 @@
 import argparse
+import gevent  # type: ignore
+import signal
 import yaml
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from broadcast import broadcaster
+from broker import BrokerClient, BrokerManager, default_lock_path, leader_lock
 from data import Data
+from drawings import default_drawings_dir, drawing_store
 from app import app, config, socketio
+from events import event_sink, observe_events, observe_writes
+from helpers import mysql, release_mysql, streamer_settings
+from hls import symlink_registry
+from notify import default_socket_path
+from presence import announce, apply_change, presence_limit, replicate_with, request_sync
+from sessions import session_rollup, session_tracker
 
 
 # Since the sockets and REST files use decorators for hooking, simply importing these hooks the desired functions
@@ -13,8 +24,43 @@ import sockets  # noqa
 
 def load_config(filename: str) -> None:
     config.update(yaml.safe_load(open(filename)))
+    config.setdefault('notify_socket', default_socket_path(filename))
+    config.setdefault('drawings_dir', default_drawings_dir(filename))
     config['database']['engine'] = Data.create_engine(config)
     app.secret_key = config['secret_key']
+    drawing_store.configure(config['drawings_dir'])
+    event_sink.configure(
+        int(config.get('event_batch_size', 100)),
+        float(config.get('event_flush_interval', 1.0)),
+        int(config.get('event_queue_limit', 10000)),
+    )
+    broadcaster.configure(
+        int(config.get('batch_window', 75)),
+        config.get('batch_rooms') or [],
+    )
+    sockets.chat_backlog.configure(
+        int(config.get('chat_backlog', 50)),
+        int(config.get('chat_backlog_budget', 4194304)),
+    )
+    presence_limit.configure(int(config.get('max_sockets', 0)))
+    observe_events(session_tracker.observe)
+    observe_writes(session_rollup.written)
+
+    if config.get('broker_socket'):
+        # We're one of several workers, so relay emits and presence changes through the broker and
+        # only do the server-wide work when we're holding the leader lock.
+        client = BrokerClient(config['broker_socket'])
+        client.subscribe('presence', apply_change)
+        client.subscribe('backlog', sockets.chat_backlog.apply)
+        client.on_connect(request_sync)
+        client.on_connect(announce)
+        replicate_with(lambda change: client.publish('presence', change))
+        sockets.chat_backlog.replicate_with(lambda line: client.publish('backlog', line))
+        leader_lock.configure(config.get('leader_lock') or default_lock_path(filename))
+        socketio.init_app(app, client_manager=BrokerManager(client))
+        client.start()
+    else:
+        socketio.init_app(app)
 
 
 if __name__ == '__main__':
@@ -27,6 +73,32 @@ if __name__ == '__main__':
 
     load_config(args.config)
 
+    # Warm the streamer settings cache so the first requests don't pay for it.
+    streamer_settings().load()
+
+    # Find out whether batched event inserts can trust the IDs MySQL hands back.
+    event_sink.check_ids(mysql())
+    release_mysql()
+
+    # Pick up any symlinks a previous server left behind so they get cleaned up.
+    symlink_registry.reconcile()
+
+    # Deliver messages queued by the manage script as soon as they're poked, and write out events.
+    sockets.start_service_threads()
+
+    # Stop serving cleanly when asked to by systemd or the install script, so the buffered events below
+    # still get written out. Without this, SIGTERM kills us on the spot.
+    def shutdown() -> None:
+        print("Shutting down due to SIGTERM.")
+        socketio.stop()
+
+    gevent.signal_handler(signal.SIGTERM, shutdown)
+
     if args.nginx_proxy > 0:
         app.wsgi_app = ProxyFix(app.wsgi_app, x_host=args.nginx_proxy, x_proto=args.nginx_proxy, x_for=args.nginx_proxy)  # type: ignore
-    socketio.run(app, host='0.0.0.0', port=args.port, debug=args.debug)
+    try:
+        socketio.run(app, host='0.0.0.0', port=args.port, debug=args.debug)
+    finally:
+        # Don't lose any events that were still buffered when we were asked to stop.
+        event_sink.flush(mysql())
+        release_mysql()
@@ -1,4 +1,9 @@
+import bisect
 import datetime
+import functools
+import json
+import os
+import time
 from flask import (
     Response,
     abort,
@@ -6,13 +11,17 @@ from flask import (
     render_template,
     redirect,
     make_response,
+    send_file,
+    stream_with_context,
     url_for,
 )
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Type, Union
 from werkzeug.datastructures import Authorization
 
 from app import app, config, request
-from data import Data
+from broadcast import broadcaster
+from data import pool_metrics
+from drawings import drawing_store
 from events import (
     Event,
     StartStreamingEvent,
@@ -22,29 +31,33 @@ from events import (
     SendBroadcastEvent,
     SendMessageEvent,
     SendActionEvent,
+    event_sink,
     get_events,
-    insert_event,
+    page_events,
+    queue_event,
 )
-from presence import stream_count, users_in_room
+from presence import presence_memory, stream_count, users, users_in_room
 from helpers import (
     PICTOCHAT_IMAGE_WIDTH,
     PICTOCHAT_IMAGE_HEIGHT,
-    clean_symlinks,
+    custom_emotes,
     emotes,
-    fetch_m3u8,
     fetch_ts,
     first_quality,
     get_emoji_unicode_dict,
     get_aliases_unicode_dict,
     mysql,
     now,
-    stream_live,
-    symlink,
+    release_mysql,
+    streamer_settings,
 )
+from hls import playlist_cache, stream_live
+from sessions import session_tracker
+from sockets import chat_backlog, send_pending_message
 
 
 # Allow cache-busting of entire frontend for stream page and chat updates.
-FRONTEND_CACHE_BUST: str = "site.1.2.2"
+FRONTEND_CACHE_BUST: str = "site.1.2.7"
 
 
 @app.context_processor
@@ -54,42 +67,55 @@ def provide_globals() -> Dict[str, Any]:
     }
 
 
+@app.teardown_appcontext
+def release_connection(exception: Optional[BaseException]) -> None:
+    # Every request and socket event gets its own session, make sure it goes back to the pool.
+    release_mysql()
+
+
+@app.route('/metrics')
+def metrics() -> Response:
+    # Only expose internal counters to the local host, similar to the nginx callbacks.
+    if request.remote_addr not in {"127.0.0.1", "::1"}:
+        abort(404)
+
+    return make_response(jsonify({
+        'database': pool_metrics.snapshot(),
+        'events': event_sink.snapshot(),
+        'broadcast': broadcaster.snapshot(),
+        'backlog': chat_backlog.snapshot(),
+        'presence': presence_memory(),
+        'hooks': {hook: histogram.snapshot() for hook, histogram in hook_latency.items()},
+    }))
+
+
 @app.route('/')
 def index() -> str:
-    cursor = mysql().execute(
-        "SELECT `username`, `key`, `description`, `streampass` FROM streamersettings",
-    )
     streamers = [
         {
-            'username': result['username'],
-            'live': stream_live(result['key'], first_quality()), 'count': stream_count(result['username'].lower()),
-            'description': emotes(result['description']) if result['description'] else '',
-            'locked': result['streampass'] is not None,
+            'username': settings.username,
+            'live': stream_live(settings.key, first_quality()), 'count': stream_count(settings.username.lower()),
+            'description': emotes(settings.description) if settings.description else '',
+            'locked': settings.streampass is not None,
         }
-        for result in cursor
+        for settings in streamer_settings().all()
     ]
     return render_template('index.html', streamers=streamers)
 
 
 @app.route('/<streamer>/')
 def stream(streamer: str) -> Response:
-    data = mysql()
-    cursor = data.execute(
-        "SELECT username, streampass, mastodon, chat FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
         abort(404)
 
-    result = cursor.fetchone()
-
-    streampass = result['streampass']
+    streampass = settings.streampass
     if streampass is not None and request.cookies.get('streampass') != streampass:
         # This stream is password protected!
         return make_response(
             render_template(
                 'password.html',
-                streamer=result["username"],
+                streamer=settings.username,
             ),
             403
         )
@@ -107,11 +133,6 @@ def stream(streamer: str) -> Response:
     }
     emojis = {key: emojis[key] for key in emojis if "__" not in key}
 
-    cursor = data.execute(
-        "SELECT alias, uri FROM emotes ORDER BY alias",
-    )
-    emotes = {f":{result['alias']}:": result['uri'] for result in cursor}
-
     # Support themes drop-down and default theme.
     themes = config.get('themes', [])
     if not themes:
@@ -123,12 +144,12 @@ def stream(streamer: str) -> Response:
     return make_response(
         render_template(
             'stream.html',
-            streamer=result["username"],
-            mastodon=result["mastodon"],
-            chat=result["chat"] or "enabled",
+            streamer=settings.username,
+            mastodon=settings.mastodon,
+            chat=settings.chat or "enabled",
             playlists=playlists,
             emojis=emojis,
-            emotes=emotes,
+            emotes=custom_emotes().emotes,
             icons=['admin', 'moderator'],
             themes=themes,
             default=default,
@@ -140,21 +161,16 @@ def stream(streamer: str) -> Response:
 
 @app.route('/<streamer>/password', methods=["POST"])
 def password(streamer: str) -> Response:
-    streamer = streamer.lower()
-    cursor = mysql().execute(
-        "SELECT `username`, `streampass` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
         abort(404)
 
     # Verify the password.
-    result = cursor.fetchone()
-    streampass = result['streampass']
-    if request.form.get('streampass') == streampass:
+    streampass = settings.streampass
+    if streampass is not None and request.form.get('streampass') == streampass:
         expire_date = datetime.datetime.now()
         expire_date = expire_date + datetime.timedelta(days=1)
-        response = make_response(redirect(url_for("stream", streamer=result["username"])))
+        response = make_response(redirect(url_for("stream", streamer=settings.username)))
         response.set_cookie("streampass", streampass, expires=expire_date)
         return response
 
@@ -162,7 +178,7 @@ def password(streamer: str) -> Response:
     return make_response(
         render_template(
             'password.html',
-            streamer=result["username"],
+            streamer=settings.username,
             password_invalid=True,
         ),
         403
@@ -173,30 +189,22 @@ def password(streamer: str) -> Response:
 def streaminfo(streamer: str) -> Response:
     streamer = streamer.lower()
 
-    cursor = mysql().execute(
-        "SELECT `username`, `streampass`, `key`, `description` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
         abort(404)
 
-    # Doesn't cost us much, so let's clean up on the fly.
-    clean_symlinks()
-
-    result = cursor.fetchone()
-
     # First, verify they're even allowed to see this stream.
-    streampass = result['streampass']
+    streampass = settings.streampass
     if streampass is not None and request.cookies.get('streampass') != streampass:
         # This stream is password protected!
         abort(403)
 
     # The stream is either not password protected, or the user has already authenticated.
-    live = stream_live(result['key'], first_quality())
+    live = stream_live(settings.key, first_quality())
     return make_response(jsonify({
         'live': live,
         'count': stream_count(streamer) if live else 0,
-        'description': emotes(result['description']) if result['description'] else '',
+        'description': emotes(settings.description) if settings.description else '',
     }))
 
 
@@ -204,46 +212,23 @@ def streaminfo(streamer: str) -> Response:
 def streamplaylist(streamer: str) -> str:
     streamer = streamer.lower()
 
-    cursor = mysql().execute(
-        "SELECT `username`, `streampass`, `key` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
         abort(404)
 
-    result = cursor.fetchone()
-
     # First ensure they're even allowed to see this stream.
-    streampass = result['streampass']
+    streampass = settings.streampass
     if streampass is not None and request.cookies.get('streampass') != streampass:
         # This stream is password protected!
         abort(403)
 
     # The stream is either not password protected, or the user has already authenticated.
-    key = result['key']
-
-    if not stream_live(key):
-        abort(404)
+    key = settings.key
 
-    m3u8 = fetch_m3u8(key)
+    m3u8 = playlist_cache.fetch(streamer, key)
     if m3u8 is None:
         abort(404)
 
-    lines = m3u8.splitlines()
-    for i in range(len(lines)):
-        if lines[i].startswith(key) and lines[i][-3:] == ".ts":
-            # We need to rewrite this
-            oldname = lines[i]
-            newname = f"{streamer}" + lines[i][len(key):]
-            symlink(oldname, newname)
-            lines[i] = "/hls/" + newname
-        if key in lines[i]:
-            raise Exception("Possible stream key leak!")
-
-    # Doesn't cost us much, so let's clean up on the fly.
-    clean_symlinks()
-
-    m3u8 = "\n".join(lines)
     return m3u8
 
 
@@ -251,46 +236,23 @@ def streamplaylist(streamer: str) -> str:
 def streamplaylistwithquality(streamer: str, quality: str) -> str:
     streamer = streamer.lower()
 
-    cursor = mysql().execute(
-        "SELECT `username`, `streampass`, `key` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
         abort(404)
 
-    result = cursor.fetchone()
-
     # First ensure they're even allowed to see this stream.
-    streampass = result['streampass']
+    streampass = settings.streampass
     if streampass is not None and request.cookies.get('streampass') != streampass:
         # This stream is password protected!
         abort(403)
 
     # The stream is either not password protected, or the user has already authenticated.
-    key = result['key']
-
-    if not stream_live(key, quality):
-        abort(404)
+    key = settings.key
 
-    m3u8 = fetch_m3u8(key, quality)
+    m3u8 = playlist_cache.fetch(streamer, key, quality)
     if m3u8 is None:
         abort(404)
 
-    lines = m3u8.splitlines()
-    for i in range(len(lines)):
-        if lines[i].startswith(key + '_' + quality) and lines[i][-3:] == ".ts":
-            # We need to rewrite this
-            oldname = lines[i]
-            newname = f"{streamer}_{quality}" + lines[i][(len(key) + len(quality) + 1):]
-            symlink(oldname, newname)
-            lines[i] = "/hls/" + newname
-        if key in lines[i]:
-            raise Exception("Possible stream key leak!")
-
-    # Doesn't cost us much, so let's clean up on the fly.
-    clean_symlinks()
-
-    m3u8 = "\n".join(lines)
     return m3u8
 
 
@@ -306,67 +268,129 @@ def streamts(filename: str) -> Response:
     return response
 
 
+@app.route('/drawings/<digest>.png')
+def drawing(digest: str) -> Response:
+    filename = drawing_store.filename(digest)
+    if filename is None or not os.path.isfile(filename):
+        abort(404)
+
+    # A drawing's name is the hash of its contents, so it can never change.
+    response = send_file(filename, mimetype='image/png', max_age=31536000, etag=digest)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+class LatencyHistogram:
+    """
+    Counts how long something took in fixed buckets, so that slow outliers show up in the metrics
+    even when the average looks fine.
+    """
+
+    # The upper bound of each bucket in milliseconds, anything slower lands in a final overflow bucket.
+    BUCKETS: List[float] = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds * 1000.0)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self) -> Dict[str, object]:
+        count = sum(self.counts)
+        buckets = {f"le_{bound:g}ms": self.counts[i] for i, bound in enumerate(self.BUCKETS)}
+        buckets["overflow"] = self.counts[-1]
+        return {
+            'count': count,
+            'avg_ms': round(self.total / count * 1000.0, 2) if count else 0.0,
+            'max_ms': round(self.max * 1000.0, 2),
+            'buckets': buckets,
+        }
+
+
+# How long the nginx publish callbacks take to answer, since the encoder waits on them to connect.
+hook_latency: Dict[str, LatencyHistogram] = {
+    'on_publish': LatencyHistogram(),
+    'on_publish_done': LatencyHistogram(),
+}
+
+
+def measured(hook: str) -> Callable[[Callable[[], Response]], Callable[[], Response]]:
+    def decorator(func: Callable[[], Response]) -> Callable[[], Response]:
+        @functools.wraps(func)
+        def wrapper() -> Response:
+            start = time.monotonic()
+            try:
+                return func()
+            finally:
+                hook_latency[hook].record(time.monotonic() - start)
+
+        return wrapper
+
+    return decorator
+
+
 @app.route('/auth/on_publish', methods=["GET", "POST"])
+@measured('on_publish')
 def publishcheck() -> Response:
     key = request.values.get('name')
     if key is None:
         # We don't have a stream key, deny it.
         abort(404)
 
-    data = mysql()
-    cursor = data.execute(
-        "SELECT `username`, `description`, `streampass` FROM streamersettings WHERE `key` = :key",
-        {"key": key},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_key(key)
+    if settings is None:
         # We didn't find a registered streamer with this key, deny it.
         abort(404)
 
-    # Log that we started streaming.
-    result = cursor.fetchone()
-    insert_event(
-        data,
-        StartStreamingEvent(
-            now(),
-            result["username"].lower(),
-            result["description"],
-            result["streampass"],
-        )
+    # Log that we started streaming, without making the encoder wait on the DB.
+    start = StartStreamingEvent(
+        now(),
+        settings.username.lower(),
+        settings.description,
+        settings.streampass,
     )
+    session_tracker.open(key, start)
+    queue_event(mysql(), start)
 
     # This is fine, allow it
     return make_response("Stream ok!", 200)
 
 
 @app.route('/auth/on_publish_done', methods=["GET", "POST"])
+@measured('on_publish_done')
 def donepublishcheck() -> Response:
     key = request.values.get('name')
     if key is None:
         # We don't have a stream key, can't link to an event.
         return make_response("Stream ok!", 200)
 
-    data = mysql()
-    cursor = data.execute(
-        "SELECT `username` FROM streamersettings WHERE `key` = :key",
-        {"key": key},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_key(key)
+    if settings is None:
         # We didn't find a registered streamer with this key, can't link to an event.
         return make_response("Stream ok!", 200)
 
-    # Log that we stopped streaming.
-    result = cursor.fetchone()
-    insert_event(
+    # Log that we stopped streaming, along with a summary of the stream if we saw it start.
+    data = mysql()
+    timestamp = now()
+    queue_event(
         data,
         StopStreamingEvent(
-            now(),
-            result["username"].lower(),
+            timestamp,
+            settings.username.lower(),
         )
     )
+    session = session_tracker.close(settings.username, timestamp)
+    if session is not None:
+        queue_event(data, session.summary())
     return make_response("Stream ok!", 200)
 
 
-def get_auth(data: Data, auth: Optional[Authorization]) -> Optional[str]:
+def get_auth(auth: Optional[Authorization]) -> Optional[str]:
     if not auth:
         return None
 
@@ -376,38 +400,29 @@ def get_auth(data: Data, auth: Optional[Authorization]) -> Optional[str]:
     if not auth.username or not auth.password:
         return None
 
-    cursor = data.execute(
-        "SELECT `username`, `key` FROM streamersettings WHERE username = :username",
-        {"username": auth.username},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_username(auth.username)
+    if settings is None:
         return None
 
-    result = cursor.fetchone()
-    if auth.password == result["key"]:
+    if auth.password == settings.key:
         return auth.username.lower()
 
     return None
 
 
-def __info(data: Data, streamer: str) -> Response:
-    cursor = data.execute(
-        "SELECT `username`, `key`, `streampass`, `description` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+def __info(streamer: str) -> Response:
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
         # Shouldn't happen due to auth check, but let's be sure.
         abort(404)
 
-    result = cursor.fetchone()
-
     # First, verify they're even allowed to see this stream.
-    streampass = result['streampass'] or None
-    username = result['username']
-    description = result['description'] or ''
+    streampass = settings.streampass or None
+    username = settings.username
+    description = settings.description or ''
 
     # Figure out if the stream itself is live.
-    live = stream_live(result['key'], first_quality())
+    live = stream_live(settings.key, first_quality())
 
     # Grab viewer count, active chatters.
     users = [u["username"] for u in users_in_room(streamer)]
@@ -426,21 +441,24 @@ def __info(data: Data, streamer: str) -> Response:
 
 @app.route('/api/info', methods=["GET"])
 def fetchinfo() -> Response:
-    data = mysql()
-    streamer = get_auth(data, request.authorization)
+    streamer = get_auth(request.authorization)
     if not streamer:
         abort(401)
 
-    return __info(data, streamer)
+    return __info(streamer)
 
 
 @app.route('/api/info', methods=["PATCH"])
 def updateinfo() -> Response:
     data = mysql()
-    streamer = get_auth(data, request.authorization)
+    streamer = get_auth(request.authorization)
     if not streamer:
         abort(401)
 
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
+        abort(404)
+
     content = request.json
     if isinstance(content, dict):
         if 'description' in content:
@@ -449,7 +467,8 @@ def updateinfo() -> Response:
                 "UPDATE streamersettings SET description = :description WHERE username = :username LIMIT 1",
                 {"username": streamer, "description": description},
             )
-            insert_event(
+            settings.description = description
+            queue_event(
                 data,
                 SetDescriptionEvent(
                     now(),
@@ -467,7 +486,8 @@ def updateinfo() -> Response:
                 "UPDATE streamersettings SET streampass = :password WHERE username = :username LIMIT 1",
                 {'username': streamer, 'password': password},
             )
-            insert_event(
+            settings.change_password(password)
+            queue_event(
                 data,
                 SetViewerPasswordEvent(
                     now(),
@@ -476,73 +496,134 @@ def updateinfo() -> Response:
                 )
             )
 
-    return __info(data, streamer)
+    return __info(streamer)
+
+
+# The message types that can be asked for through the API, by the name they're returned with.
+MESSAGE_TYPES: Dict[str, Type[Event]] = {
+    "broadcast": SendBroadcastEvent,
+    "message": SendMessageEvent,
+    "action": SendActionEvent,
+}
+
+
+def __serialize_message(event: Event) -> Dict[str, Union[str, int, None]]:
+    if isinstance(event, SendBroadcastEvent):
+        return {
+            "id": event.id,
+            "type": "broadcast",
+            "timestamp": event.timestamp,
+            "message": event.broadcast,
+        }
+    elif isinstance(event, SendMessageEvent):
+        return {
+            "id": event.id,
+            "type": "message",
+            "timestamp": event.timestamp,
+            "name": event.name,
+            "message": event.message,
+        }
+    elif isinstance(event, SendActionEvent):
+        return {
+            "id": event.id,
+            "type": "action",
+            "timestamp": event.timestamp,
+            "name": event.name,
+            "message": event.action,
+        }
+    else:
+        raise Exception(f"Event type {event.type} is not a message!")
+
+
+def __int_arg(name: str) -> Optional[int]:
+    value = request.args.get(name, '')
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
 
 
 @app.route('/api/messages', methods=["GET"])
 def getmessages() -> Response:
     data = mysql()
-    streamer = get_auth(data, request.authorization)
+    streamer = get_auth(request.authorization)
     if not streamer:
         abort(401)
 
-    # Offer ability to limit to number of messages.
-    limitStr = request.args.get('limit', '')
-    if limitStr:
-        limit = int(limitStr)
-    else:
-        limit = None
+    # Messages come back a page at a time, where the page size can be lowered but never raised.
+    pagesize = int(config.get('api_page_limit', 500))
+    limit = __int_arg('limit')
+    if limit is None or limit > pagesize:
+        limit = pagesize
+    if limit < 0:
+        abort(400)
+    if limit == 0:
+        # Nothing was asked for, so don't bother looking.
+        return make_response(jsonify([]))
+
+    # Offer ability to page forward from or backward from a given message.
+    after = __int_arg('after')
+    before = __int_arg('before')
+
+    # Offer ability to only return some types of messages.
+    typesStr = request.args.get('types', '')
+    types = list(MESSAGE_TYPES.values())
+    if typesStr:
+        try:
+            types = [MESSAGE_TYPES[t.strip().lower()] for t in typesStr.split(",")]
+        except KeyError:
+            abort(400)
 
     # Offer ability to limit to only the last active stream.
     lastStreamOnly = request.args.get('lastStreamOnly', '')
-    startEvent: Optional[Event] = None
+    since: Optional[int] = None
     if lastStreamOnly.lower() == "true":
-        startEvents = get_events(data, streamer=streamer, types=[StartStreamingEvent], limit=1)
-        if startEvents:
-            startEvent = startEvents[0]
-        else:
+        session = session_tracker.get(streamer)
+        if session is not None:
+            # We saw the stream start, so we already know where it begins once it's written out.
+            if session.start_id is None:
+                event_sink.flush(data)
+            since = session.start_id
+        if since is None:
+            startEvents = get_events(data, streamer=streamer, types=[StartStreamingEvent], limit=1)
+            if startEvents:
+                since = startEvents[0].id
+        if since is None:
             # No active stream, so no events to return.
             return make_response(jsonify([]))
 
-    all_events = get_events(
-        data,
-        streamer=streamer,
-        types=[SendBroadcastEvent, SendMessageEvent, SendActionEvent],
-        after=startEvent,
-        limit=limit
-    )
-
-    # Now, serialize these out.
-    output: List[Dict[str, Union[str, int]]] = []
-    for event in all_events:
-        if isinstance(event, SendBroadcastEvent):
-            output.append({
-                "type": "broadcast",
-                "timestamp": event.timestamp,
-                "message": event.broadcast,
-            })
-        elif isinstance(event, SendMessageEvent):
-            output.append({
-                "type": "message",
-                "timestamp": event.timestamp,
-                "name": event.name,
-                "message": event.message,
-            })
-        elif isinstance(event, SendActionEvent):
-            output.append({
-                "type": "action",
-                "timestamp": event.timestamp,
-                "name": event.name,
-                "message": event.action,
-            })
-
-    return make_response(jsonify(output))
+    # A page is small enough to fetch in full, which means a DB error turns into an error response
+    # instead of a truncated one. Only the serializing is streamed.
+    events = list(page_events(data, streamer=streamer, types=types, after=after, before=before, since=since, limit=limit))
+
+    def generate() -> Iterator[str]:
+        yield "["
+        for i, event in enumerate(events):
+            if i:
+                yield ","
+            yield json.dumps(__serialize_message(event))
+        yield "]"
+
+    response = Response(stream_with_context(generate()), mimetype="application/json")
+    if events and len(events) == limit:
+        # There may be more, so tell the caller where the next page in the same direction starts.
+        args: Dict[str, Any] = request.args.to_dict()
+        args.pop('after', None)
+        args.pop('before', None)
+        if after is not None:
+            args['after'] = str(events[-1].id)
+        else:
+            args['before'] = str(events[0].id)
+        response.headers['Link'] = f'<{url_for("getmessages", **args)}>; rel="next"'
+    return response
 
 
 @app.route('/api/messages', methods=["POST"])
 def sendmessage() -> Response:
     data = mysql()
-    streamer = get_auth(data, request.authorization)
+    streamer = get_auth(request.authorization)
     if not streamer:
         abort(401)
 
@@ -563,9 +644,67 @@ def sendmessage() -> Response:
         if messagetype not in {"normal", "action", "server"}:
             abort(400)
 
-        data.execute(
-            "INSERT INTO pendingmessages (`username`, `type`, `message`) VALUES (:username, :type, :message)",
-            {'username': streamer, 'type': messagetype, 'message': message},
-        )
+        if users(streamer):
+            # Somebody is chatting on this server, so there's no need to go through the DB.
+            send_pending_message(data, streamer, messagetype, message)
+        else:
+            data.execute(
+                "INSERT INTO pendingmessages (`username`, `type`, `message`) VALUES (:username, :type, :message)",
+                {'username': streamer, 'type': messagetype, 'message': message},
+            )
 
     return make_response(jsonify({}))
+
+
+def __serialize_session(row: Any) -> Dict[str, Union[int, float, bool, None]]:
+    stopped = row['stopped']
+    if stopped is None:
+        # Still live, so work out the mean up until now.
+        until = max(now(), row['viewers_since'])
+        elapsed = until - row['started']
+        seconds = row['viewer_seconds'] + row['viewers'] * (until - row['viewers_since'])
+        mean = (seconds / elapsed) if elapsed > 0 else float(row['viewers'])
+    else:
+        mean = float(row['mean'] or 0.0)
+
+    return {
+        "id": row['id'],
+        "started": row['started'],
+        "stopped": stopped,
+        "live": stopped is None,
+        "peak": row['peak'],
+        "mean": round(mean, 2),
+        "messages": row['messages'],
+        "actions": row['actions'],
+        "drawings": row['drawings'],
+        "chatters": row['chatters'],
+    }
+
+
+@app.route('/api/sessions', methods=["GET"])
+def getsessions() -> Response:
+    data = mysql()
+    streamer = get_auth(request.authorization)
+    if not streamer:
+        abort(401)
+
+    # Sessions come back newest first a page at a time, just like messages.
+    pagesize = int(config.get('api_page_limit', 500))
+    limit = __int_arg('limit')
+    if limit is None or limit > pagesize:
+        limit = pagesize
+    if limit <= 0:
+        abort(400)
+
+    # Anything we've buffered hasn't been rolled up yet.
+    event_sink.flush(data)
+
+    sql = "SELECT * FROM sessions WHERE username = :streamer"
+    params: Dict[str, object] = {'streamer': streamer, 'limit': limit}
+    before = __int_arg('before')
+    if before is not None:
+        sql += " AND id < :before"
+        params['before'] = before
+
+    cursor = data.execute(sql + " ORDER BY id DESC LIMIT :limit", params)
+    return make_response(jsonify([__serialize_session(row) for row in cursor]))
@@ -0,0 +1,326 @@
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from data import Data
+from events import (
+    Event,
+    SendActionEvent,
+    SendDrawingEvent,
+    SendMessageEvent,
+    StartStreamingEvent,
+    StopStreamingEvent,
+    StreamSummaryEvent,
+    ViewerCountEvent,
+)
+
+
+class LiveSession:
+    """
+    A single stream from the moment nginx tells us it was published to the moment nginx tells us it
+    ended, along with running totals of what happened during it.
+    """
+
+    def __init__(self, key: str, start: StartStreamingEvent) -> None:
+        self.key = key
+        self.start = start
+        self.stopped: Optional[int] = None
+
+        # The qualities whose playlist was being written the last time anybody asked.
+        self.playable: Set[Optional[str]] = set()
+
+        self.viewers = 0
+        self.peak = 0
+        self.__viewer_seconds = 0
+        self.__viewers_since = start.timestamp
+
+        self.messages = 0
+        self.actions = 0
+        self.drawings = 0
+        self.chatters: Set[str] = set()
+
+    @property
+    def streamer(self) -> str:
+        return self.start.streamer
+
+    @property
+    def started(self) -> int:
+        return self.start.timestamp
+
+    @property
+    def live(self) -> bool:
+        return self.stopped is None
+
+    @property
+    def start_id(self) -> Optional[int]:
+        """
+        The ID of the event that started this stream, which is None until the event sink writes it out.
+        """
+
+        return self.start.id
+
+    def record_viewers(self, timestamp: int, viewers: int) -> None:
+        timestamp = max(timestamp, self.__viewers_since)
+        self.__viewer_seconds += self.viewers * (timestamp - self.__viewers_since)
+        self.__viewers_since = timestamp
+        self.viewers = viewers
+        self.peak = max(self.peak, viewers)
+
+    def average(self, timestamp: int) -> float:
+        """
+        Returns the average number of viewers from the start of the stream up until the given time,
+        weighted by how long each viewer count lasted.
+        """
+
+        elapsed = max(timestamp, self.__viewers_since) - self.started
+        if elapsed <= 0:
+            return float(self.viewers)
+        total = self.__viewer_seconds + self.viewers * (max(timestamp, self.__viewers_since) - self.__viewers_since)
+        return total / elapsed
+
+    def close(self, timestamp: int) -> None:
+        self.record_viewers(timestamp, self.viewers)
+        self.stopped = timestamp
+
+    def summary(self) -> StreamSummaryEvent:
+        stopped = self.stopped if self.stopped is not None else self.__viewers_since
+        return StreamSummaryEvent(
+            stopped,
+            self.streamer,
+            start_id=self.start_id,
+            started=self.started,
+            peak=self.peak,
+            average=round(self.average(stopped), 2),
+            messages=self.messages,
+            actions=self.actions,
+            drawings=self.drawings,
+            chatters=len(self.chatters),
+        )
+
+
+class SessionTracker:
+    """
+    The current or most recent stream for every streamer that published to this server since it
+    started. Sessions are opened and closed by the nginx publish callbacks, and every logged event is
+    shown to the tracker so that the running totals stay current without ever going to the DB. When
+    the tracker doesn't know about a streamer, such as right after a restart or on a worker that
+    didn't receive the callback, callers should fall back to looking things up the old way.
+    """
+
+    def __init__(self) -> None:
+        self.__sessions: Dict[str, LiveSession] = {}
+        self.__keys: Dict[str, str] = {}
+
+    def open(self, key: str, start: StartStreamingEvent) -> LiveSession:
+        session = LiveSession(key, start)
+        self.__sessions[session.streamer] = session
+        self.__keys[key] = session.streamer
+        return session
+
+    def close(self, streamer: str, timestamp: int) -> Optional[LiveSession]:
+        """
+        Ends the stream a streamer is currently live with, returning it so that it can be persisted.
+        Returns None if we didn't see the stream start.
+        """
+
+        session = self.__sessions.get(streamer.lower())
+        if session is None or not session.live:
+            return None
+        session.close(timestamp)
+        return session
+
+    def get(self, streamer: str) -> Optional[LiveSession]:
+        return self.__sessions.get(streamer.lower())
+
+    def by_key(self, key: str) -> Optional[LiveSession]:
+        streamer = self.__keys.get(key)
+        if streamer is None:
+            return None
+        session = self.__sessions.get(streamer)
+        if session is None or session.key != key:
+            # The streamer has published with a different key since.
+            return None
+        return session
+
+    def live(self) -> Set[str]:
+        return {streamer for streamer, session in self.__sessions.items() if session.live}
+
+    def observe(self, event: Event) -> None:
+        """
+        Updates the running totals of the live session an event belongs to, if any.
+        """
+
+        session = self.__sessions.get(event.streamer.lower())
+        if session is None or not session.live:
+            return
+
+        if isinstance(event, ViewerCountEvent):
+            session.record_viewers(event.timestamp, event.viewers)
+        elif isinstance(event, SendMessageEvent):
+            session.messages += 1
+            session.chatters.add(event.name)
+        elif isinstance(event, SendActionEvent):
+            session.actions += 1
+            session.chatters.add(event.name)
+        elif isinstance(event, SendDrawingEvent):
+            session.drawings += 1
+            session.chatters.add(event.name)
+
+
+# Process-wide session tracker.
+session_tracker = SessionTracker()
+
+
+class ChatTally:
+    """
+    The chat lines a single batch of events holds for one session.
+    """
+
+    def __init__(self, lines: Iterable[Event]) -> None:
+        self.messages = 0
+        self.actions = 0
+        self.drawings = 0
+        self.chatters: Set[str] = set()
+
+        for line in lines:
+            if isinstance(line, SendMessageEvent):
+                self.messages += 1
+                self.chatters.add(line.name)
+            elif isinstance(line, SendActionEvent):
+                self.actions += 1
+                self.chatters.add(line.name)
+            elif isinstance(line, SendDrawingEvent):
+                self.drawings += 1
+                self.chatters.add(line.name)
+
+
+class SessionRollup:
+    """
+    Keeps the sessions table current by applying every batch of events as it is written. Chat lines
+    are tallied per streamer across a whole batch and applied with a single update, so a busy batch
+    costs a few statements per streamer instead of one per event. Every update is relative to what
+    is already in the table, so it doesn't matter which worker wrote the events. Chat lines count
+    towards the session that was running when they were sent, going by their timestamps, so lines
+    written after the session was closed still count. Lines written by one worker before another
+    worker has written the start of their session are still missed.
+    """
+
+    # The event types that affect a session, as they're stored in the DB.
+    TYPES: List[str] = [
+        StartStreamingEvent.__TYPE__,
+        StopStreamingEvent.__TYPE__,
+        ViewerCountEvent.__TYPE__,
+        SendMessageEvent.__TYPE__,
+        SendActionEvent.__TYPE__,
+        SendDrawingEvent.__TYPE__,
+    ]
+
+    def written(self, data: Data, events: List[Event]) -> None:
+        """
+        Called by the event sink with every batch it writes. The events are already safely in the DB,
+        so a failure here only costs us some accuracy in the rollup.
+        """
+
+        try:
+            self.apply(data, events)
+        except Exception as e:
+            print(f"Failed to update session rollups: {e}")
+
+    def apply(self, data: Data, events: Iterable[Event]) -> None:
+        """
+        Applies events to the sessions table, in the order they happened.
+        """
+
+        lines: Dict[str, List[Event]] = {}
+        for event in events:
+            streamer = event.streamer.lower()
+            if isinstance(event, StartStreamingEvent):
+                self.__start(data, streamer, event)
+            elif isinstance(event, StopStreamingEvent):
+                self.__stop(data, streamer, event.timestamp)
+            elif isinstance(event, ViewerCountEvent):
+                self.__viewers(data, streamer, event.timestamp, event.viewers)
+            elif isinstance(event, (SendMessageEvent, SendActionEvent, SendDrawingEvent)):
+                lines.setdefault(streamer, []).append(event)
+
+        # Sessions are already started and stopped above, so every line can find the one it belongs to.
+        for streamer, chat in lines.items():
+            self.__attribute(data, streamer, chat)
+
+    def __start(self, data: Data, streamer: str, event: StartStreamingEvent) -> None:
+        # If we never heard that the last stream ended, it ended when this one started.
+        self.__stop(data, streamer, event.timestamp)
+        data.execute(
+            "INSERT INTO sessions (username, start_id, started, stopped, viewers, viewers_since, viewer_seconds, "
+            "peak, mean, messages, actions, drawings, chatters) VALUES (:username, :start_id, :ts, NULL, 0, :ts, 0, "
+            "0, NULL, 0, 0, 0, 0)",
+            {'username': streamer, 'start_id': event.id, 'ts': event.timestamp},
+        )
+
+    def __stop(self, data: Data, streamer: str, timestamp: int) -> None:
+        # MySQL applies these in order, so the mean is worked out from the final viewer seconds.
+        data.execute(
+            "UPDATE sessions SET viewer_seconds = viewer_seconds + viewers * GREATEST(:ts - viewers_since, 0), "
+            "viewers_since = GREATEST(:ts, viewers_since), stopped = viewers_since, "
+            "mean = IF(stopped > started, viewer_seconds / (stopped - started), viewers) "
+            "WHERE username = :username AND stopped IS NULL",
+            {'username': streamer, 'ts': timestamp},
+        )
+
+    def __viewers(self, data: Data, streamer: str, timestamp: int, viewers: int) -> None:
+        data.execute(
+            "UPDATE sessions SET viewer_seconds = viewer_seconds + viewers * GREATEST(:ts - viewers_since, 0), "
+            "viewers_since = GREATEST(:ts, viewers_since), viewers = :viewers, peak = GREATEST(peak, :viewers) "
+            "WHERE username = :username AND stopped IS NULL",
+            {'username': streamer, 'ts': timestamp, 'viewers': viewers},
+        )
+
+    def __attribute(self, data: Data, streamer: str, lines: List[Event]) -> None:
+        lines = sorted(lines, key=lambda line: line.timestamp)
+        while lines:
+            # The most recent session that had started by the time the newest remaining line was sent.
+            row = data.execute(
+                "SELECT id, started, stopped FROM sessions WHERE username = :username AND started <= :ts "
+                "ORDER BY id DESC LIMIT 1",
+                {'username': streamer, 'ts': lines[-1].timestamp},
+            ).fetchone()
+            if row is None:
+                # Chatting before anybody ever streamed doesn't count towards anything.
+                return
+
+            first = len(lines)
+            while first > 0 and lines[first - 1].timestamp >= row['started']:
+                first -= 1
+            during = [line for line in lines[first:] if row['stopped'] is None or line.timestamp <= row['stopped']]
+            lines = lines[:first]
+
+            # Chatting while nobody is streaming doesn't count towards anything either.
+            if during:
+                self.__tally(data, row['id'], ChatTally(during))
+
+    def __tally(self, data: Data, session: int, tally: ChatTally) -> None:
+        chatters = 0
+        if tally.chatters:
+            values: List[str] = []
+            params: Dict[str, Any] = {'id': session}
+            for i, name in enumerate(sorted(tally.chatters)):
+                values.append(f"(:id, :name{i})")
+                params[f"name{i}"] = name
+            chatters = data.execute(
+                "INSERT IGNORE INTO session_chatters (session_id, name) VALUES " + ", ".join(values),
+                params,
+            ).rowcount
+
+        data.execute(
+            "UPDATE sessions SET messages = messages + :messages, actions = actions + :actions, "
+            "drawings = drawings + :drawings, chatters = chatters + :chatters WHERE id = :id",
+            {
+                'id': session,
+                'messages': tally.messages,
+                'actions': tally.actions,
+                'drawings': tally.drawings,
+                'chatters': chatters,
+            },
+        )
+
+
+# Process-wide session rollup.
+session_rollup = SessionRollup()
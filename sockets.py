@@ -1,9 +1,13 @@
-import urllib.request
-from flask_socketio import join_room  # type: ignore
-from PIL import Image
-from typing import Any, Dict, List, Optional, Set
+from collections import OrderedDict, deque
+from flask_socketio import join_room, leave_room  # type: ignore
+from json import dumps
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
 
 from app import socketio, config, request
+from broadcast import broadcaster
+from broker import leader_lock
+from data import Data
+from drawings import drawing_store, drawing_url, drawing_validator
 from events import (
     JoinChatEvent,
     ChangeNameEvent,
@@ -19,51 +23,477 @@ from events import (
     UnmuteUserEvent,
     SetDescriptionEvent,
     SetViewerPasswordEvent,
-    insert_event,
+    event_sink,
+    queue_event,
 )
 from helpers import (
-    PICTOCHAT_IMAGE_WIDTH,
-    PICTOCHAT_IMAGE_HEIGHT,
+    custom_emotes,
     emotes,
     first_quality,
     get_color,
     message_length,
     mysql,
     now,
-    stream_live,
+    release_mysql,
+    releases_mysql,
+    streamer_settings,
 )
+from hls import hls_watch_thread_proc, stream_live, symlink_gc_thread_proc
+from notify import NotificationListener
 from presence import (
+    HOST_ID,
     SocketInfo,
-    PresenceInfo,
+    add_user,
+    admit,
+    chat_rooms,
+    expire_hosts,
+    find_user,
+    expire_presence,
+    has_presence,
+    legacy_users,
+    next_user_seq,
     presence_lock,
+    presence_rooms,
+    remove_presence,
+    remove_user,
+    rename_user,
+    send_heartbeat,
+    seq_conflicts,
+    set_presence,
     socket_to_info,
-    socket_to_presence,
     stream_count,
+    user_seq,
+    update_user,
+    users,
     users_in_room,
 )
+from sessions import session_tracker
 
 
 background_thread: Optional[object] = None
+notification_thread: Optional[object] = None
+event_flush_thread: Optional[object] = None
+symlink_gc_thread: Optional[object] = None
+hls_watch_thread: Optional[object] = None
+cluster_thread: Optional[object] = None
+settings_refresh_thread: Optional[object] = None
+
+
+class ChatBacklog:
+    """
+    The last few chat lines sent to each room, so that somebody joining chat sees what was just said
+    without anybody going to the DB. Each room keeps as many lines as its streamer's backlog setting
+    allows, and the backlog as a whole stays under a byte budget by forgetting whole rooms, starting
+    with the room that has gone the longest without anything being said or anybody joining.
+    """
+
+    def __init__(self) -> None:
+        self.size = 50
+        self.budget = 4 * 1024 * 1024
+        self.__rooms: "OrderedDict[str, Deque[Tuple[str, Dict[str, Any], int]]]" = OrderedDict()
+        self.__bytes: Dict[str, int] = {}
+        self.__replicator: Optional[Callable[[Dict[str, Any]], None]] = None
+        self.total = 0
+        self.evictions = 0
+
+    def configure(self, size: int, budget: int) -> None:
+        self.size = size
+        self.budget = budget
+
+    def replicate_with(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        """
+        Starts telling other workers about every line we record, by way of the given callback.
+        """
+
+        self.__replicator = callback
+
+    def limit(self, room: str) -> int:
+        settings = streamer_settings().by_username(room)
+        if settings is not None and settings.backlog is not None:
+            return settings.backlog
+        return self.size
+
+    def record(self, room: str, event: str, payload: Dict[str, Any]) -> None:
+        self.__record(room, event, payload)
+        if self.__replicator is not None:
+            self.__replicator({'host': HOST_ID, 'room': room, 'event': event, 'data': payload})
+
+    def apply(self, change: Dict[str, Any]) -> None:
+        """
+        Records a line that another worker sent to one of its rooms.
+        """
+
+        if change['host'] != HOST_ID:
+            self.__record(change['room'], change['event'], change['data'])
+
+    def __record(self, room: str, event: str, payload: Dict[str, Any]) -> None:
+        limit = self.limit(room)
+        if limit <= 0:
+            self.forget(room)
+            return
+
+        if room not in self.__rooms:
+            self.__rooms[room] = deque()
+            self.__bytes[room] = 0
+        self.__rooms.move_to_end(room)
+
+        # What the line costs to send is a good enough estimate of what it costs to keep.
+        cost = len(dumps(payload))
+        lines = self.__rooms[room]
+        lines.append((event, payload, cost))
+        self.__bytes[room] += cost
+        self.total += cost
+        while len(lines) > limit:
+            self.__drop_oldest(room)
+
+        while self.total > self.budget:
+            oldest = next(iter(self.__rooms))
+            if oldest != room:
+                self.forget(oldest)
+                self.evictions += 1
+            elif len(lines) > 1:
+                # Nothing else left to forget, so this room has to make do with fewer lines.
+                self.__drop_oldest(room)
+            else:
+                break
+
+    def __drop_oldest(self, room: str) -> None:
+        _, _, cost = self.__rooms[room].popleft()
+        self.__bytes[room] -= cost
+        self.total -= cost
+
+    def forget(self, room: str) -> None:
+        if room in self.__rooms:
+            del self.__rooms[room]
+            self.total -= self.__bytes.pop(room)
+
+    def replay(self, room: str) -> List[Dict[str, Any]]:
+        """
+        Returns the lines recently sent to a room, oldest first, in the same format as a batch.
+        """
+
+        lines = self.__rooms.get(room)
+        if not lines:
+            return []
+        self.__rooms.move_to_end(room)
+
+        limit = self.limit(room)
+        if limit <= 0:
+            return []
+        return [{'event': event, 'data': payload} for event, payload, _ in list(lines)[-limit:]]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'rooms': len(self.__rooms),
+            'lines': sum(len(lines) for lines in self.__rooms.values()),
+            'bytes': self.total,
+            'budget': self.budget,
+            'evictions': self.evictions,
+        }
+
+
+# Process-wide chat backlog, configured once the config has been loaded.
+chat_backlog = ChatBacklog()
+
+
+def send_chat_line(event: str, payload: Dict[str, Any], room: str) -> None:
+    """
+    Sends a line of chat to everyone in a streamer's chat, remembering it for anybody that joins later.
+    """
+
+    chat_backlog.record(room, event, payload)
+    broadcaster.emit(event, payload, room=room)
+
+
+def send_pending_message(data: Data, username: str, msgtype: str, message: str) -> None:
+    """
+    Given a streamer's username, a message type and a message, send that message to the streamer's
+    chat on their behalf. This is how messages sent through the API or the manage script get delivered.
+    """
+
+    streamer = username.lower()
+
+    # If they're actually chatting, use the name they're currently set to. Otherwise
+    # default to their stream username. Also, default to their currently set color or
+    # use black as the default.
+    actual_name = username
+    actual_color = '#000000'
+    for info in users(streamer):
+        if info.admin:
+            actual_name = info.username
+            actual_color = info.htmlcolor
+            break
+
+    if msgtype == "server":
+        queue_event(
+            data,
+            SendBroadcastEvent(
+                now(),
+                streamer,
+                message,
+            )
+        )
+
+        send_chat_line(
+            'server',
+            {'msg': message},
+            room=streamer,
+        )
+    elif msgtype == "action":
+        rendered = emotes(message)
+        queue_event(
+            data,
+            SendActionEvent(
+                now(),
+                streamer,
+                actual_name,
+                rendered,
+            )
+        )
+
+        send_chat_line(
+            'action received',
+            {
+                'username': actual_name,
+                'type': 'admin',
+                'color': actual_color,
+                'message': rendered,
+            },
+            room=streamer,
+        )
+    elif msgtype == "normal":
+        rendered = emotes(message)
+        queue_event(
+            data,
+            SendMessageEvent(
+                now(),
+                streamer,
+                actual_name,
+                rendered,
+            )
+        )
+
+        send_chat_line(
+            'message received',
+            {
+                'username': actual_name,
+                'type': 'admin',
+                'color': actual_color,
+                'message': rendered,
+            },
+            room=streamer,
+        )
+
+
+def deliver_pending_messages(data: Data) -> None:
+    """
+    Send any messages queued up in the DB for streamers who have somebody in their chat, and then
+    remove the delivered messages in one go.
+    """
+
+    streamers = set(chat_rooms())
+    if not streamers:
+        # Nobody is chatting, so there's nobody to deliver to.
+        return
+
+    delivered: List[int] = []
+    cursor = data.execute("SELECT id, username, type, message FROM pendingmessages")
+    for result in cursor.fetchall():
+        if result['username'].lower() not in streamers:
+            continue
+
+        send_pending_message(data, result['username'], result['type'], result['message'])
+        delivered.append(result['id'])
+
+    if delivered:
+        data.execute("DELETE FROM pendingmessages WHERE id IN :ids", {'ids': delivered})
+
+
+def notification_thread_proc() -> None:
+    """
+    The background thread that delivers pending messages and reloads streamer settings as soon as the
+    manage script or another process pokes us, falling back to a slow poll of the DB in case a poke is
+    missed.
+    """
+
+    path = config.get('notify_socket')
+    listener = NotificationListener(path) if path else None
+    interval = float(config.get('pending_poll_interval', 10))
+
+    try:
+        while True:
+            if listener is not None:
+                channels = listener.wait(interval)
+            else:
+                socketio.sleep(interval)
+                channels = []
+
+            # An empty list of channels means that we timed out, so check anyway.
+            if not channels or "pending" in channels:
+                deliver_pending_messages(mysql())
+                release_mysql()
+            if "streamers" in channels:
+                streamer_settings().reload_soon()
+    finally:
+        if listener is not None:
+            listener.close()
+
+
+def event_flush_thread_proc() -> None:
+    """
+    The background thread that writes buffered events out to the DB in batches.
+    """
+
+    while True:
+        event_sink.wait()
+        if event_sink.due():
+            event_sink.flush(mysql())
+            release_mysql()
+
+
+def settings_refresh_thread_proc() -> None:
+    """
+    The background thread that keeps the streamer settings cache in step with the DB, so that looking
+    up a streamer never has to wait on it.
+    """
+
+    settings = streamer_settings()
+    while True:
+        settings.wait()
+        try:
+            settings.refresh()
+        except Exception as e:
+            # Keep serving what we have, we'll try again next time around.
+            print(f"Failed to refresh streamer settings: {e}")
+        release_mysql()
+
+
+def start_service_threads() -> None:
+    """
+    Start the threads that run for the lifetime of the server, regardless of whether anybody is
+    connected: listening for pokes from other processes on this host, writing out events, watching
+    for streams going live or offline, cleaning up after old stream segments and keeping the streamer
+    settings cache current.
+    """
+
+    global notification_thread
+    global event_flush_thread
+    global symlink_gc_thread
+    global hls_watch_thread
+    global cluster_thread
+    global settings_refresh_thread
+    if notification_thread is None and leader_lock.try_acquire():
+        notification_thread = socketio.start_background_task(notification_thread_proc)
+    if event_flush_thread is None:
+        event_flush_thread = socketio.start_background_task(event_flush_thread_proc)
+    if symlink_gc_thread is None:
+        symlink_gc_thread = socketio.start_background_task(symlink_gc_thread_proc)
+    if hls_watch_thread is None:
+        hls_watch_thread = socketio.start_background_task(hls_watch_thread_proc)
+    if settings_refresh_thread is None:
+        settings_refresh_thread = socketio.start_background_task(settings_refresh_thread_proc)
+    if cluster_thread is None and config.get('broker_socket'):
+        cluster_thread = socketio.start_background_task(cluster_thread_proc)
+
+
+def cluster_thread_proc() -> None:
+    """
+    The background thread that keeps this worker in step with the others when running more than one.
+    Whichever worker holds the leader lock runs the server-wide loops, and everybody else keeps their
+    emote registry current on their own since the leader only tells clients about emote changes.
+    """
+
+    global notification_thread
+    global background_thread
+    interval = float(config.get('cluster_heartbeat', 5))
+    timeout = int(config.get('cluster_timeout', 15))
+
+    while True:
+        send_heartbeat()
+
+        # Anybody chatting through a worker that went away is gone too.
+        for info in expire_hosts(timeout):
+            if leader_lock.leader:
+                emit_user_change('disconnected', info.streamer, {'username': info.username, 'type': info.type, 'color': info.htmlcolor})
+
+        # Every worker enforces its own socket limit, whether or not it runs the polling thread.
+        disconnect_idle_sockets()
+
+        if leader_lock.try_acquire():
+            if notification_thread is None:
+                print("Taking over as leader worker.")
+                notification_thread = socketio.start_background_task(notification_thread_proc)
+
+            # Two workers changed the same userlist at once, so give everybody a fresh copy.
+            while seq_conflicts:
+                streamer = seq_conflicts.pop()
+                socketio.emit('users', {'users': users_in_room(streamer), 'seq': next_user_seq(streamer)}, room=streamer)
+
+            with presence_lock:
+                if background_thread is None and has_presence():
+                    print("Starting polling thread due to client sockets on other workers.")
+                    background_thread = socketio.start_background_task(background_thread_proc)
+        else:
+            seq_conflicts.clear()
+            custom_emotes().refresh(mysql())
+            release_mysql()
+
+        socketio.sleep(interval)
+
+
+# The stream each socket is getting status updates for.
+status_subscriptions: Dict[Any, str] = {}
+
+
+def status_room(streamer: str) -> str:
+    """
+    Returns the room that everyone watching a stream is in, whether or not they joined chat.
+    """
+
+    return f"status:{streamer}"
+
+
+def stream_status(streamer: str) -> Optional[Dict[str, Any]]:
+    """
+    Looks up everything a viewer needs to know about a stream, in the same format as the info
+    endpoint. Instead of the password, a count of password changes is included so that viewers
+    can tell when they need to check whether they still have access.
+    """
+
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
+        return None
+
+    # Figure out if the stream itself is live.
+    live = stream_live(settings.key, first_quality())
+    return {
+        'live': live,
+        'count': stream_count(streamer) if live else 0,
+        'description': emotes(settings.description) if settings.description else '',
+        'locked': settings.streampass is not None,
+        'passwordchanges': settings.password_changes,
+    }
 
 
 def background_thread_proc() -> None:
     """
-    The background polling thread that manages asynchronous messages from the database.
+    The background polling thread that manages viewer counts, stream status and emote changes.
     """
 
-    # Grab the initial list of emoji that are supported so that we can delta it occasionally and
-    # inform clients of emoji changes on the server. Technically there could be a race where we
-    # add an emote right after somebody loads the page but before the JS connects to us, but the
-    # likelihood of that is small, so we will live with the bug.
-    cursor = mysql().execute(
-        "SELECT alias, uri FROM emotes",
-    )
-    validemotes = {f":{result['alias']}:": result['uri'] for result in cursor}
-    last_update = now()
+    # Make sure the emote registry is current, since nobody was around to keep it up to date while
+    # the server was idle. Anybody who loaded the page with a stale list gets the delta below.
+    # Technically there could be a race where we add an emote right after somebody loads the page
+    # but before the JS connects to us, but the likelihood of that is small, so we will live with the bug.
+    last_update = 0
 
     # Track our known streamer viewcounts.
     viewcounts: Dict[str, int] = {}
 
+    # Track the last status we pushed to each stream's viewers, and when.
+    statuses: Dict[str, Dict[str, Any]] = {}
+    status_sent: Dict[str, int] = {}
+    heartbeat = int(config.get('status_heartbeat', 30))
+
     while True:
         # Just yield to the async system.
         socketio.sleep(1.0)
@@ -71,110 +501,30 @@ def background_thread_proc() -> None:
         # Our connection for this loop.
         data = mysql()
 
-        # Look up any pending messages that need to be sent.
-        streamers = set(s.streamer for s in socket_to_info.values() if s.streamer)
-        usernames = {s.streamer: s.username for s in socket_to_info.values() if s.admin}
-        colors = {s.streamer: s.htmlcolor for s in socket_to_info.values() if s.admin}
-
-        cursor = data.execute("SELECT id, username, type, message FROM pendingmessages")
-        for result in cursor:
-            delid = result['id']
-            username = result['username']
-            streamer = username.lower()
-            msgtype = result['type']
-            message = result['message']
-
-            if streamer not in streamers:
-                continue
-
-            # If they're actually chatting, use the name they're currently set to. Otherwise
-            # default to their stream username. Also, default to their currently set color or
-            # use black as the default.
-            actual_name = usernames.get(streamer, username)
-            actual_color = colors.get(streamer, '#000000')
-
-            if msgtype == "server":
-                insert_event(
-                    data,
-                    SendBroadcastEvent(
-                        now(),
-                        streamer,
-                        message,
-                    )
-                )
-
-                socketio.emit(
-                    'server',
-                    {'msg': message},
-                    room=streamer,
-                )
-            elif msgtype == "action":
-                insert_event(
-                    data,
-                    SendActionEvent(
-                        now(),
-                        streamer,
-                        actual_name,
-                        emotes(message),
-                    )
-                )
-
-                socketio.emit(
-                    'action received',
-                    {
-                        'username': actual_name,
-                        'type': 'admin',
-                        'color': actual_color,
-                        'message': emotes(message),
-                    },
-                    room=streamer,
-                )
-            elif msgtype == "normal":
-                insert_event(
-                    data,
-                    SendMessageEvent(
-                        now(),
-                        streamer,
-                        actual_name,
-                        emotes(message),
-                    )
-                )
-
-                socketio.emit(
-                    'message received',
-                    {
-                        'username': actual_name,
-                        'type': 'admin',
-                        'color': actual_color,
-                        'message': emotes(message),
-                    },
-                    room=streamer,
-                )
-
-            data.execute("DELETE FROM pendingmessages WHERE id = :id LIMIT 1", {'id': delid})
+        streamers = set(chat_rooms())
 
         # Figure out if we need to log an analytics event (viewer count changed).
         alltracked = set(streamers)
         alltracked.update(viewcounts.keys())
-        alltracked.update(p.streamer for p in socket_to_presence.values() if p.streamer)
+        alltracked.update(session_tracker.live())
+        with presence_lock:
+            alltracked.update(presence_rooms())
         for streamer in alltracked:
-            cursor = data.execute(
-                "SELECT `key` FROM streamersettings WHERE username = :username",
-                {"username": streamer},
-            )
-            if cursor.rowcount == 1:
-                result = cursor.fetchone()
-
-                # Figure out if the stream itself is live.
-                live = stream_live(result['key'], first_quality())
+            status = stream_status(streamer)
+            if status is not None:
+                # Let viewers know if anything changed, or every so often regardless.
+                if statuses.get(streamer) != status or (now() - status_sent.get(streamer, 0)) >= heartbeat:
+                    socketio.emit('stream status', status, room=status_room(streamer))
+                    statuses[streamer] = status
+                    status_sent[streamer] = now()
 
                 # Grab viewer count, active chatters.
-                viewers = stream_count(streamer) if live else 0
+                viewers = status['count']
                 oldviewers = viewcounts.get(streamer, -1)
 
                 if viewers != oldviewers:
                     viewcounts[streamer] = viewers
-                    insert_event(
+                    queue_event(
                         data,
                         ViewerCountEvent(
                             now(),
@@ -185,53 +535,37 @@ def background_thread_proc() -> None:
 
         if now() - last_update >= 5:
             # Delta our emojis and send the deltas to clients.
-            cursor = data.execute(
-                "SELECT alias, uri FROM emotes",
-            )
-
-            updated: Set[str] = set()
-            for result in cursor:
-                key = f":{result['alias']}:"
-                uri = result['uri']
+            added, removed = custom_emotes().refresh(data)
 
-                if key not in validemotes:
-                    # This was an addition.
-                    print(f"Broadcasting new emote {key} to all connected clients.")
-                    validemotes[key] = uri
-
-                    # Emit to all clients, so don't provide a room.
-                    socketio.emit(
-                        'add emote',
-                        {'key': key, 'uri': uri},
-                    )
+            for key, uri in added.items():
+                # This was an addition.
+                print(f"Broadcasting new emote {key} to all connected clients.")
 
-                updated.add(key)
+                # Emit to all clients, so don't provide a room.
+                socketio.emit(
+                    'add emote',
+                    {'key': key, 'uri': uri},
+                )
 
-            for existing in list(validemotes.keys()):
-                if existing not in updated:
-                    # This was a deletion.
-                    print(f"Broadcasting deleted emote {existing} to all connected clients.")
-                    del validemotes[existing]
+            for key in removed:
+                # This was a deletion.
+                print(f"Broadcasting deleted emote {key} to all connected clients.")
 
-                    # Emit to all clients, so don't provide a room.
-                    socketio.emit(
-                        'remove emote',
-                        {'key': existing},
-                    )
+                # Emit to all clients, so don't provide a room.
+                socketio.emit(
+                    'remove emote',
+                    {'key': key},
+                )
 
             last_update = now()
 
-        with presence_lock:
-            # Clean up orphaned watchers.
-            sids = list(socket_to_presence.keys())
-            oldest = now() - 30
-
-            for sid in sids:
-                if socket_to_presence[sid].timestamp < oldest:
-                    del socket_to_presence[sid]
+        # Hand our connection back to the pool while we sleep.
+        release_mysql()
 
+        disconnect_idle_sockets()
+        with presence_lock:
             # If there's nobody left watching, shut ourselves down to save on DB accesses.
-            if not socket_to_presence:
+            if not has_presence():
                 print("Shutting down polling thread due to no more client sockets.")
 
                 global background_thread
@@ -247,40 +581,77 @@ def update_presence(sid: Any, streamer: Optional[str]) -> None:
     """
 
     with presence_lock:
-        socket_to_presence[sid] = PresenceInfo(sid, streamer)
+        set_presence(sid, streamer)
 
         global background_thread
-        if background_thread is None:
+        if background_thread is None and leader_lock.leader:
             print("Starting polling thread due to first client socket connection.")
             background_thread = socketio.start_background_task(background_thread_proc)
 
 
+def disconnect_idle_sockets() -> None:
+    """
+    Forgets sockets that haven't interacted with the server recently, disconnecting the ones
+    connected to us when there's a socket limit to enforce.
+    """
+
+    with presence_lock:
+        expired = expire_presence()
+
+    # Disconnecting runs the disconnect handler, which cleans up their chat info as well.
+    for sid in expired:
+        socketio.server.disconnect(sid, namespace='/')
+
+
 def delete_presence(sid: Any) -> None:
     """
     Given a stream SID, delete the presence info for the purpose of counting connected SIDs.
     """
 
     with presence_lock:
-        if request.sid in socket_to_presence:
-            del socket_to_presence[request.sid]
+        remove_presence(sid)
+
+
+def emit_user_change(event: str, streamer: str, change: Dict[str, Any], seq: Optional[int] = None) -> None:
+    """
+    Tell everyone in a room that somebody joined, left, was renamed or was recolored. Clients apply
+    the change to their own copy of the userlist and ask for a resync if they notice they missed one.
+    Clients from before deltas existed still get the whole list as long as any are in the room.
+    """
+
+    change['seq'] = seq if seq is not None else next_user_seq(streamer)
+    if legacy_users(streamer):
+        change['users'] = users_in_room(streamer)
+    broadcaster.emit(event, change, room=streamer)
 
 
 @socketio.on('connect')  # type: ignore
-def connect() -> None:
-    if request.sid in socket_to_info:
-        del socket_to_info[request.sid]
+@releases_mysql
+def connect() -> bool:
+    remove_user(request.sid)
+
+    with presence_lock:
+        admitted, evicted = admit(request.sid)
+
+    # Sockets we forgot to make room would otherwise hang around without being tracked.
+    for sid in evicted:
+        socketio.server.disconnect(sid, namespace='/')
+
+    if not admitted:
+        # We're tracking as many sockets as we're allowed to, so turn this one away.
+        return False
 
     # Make sure we track this client so we don't get a premature hang-up.
     update_presence(request.sid, None)
+    return True
 
 
 @socketio.on('disconnect')  # type: ignore
+@releases_mysql
 def disconnect() -> None:
-    if request.sid in socket_to_info:
-        info = socket_to_info[request.sid]
-        del socket_to_info[request.sid]
-
-        insert_event(
+    info = remove_user(request.sid)
+    if info is not None:
+        queue_event(
             mysql(),
             LeaveChatEvent(
                 now(),
@@ -289,13 +660,15 @@ def disconnect() -> None:
             )
         )
 
-        socketio.emit('disconnected', {'username': info.username, 'type': info.type, 'color': info.htmlcolor, 'users': users_in_room(info.streamer)}, room=info.streamer)
+        emit_user_change('disconnected', info.streamer, {'username': info.username, 'type': info.type, 'color': info.htmlcolor})
 
     # Explicitly kill the presence since we know they're gone.
     delete_presence(request.sid)
+    status_subscriptions.pop(request.sid, None)
 
 
 @socketio.on('presence')  # type: ignore
+@releases_mysql
 def handle_presence(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
     if 'streamer' not in json:
         return
@@ -304,8 +677,25 @@ def handle_presence(json: Dict[str, Any], methods: List[str] = ['GET', 'POST'])
     streamer = json['streamer'].lower()
     update_presence(request.sid, streamer)
 
+    settings = streamer_settings().by_username(streamer)
+    if settings is not None and settings.streampass is not None and request.cookies.get('streampass') != settings.streampass:
+        # They haven't been let into this stream, so they don't get to hear about it.
+        return
+
+    if status_subscriptions.get(request.sid) != streamer:
+        # Subscribe them to status changes for this stream, and catch them up right away.
+        if request.sid in status_subscriptions:
+            leave_room(status_room(status_subscriptions[request.sid]))
+        join_room(status_room(streamer))
+        status_subscriptions[request.sid] = streamer
+
+        status = stream_status(streamer)
+        if status is not None:
+            socketio.emit('stream status', status, room=request.sid)
+
 
 @socketio.on('login')  # type: ignore
+@releases_mysql
 def handle_login(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
     if request.sid in socket_to_info:
         socketio.emit('error', {'msg': 'SID already taken?'}, room=request.sid)
@@ -324,19 +714,17 @@ def handle_login(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) ->
         return
 
     data = mysql()
-    if message_length(data, json['username']) > 20:
+    if message_length(json['username']) > 20:
         socketio.emit('error', {'msg': 'Username cannot be that long'}, room=request.sid)
         return
 
     streamer = json['streamer'].lower()
     username = json['username']
 
-    first_to_join = True
-    for user in users_in_room(streamer):
-        first_to_join = False
-        if user['username'].lower() == username.lower():
-            socketio.emit('error', {'msg': 'Username is already taken'}, room=request.sid)
-            return
+    first_to_join = not users(streamer)
+    if find_user(streamer, username) is not None:
+        socketio.emit('error', {'msg': 'Username is already taken'}, room=request.sid)
+        return
 
     color = get_color(json['color'].strip().lower()) or 0
     key = json.get('key', None)
@@ -344,37 +732,28 @@ def handle_login(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) ->
     # Update user presence information
     update_presence(request.sid, streamer)
 
-    cursor = data.execute(
-        "SELECT `username`, `key` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    settings = streamer_settings().by_username(streamer)
+    if settings is None:
         socketio.emit('error', {'msg': 'Streamer does not exist'}, room=request.sid)
         return
 
     admin = False
     if username.lower() == streamer:
-        result = cursor.fetchone()
-
         if key is None:
-            socketio.emit('login key required', {'username': result['username']}, room=request.sid)
+            socketio.emit('login key required', {'username': settings.username}, room=request.sid)
             return
 
-        if key != result["key"]:
+        if key != settings.key:
             socketio.emit('error', {'msg': 'Invalid password!'}, room=request.sid)
             return
 
-        username = result['username']
+        username = settings.username
         admin = True
 
-    for _, existing in socket_to_info.items():
-        if existing.streamer != streamer:
-            # Not the right room
-            continue
-
-        if existing.username.lower() == json['username'].lower():
-            socketio.emit('error', {'msg': 'Username is taken'}, room=request.sid)
-            return
+    # Somebody could have taken the name while we were checking the key.
+    if find_user(streamer, json['username']) is not None:
+        socketio.emit('error', {'msg': 'Username is taken'}, room=request.sid)
+        return
 
     # If we have any pending API-queued messages for this streamer and this is the first chatter to
     # join, blow all those pending messages away. This is so that the first person to join a room
@@ -382,12 +761,17 @@ def handle_login(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) ->
     if first_to_join:
         data.execute("DELETE FROM pendingmessages WHERE username = :streamer", {'streamer': streamer})
 
-    socket_to_info[request.sid] = SocketInfo(request.sid, str(request.remote_addr), streamer, json['username'], admin, False, False, color)
+    add_user(SocketInfo(request.sid, str(request.remote_addr), streamer, json['username'], admin, False, False, color, bool(json.get('deltas', False)), bool(json.get('batches', False))))
     join_room(streamer)
-    socketio.emit('login success', {'username': json['username']}, room=request.sid)
-    socketio.emit('connected', {'username': json['username'], 'type': socket_to_info[request.sid].type, 'color': socket_to_info[request.sid].htmlcolor, 'users': users_in_room(streamer)}, room=streamer)
 
-    insert_event(
+    # Clients that understand deltas get the userlist once here, including themselves since the
+    # snapshot's sequence number covers the join that follows. Everybody gets whatever was said
+    # recently along with it, so they aren't joining a chat that looks empty.
+    seq = next_user_seq(streamer)
+    socketio.emit('login success', {'username': json['username'], 'users': users_in_room(streamer), 'seq': seq, 'backlog': chat_backlog.replay(streamer)}, room=request.sid)
+    emit_user_change('connected', streamer, {'username': json['username'], 'type': socket_to_info[request.sid].type, 'color': socket_to_info[request.sid].htmlcolor}, seq)
+
+    queue_event(
         data,
         JoinChatEvent(
             now(),
@@ -400,7 +784,19 @@ def handle_login(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) ->
         socketio.emit('server', {'msg': 'You have admin rights.'}, room=request.sid)
 
 
+@socketio.on('resync')  # type: ignore
+@releases_mysql
+def handle_resync(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
+    if request.sid not in socket_to_info:
+        socketio.emit('error', {'msg': 'User is not authenticated?'}, room=request.sid)
+        return
+
+    streamer = socket_to_info[request.sid].streamer
+    socketio.emit('users', {'users': users_in_room(streamer), 'seq': user_seq(streamer)}, room=request.sid)
+
+
 @socketio.on('message')  # type: ignore
+@releases_mysql
 def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
     if 'message' not in json:
         socketio.emit('error', {'msg': 'Message mssing from JSON?'}, room=request.sid)
@@ -445,23 +841,24 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 )
             else:
                 # Just a say message
-                insert_event(
+                rendered = emotes(message)
+                queue_event(
                     data,
                     SendMessageEvent(
                         now(),
                         socket_to_info[request.sid].streamer,
                         socket_to_info[request.sid].username,
-                        emotes(message),
+                        rendered,
                     )
                 )
 
-                socketio.emit(
+                send_chat_line(
                     'message received',
                     {
                         'username': socket_to_info[request.sid].username,
                         'type': socket_to_info[request.sid].type,
                         'color': socket_to_info[request.sid].htmlcolor,
-                        'message': emotes(message),
+                        'message': rendered,
                     },
                     room=socket_to_info[request.sid].streamer,
                 )
@@ -474,23 +871,24 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 )
             else:
                 # An action message
-                insert_event(
+                rendered = emotes(message)
+                queue_event(
                     data,
                     SendActionEvent(
                         now(),
                         socket_to_info[request.sid].streamer,
                         socket_to_info[request.sid].username,
-                        emotes(message),
+                        rendered,
                     )
                 )
 
-                socketio.emit(
+                send_chat_line(
                     'action received',
                     {
                         'username': socket_to_info[request.sid].username,
                         'type': socket_to_info[request.sid].type,
                         'color': socket_to_info[request.sid].htmlcolor,
-                        'message': emotes(message),
+                        'message': rendered,
                     },
                     room=socket_to_info[request.sid].streamer,
                 )
@@ -512,15 +910,15 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                         room=request.sid,
                     )
                 else:
-                    socket_to_info[request.sid].color = color
-                    socketio.emit(
+                    update_user(socket_to_info[request.sid], color=color)
+                    emit_user_change(
                         'recolor',
+                        socket_to_info[request.sid].streamer,
                         {
                             'username': socket_to_info[request.sid].username,
                             'type': socket_to_info[request.sid].type,
                             'color': socket_to_info[request.sid].htmlcolor,
                         },
-                        room=socket_to_info[request.sid].streamer,
                     )
                     socketio.emit(
                         'return color',
@@ -538,21 +936,19 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 # Set a new name
                 name = message.strip()
 
-                if message_length(data, name) > 20:
+                if message_length(name) > 20:
                     socketio.emit(
                         'server',
                         {'msg': 'Too long of a name specified, try a different name.'},
                         room=request.sid,
                     )
                 else:
-                    for user in users_in_room(socket_to_info[request.sid].streamer):
-                        if user['username'].lower() == name.lower():
-                            socketio.emit(
-                                'server',
-                                {'msg': 'Name has already been taken, try a different name.'},
-                                room=request.sid,
-                            )
-                            break
+                    if find_user(socket_to_info[request.sid].streamer, name) is not None:
+                        socketio.emit(
+                            'server',
+                            {'msg': 'Name has already been taken, try a different name.'},
+                            room=request.sid,
+                        )
                     else:
                         if not name:
                             socketio.emit(
@@ -562,9 +958,9 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                             )
                         else:
                             old = socket_to_info[request.sid].username
-                            socket_to_info[request.sid].username = name
+                            rename_user(socket_to_info[request.sid], name)
 
-                            insert_event(
+                            queue_event(
                                 data,
                                 ChangeNameEvent(
                                     now(),
@@ -574,16 +970,15 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                                 )
                             )
 
-                            socketio.emit(
+                            emit_user_change(
                                 'rename',
+                                socket_to_info[request.sid].streamer,
                                 {
                                     'newname': socket_to_info[request.sid].username,
                                     'oldname': old,
                                     'type': socket_to_info[request.sid].type,
                                     'color': socket_to_info[request.sid].htmlcolor,
-                                    'users': users_in_room(socket_to_info[request.sid].streamer),
                                 },
-                                room=socket_to_info[request.sid].streamer,
                             )
         elif command in ["/help"]:
             messages = [
@@ -632,22 +1027,18 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 return
 
             streamer = socket_to_info[request.sid].streamer
-            cursor = data.execute(
-                "SELECT `description`, `streampass`, `chat` FROM streamersettings WHERE `username` = :streamer",
-                {"streamer": streamer}
-            )
-            if cursor.rowcount != 1:
+            settings = streamer_settings().by_username(streamer)
+            if settings is None:
                 socketio.emit(
                     'server',
                     {'msg': "Error looking up settings!"},
                     room=request.sid,
                 )
             else:
-                result = cursor.fetchone()
-                if result['streampass']:
+                if settings.description:
                     socketio.emit(
                         'server',
-                        {'msg': f"Description: {result['description']}"},
+                        {'msg': f"Description: {settings.description}"},
                         room=request.sid,
                     )
                 else:
@@ -656,10 +1047,10 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                         {'msg': "No stream description"},
                         room=request.sid,
                     )
-                if result['streampass']:
+                if settings.streampass:
                     socketio.emit(
                         'server',
-                        {'msg': f"Stream password: {result['streampass']}"},
+                        {'msg': f"Stream password: {settings.streampass}"},
                         room=request.sid,
                     )
                 else:
@@ -670,7 +1061,7 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                     )
 
                 # We want empty columns to represent the default state of enabled.
-                chatsetting = result['chat'] or "enabled"
+                chatsetting = settings.chat or "enabled"
                 socketio.emit(
                     'server',
                     {'msg': f"Chat defaults to {chatsetting}"},
@@ -687,57 +1078,54 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 return
 
             message = message.strip().lower()
-            for sinfo in socket_to_info.values():
-                if sinfo.username.lower() == message and sinfo.streamer == socket_to_info[request.sid].streamer:
-                    if sinfo.admin:
-                        # Stop admins from softlocking themselves, stop mods from muting admin.
+            sinfo = find_user(socket_to_info[request.sid].streamer, message)
+            if sinfo is not None:
+                if sinfo.admin:
+                    # Stop admins from softlocking themselves, stop mods from muting admin.
+                    socketio.emit(
+                        'server',
+                        {'msg': f"User '{message}' cannot be muted."},
+                        room=request.sid,
+                    )
+                elif sinfo.moderator and socket_to_info[request.sid].moderator:
+                    # Stop mods from being able to mute each other, only an admin can mute a mod.
+                    socketio.emit(
+                        'server',
+                        {'msg': f"User '{message}' cannot be muted."},
+                        room=request.sid,
+                    )
+                else:
+                    # User has permission to mute, reply with the status.
+                    changed = (sinfo.muted is False)
+                    update_user(sinfo, muted=True)
+
+                    if changed:
+                        queue_event(
+                            data,
+                            MuteUserEvent(
+                                now(),
+                                socket_to_info[request.sid].streamer,
+                                socket_to_info[request.sid].username,
+                                sinfo.username,
+                            )
+                        )
+
                         socketio.emit(
                             'server',
-                            {'msg': f"User '{message}' cannot be muted."},
+                            {'msg': f"User '{message}' has been muted."},
                             room=request.sid,
                         )
-                    elif sinfo.moderator and socket_to_info[request.sid].moderator:
-                        # Stop mods from being able to mute each other, only an admin can mute a mod.
                         socketio.emit(
                             'server',
-                            {'msg': f"User '{message}' cannot be muted."},
-                            room=request.sid,
+                            {'msg': "You have been muted."},
+                            room=sinfo.sid,
                         )
                     else:
-                        # User has permission to mute, reply with the status.
-                        changed = (sinfo.muted is False)
-                        sinfo.muted = True
-
-                        if changed:
-                            insert_event(
-                                data,
-                                MuteUserEvent(
-                                    now(),
-                                    socket_to_info[request.sid].streamer,
-                                    socket_to_info[request.sid].username,
-                                    sinfo.username,
-                                )
-                            )
-
-                            socketio.emit(
-                                'server',
-                                {'msg': f"User '{message}' has been muted."},
-                                room=request.sid,
-                            )
-                            socketio.emit(
-                                'server',
-                                {'msg': "You have been muted."},
-                                room=sinfo.sid,
-                            )
-                        else:
-                            socketio.emit(
-                                'server',
-                                {'msg': f"User '{message}' is already muted."},
-                                room=request.sid,
-                            )
-
-                    # We found our guy, let's bail.
-                    break
+                        socketio.emit(
+                            'server',
+                            {'msg': f"User '{message}' is already muted."},
+                            room=request.sid,
+                        )
             else:
                 socketio.emit(
                     'server',
@@ -754,57 +1142,54 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 return
 
             message = message.strip().lower()
-            for sinfo in socket_to_info.values():
-                if sinfo.username.lower() == message and sinfo.streamer == socket_to_info[request.sid].streamer:
-                    if sinfo.admin:
-                        # This should never happen, but let's guard against it anyway.
+            sinfo = find_user(socket_to_info[request.sid].streamer, message)
+            if sinfo is not None:
+                if sinfo.admin:
+                    # This should never happen, but let's guard against it anyway.
+                    socketio.emit(
+                        'server',
+                        {'msg': f"User '{message}' cannot be unmuted."},
+                        room=request.sid,
+                    )
+                elif sinfo.moderator and socket_to_info[request.sid].moderator:
+                    # Stop mods from being able to unmute each other, only an admin can unmute a mod.
+                    socketio.emit(
+                        'server',
+                        {'msg': f"User '{message}' cannot be unmuted."},
+                        room=request.sid,
+                    )
+                else:
+                    # User has permission to unmute, reply with the status.
+                    changed = (sinfo.muted is True)
+                    update_user(sinfo, muted=False)
+
+                    if changed:
+                        queue_event(
+                            data,
+                            UnmuteUserEvent(
+                                now(),
+                                socket_to_info[request.sid].streamer,
+                                socket_to_info[request.sid].username,
+                                sinfo.username,
+                            )
+                        )
+
                         socketio.emit(
                             'server',
-                            {'msg': f"User '{message}' cannot be unmuted."},
+                            {'msg': f"User '{message}' has been unmuted."},
                             room=request.sid,
                         )
-                    elif sinfo.moderator and socket_to_info[request.sid].moderator:
-                        # Stop mods from being able to unmute each other, only an admin can unmute a mod.
                         socketio.emit(
                             'server',
-                            {'msg': f"User '{message}' cannot be unmuted."},
-                            room=request.sid,
+                            {'msg': "You have been unmuted."},
+                            room=sinfo.sid,
                         )
                     else:
-                        # User has permission to unmute, reply with the status.
-                        changed = (sinfo.muted is True)
-                        sinfo.muted = False
-
-                        if changed:
-                            insert_event(
-                                data,
-                                UnmuteUserEvent(
-                                    now(),
-                                    socket_to_info[request.sid].streamer,
-                                    socket_to_info[request.sid].username,
-                                    sinfo.username,
-                                )
-                            )
-
-                            socketio.emit(
-                                'server',
-                                {'msg': f"User '{message}' has been unmuted."},
-                                room=request.sid,
-                            )
-                            socketio.emit(
-                                'server',
-                                {'msg': "You have been unmuted."},
-                                room=sinfo.sid,
-                            )
-                        else:
-                            socketio.emit(
-                                'server',
-                                {'msg': f"User '{message}' is not muted."},
-                                room=request.sid,
-                            )
-
-                    # We found our guy, let's bail.
-                    break
+                        socketio.emit(
+                            'server',
+                            {'msg': f"User '{message}' is not muted."},
+                            room=request.sid,
+                        )
             else:
                 socketio.emit(
                     'server',
@@ -821,49 +1206,47 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 return
 
             message = message.strip().lower()
-            for sinfo in socket_to_info.values():
-                if sinfo.username.lower() == message and sinfo.streamer == socket_to_info[request.sid].streamer:
-                    if sinfo.admin:
-                        # Admins shouldn't be able to set themselves or each other as mods.
+            sinfo = find_user(socket_to_info[request.sid].streamer, message)
+            if sinfo is not None:
+                if sinfo.admin:
+                    # Admins shouldn't be able to set themselves or each other as mods.
+                    socketio.emit(
+                        'server',
+                        {'msg': f"User '{message}' cannot be promoted to moderator."},
+                        room=request.sid,
+                    )
+                else:
+                    # We're good.
+                    changed = (sinfo.moderator is False)
+                    update_user(sinfo, moderator=True)
+
+                    if changed:
+                        queue_event(
+                            data,
+                            ModUserEvent(
+                                now(),
+                                socket_to_info[request.sid].streamer,
+                                socket_to_info[request.sid].username,
+                                sinfo.username,
+                            )
+                        )
+
                         socketio.emit(
                             'server',
-                            {'msg': f"User '{message}' cannot be promoted to moderator."},
+                            {'msg': f"User '{message}' has been promoted to moderator."},
                             room=request.sid,
                         )
+                        socketio.emit(
+                            'server',
+                            {'msg': "You have been promoted to moderator."},
+                            room=sinfo.sid,
+                        )
                     else:
-                        # We're good.
-                        changed = (sinfo.moderator is False)
-                        sinfo.moderator = True
-
-                        if changed:
-                            insert_event(
-                                data,
-                                ModUserEvent(
-                                    now(),
-                                    socket_to_info[request.sid].streamer,
-                                    socket_to_info[request.sid].username,
-                                    sinfo.username,
-                                )
-                            )
-
-                            socketio.emit(
-                                'server',
-                                {'msg': f"User '{message}' has been promoted to moderator."},
-                                room=request.sid,
-                            )
-                            socketio.emit(
-                                'server',
-                                {'msg': "You have been promoted to moderator."},
-                                room=sinfo.sid,
-                            )
-                        else:
-                            socketio.emit(
-                                'server',
-                                {'msg': f"User '{message}' is already a moderator."},
-                                room=request.sid,
-                            )
-
-                    break
+                        socketio.emit(
+                            'server',
+                            {'msg': f"User '{message}' is already a moderator."},
+                            room=request.sid,
+                        )
             else:
                 socketio.emit(
                     'server',
@@ -880,50 +1263,48 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 return
 
             message = message.strip().lower()
-            for sinfo in socket_to_info.values():
-                if sinfo.username.lower() == message and sinfo.streamer == socket_to_info[request.sid].streamer:
-                    if sinfo.admin:
-                        # Admins shouldn't be able to set themselves or each other as mods, so this should never
-                        # happen. But, guard against it anyway.
+            sinfo = find_user(socket_to_info[request.sid].streamer, message)
+            if sinfo is not None:
+                if sinfo.admin:
+                    # Admins shouldn't be able to set themselves or each other as mods, so this should never
+                    # happen. But, guard against it anyway.
+                    socketio.emit(
+                        'server',
+                        {'msg': f"User '{message}' cannot be demoted from moderator."},
+                        room=request.sid,
+                    )
+                else:
+                    # We're good.
+                    changed = (sinfo.moderator is True)
+                    update_user(sinfo, moderator=False)
+
+                    if changed:
+                        queue_event(
+                            data,
+                            DemodUserEvent(
+                                now(),
+                                socket_to_info[request.sid].streamer,
+                                socket_to_info[request.sid].username,
+                                sinfo.username,
+                            )
+                        )
+
                         socketio.emit(
                             'server',
-                            {'msg': f"User '{message}' cannot be demoted from moderator."},
+                            {'msg': f"User '{message}' has been demoted from moderator."},
                             room=request.sid,
                         )
+                        socketio.emit(
+                            'server',
+                            {'msg': "You have been demoted from moderator."},
+                            room=sinfo.sid,
+                        )
                     else:
-                        # We're good.
-                        changed = (sinfo.moderator is True)
-                        sinfo.moderator = False
-
-                        if changed:
-                            insert_event(
-                                data,
-                                DemodUserEvent(
-                                    now(),
-                                    socket_to_info[request.sid].streamer,
-                                    socket_to_info[request.sid].username,
-                                    sinfo.username,
-                                )
-                            )
-
-                            socketio.emit(
-                                'server',
-                                {'msg': f"User '{message}' has been demoted from moderator."},
-                                room=request.sid,
-                            )
-                            socketio.emit(
-                                'server',
-                                {'msg': "You have been demoted from moderator."},
-                                room=sinfo.sid,
-                            )
-                        else:
-                            socketio.emit(
-                                'server',
-                                {'msg': f"User '{message}' is not a moderator."},
-                                room=request.sid,
-                            )
-
-                    break
+                        socketio.emit(
+                            'server',
+                            {'msg': f"User '{message}' is not a moderator."},
+                            room=request.sid,
+                        )
             else:
                 socketio.emit(
                     'server',
@@ -941,8 +1322,8 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
 
             message = message.strip()
             matcher = message.lower()
-            for sinfo in socket_to_info.values():
-                if matcher.startswith(sinfo.username.lower()) and sinfo.streamer == socket_to_info[request.sid].streamer:
+            for sinfo in users(socket_to_info[request.sid].streamer):
+                if matcher.startswith(sinfo.username.lower()):
                     new_name = message[len(sinfo.username.lower()):]
                     if bool(new_name) and new_name[0] != ' ':
                         # This was a partial match, skip it.
@@ -955,21 +1336,19 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                             {'msg': f"Unspecified new username for user '{matcher}'"},
                             room=request.sid,
                         )
-                    elif message_length(data, new_name) > 20:
+                    elif message_length(new_name) > 20:
                         socketio.emit(
                             'server',
                             {'msg': 'Too long of a name specified, try a different name.'},
                             room=request.sid,
                         )
                     else:
-                        for user in users_in_room(socket_to_info[request.sid].streamer):
-                            if user['username'].lower() == new_name.lower():
-                                socketio.emit(
-                                    'server',
-                                    {'msg': 'Name has already been taken, try a different name.'},
-                                    room=request.sid,
-                                )
-                                break
+                        if find_user(socket_to_info[request.sid].streamer, new_name) is not None:
+                            socketio.emit(
+                                'server',
+                                {'msg': 'Name has already been taken, try a different name.'},
+                                room=request.sid,
+                            )
                         else:
                             old = sinfo.username
                             if sinfo.admin:
@@ -988,9 +1367,9 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                                 )
                             else:
                                 # User has permission to rename another user, let's execute it.
-                                sinfo.username = new_name
+                                rename_user(sinfo, new_name)
 
-                                insert_event(
+                                queue_event(
                                     data,
                                     ChangeNameEvent(
                                         now(),
@@ -1000,16 +1379,15 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                                     )
                                 )
 
-                                socketio.emit(
+                                emit_user_change(
                                     'rename',
+                                    socket_to_info[request.sid].streamer,
                                     {
                                         'newname': new_name,
                                         'oldname': old,
                                         'type': sinfo.type,
                                         'color': sinfo.htmlcolor,
-                                        'users': users_in_room(socket_to_info[request.sid].streamer),
                                     },
-                                    room=socket_to_info[request.sid].streamer,
                                 )
 
                     # We found our guy, let's bail.
@@ -1035,7 +1413,10 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 "UPDATE streamersettings SET `description` = :description WHERE `username` = :streamer LIMIT 1",
                 {"streamer": streamer, "description": description}
             )
-            insert_event(
+            settings = streamer_settings().by_username(streamer)
+            if settings is not None:
+                settings.description = description
+            queue_event(
                 data,
                 SetDescriptionEvent(
                     now(),
@@ -1118,6 +1499,9 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 "UPDATE streamersettings SET `chat` = :setting WHERE `username` = :streamer LIMIT 1",
                 {"streamer": streamer, "setting": setting}
             )
+            settings = streamer_settings().by_username(streamer)
+            if settings is not None:
+                settings.chat = setting
 
             socketio.emit(
                 'server',
@@ -1140,7 +1524,10 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                     "UPDATE streamersettings SET `streampass` = :password WHERE `username` = :streamer LIMIT 1",
                     {"streamer": streamer, "password": message}
                 )
-                insert_event(
+                settings = streamer_settings().by_username(streamer)
+                if settings is not None:
+                    settings.change_password(message)
+                queue_event(
                     data,
                     SetViewerPasswordEvent(
                         now(),
@@ -1161,7 +1548,7 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                     },
                     room=request.sid,
                 )
-                socketio.emit(
+                broadcaster.emit(
                     'password activated',
                     {
                         "username": streamer,
@@ -1173,7 +1560,10 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                     "UPDATE streamersettings SET `streampass` = :password WHERE `username` = :streamer LIMIT 1",
                     {"streamer": streamer, "password": None}
                 )
-                insert_event(
+                settings = streamer_settings().by_username(streamer)
+                if settings is not None:
+                    settings.change_password(None)
+                queue_event(
                     data,
                     SetViewerPasswordEvent(
                         now(),
@@ -1187,7 +1577,7 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                     {'msg': "Stream password removed!"},
                     room=request.sid,
                 )
-                socketio.emit(
+                broadcaster.emit(
                     'password deactivated',
                     {
                         "username": streamer,
@@ -1210,29 +1600,31 @@ def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 room=request.sid,
             )
         else:
-            insert_event(
+            rendered = emotes(message)
+            queue_event(
                 data,
                 SendMessageEvent(
                     now(),
                     socket_to_info[request.sid].streamer,
                     socket_to_info[request.sid].username,
-                    emotes(message),
+                    rendered,
                 )
             )
 
-            socketio.emit(
+            send_chat_line(
                 'message received',
                 {
                     'username': socket_to_info[request.sid].username,
                     'type': socket_to_info[request.sid].type,
                     'color': socket_to_info[request.sid].htmlcolor,
-                    'message': emotes(message),
+                    'message': rendered,
                 },
                 room=socket_to_info[request.sid].streamer,
             )
 
 
 @socketio.on('get color')  # type: ignore
+@releases_mysql
 def return_color(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
     if request.sid not in socket_to_info:
         socketio.emit('error', {'msg': 'User is not authenticated?'}, room=request.sid)
@@ -1246,6 +1638,7 @@ def return_color(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) ->
 
 
 @socketio.on('drawing')  # type: ignore
+@releases_mysql
 def handle_drawing(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
     if 'src' not in json:
         socketio.emit('error', {'msg': 'Image mssing from JSON?'}, room=request.sid)
@@ -1263,16 +1656,11 @@ def handle_drawing(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
     # Verify that this is a valid picture with the right dimensions (stop arbitrary console-based
     # picture sending in most cases).
     try:
-        header, data = src.split(",", 1)
-        if not header.startswith("data:") or not header.endswith("base64"):
-            raise ValueError("Invaid image header")
+        png = drawing_validator.validate(src)
 
-        with urllib.request.urlopen(src) as fp:
-            img = Image.open(fp)
-            width, height = img.size
-
-            if width != PICTOCHAT_IMAGE_WIDTH or height != PICTOCHAT_IMAGE_HEIGHT:
-                raise ValueError("Invalid image size")
+        # Somebody could have logged out while we were waiting on the validator.
+        if request.sid not in socket_to_info:
+            return
 
         if socket_to_info[request.sid].muted:
             socketio.emit(
@@ -1281,23 +1669,26 @@ def handle_drawing(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
                 room=request.sid,
             )
         else:
-            insert_event(
+            # Everybody fetches the drawing by its hash, instead of getting a copy in every frame.
+            digest = drawing_store.save(png)
+            queue_event(
                 mysql(),
                 SendDrawingEvent(
                     now(),
                     socket_to_info[request.sid].streamer,
                     socket_to_info[request.sid].username,
-                    src,
+                    digest,
                 )
             )
 
-            socketio.emit(
+            send_chat_line(
                 'drawing received',
                 {
                     'username': socket_to_info[request.sid].username,
                     'type': socket_to_info[request.sid].type,
                     'color': socket_to_info[request.sid].htmlcolor,
-                    'src': src,
+                    'hash': digest,
+                    'src': drawing_url(digest),
                 },
                 room=socket_to_info[request.sid].streamer,
             )
@@ -1307,3 +1698,11 @@ def handle_drawing(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -
             {'msg': "Invalid drawing received!"},
             room=request.sid,
         )
+    except OSError as e:
+        # The drawing was fine but we couldn't store it, which the sender sees the same way.
+        print(f"Failed to store drawing: {e}")
+        socketio.emit(
+            'server',
+            {'msg': "Invalid drawing received!"},
+            room=request.sid,
+        )
@@ -4,11 +4,13 @@ var connected = false;
 var live = false;
 var autoscroll = true;
 var users = [];
+var userseq = 0;
 
 // If the description contains a link, don't constantly refresh, since it can cause a slight
 // flash when the link is not colored as visited.
 var lastViewerCount = null;
 var lastStreamDescription = null;
+var lastPasswordChanges = null;
 
 // Shared state between input controls.
 var inputState = new InputState();
@@ -89,15 +91,25 @@ var ensureScrolled = function() {
   }
 }
 
+// While a batch of events from the server is being handled, chat lines are gathered here so
+// that they can be added to the chat box all at once.
+var batched = null;
+
 // Add some inner HTML to the chat box.
 var add = function( inner, type, color ) {
-  var box = $( 'div.messages' );
+  var html;
   if (color != undefined) {
-    box.append( '<div class="chat-message ' + type + ' ' + colorLuminanceClass(color) + '" style="--user-color: ' + color + '">' + inner + '</div>' );
+    html = '<div class="chat-message ' + type + ' ' + colorLuminanceClass(color) + '" style="--user-color: ' + color + '">' + inner + '</div>';
   } else {
-    box.append( '<div class="chat-message ' + type + '">' + inner + '</div>' );
+    html = '<div class="chat-message ' + type + '">' + inner + '</div>';
+  }
+
+  if (batched !== null) {
+    batched.push( html );
+    return;
   }
 
+  $( 'div.messages' ).append( html );
   ensureScrolled();
 }
 
@@ -187,34 +199,36 @@ var ping = function() {
   } );
 }
 
-// Grab the stream information, possibly reload the stream control if the streamer went live,
-// display the info such as number of viewers and stream description. This also handles when
-// a password is applied to the stream that the viewer has not inputted, to kick anyone who
-// joined before a password was set.
-var info = function() {
-  $.get("/" + streamer + "/info", {}, function(response) {
-    if (response.live) {
-      if (response.count != lastViewerCount) {
-        lastViewerCount = response.count;
-        $( 'div.stream-count' ).html( '<img class="viewer-count-icon" alt="number of viewers" /> ' + response.count );
-      }
-
-      if (response.description != lastStreamDescription) {
-        lastStreamDescription = response.description;
-        $( 'div.stream-description').html( linkifyHtml(escapehtml(response.description), linkifyOptions) );
-      }
-    } else {
-      $( 'div.stream-count' ).text( '' );
-      $( 'div.stream-description').text( '' );
+// Given the stream information, possibly reload the stream control if the streamer went live,
+// display the info such as number of viewers and stream description.
+var updatestatus = function(response) {
+  if (response.live) {
+    if (response.count != lastViewerCount) {
+      lastViewerCount = response.count;
+      $( 'div.stream-count' ).html( '<img class="viewer-count-icon" alt="number of viewers" /> ' + response.count );
     }
 
-    if (response.live != live) {
-      live = response.live;
-      videojs.players['my-video'].reset();
-      videojs.players['my-video'].src(playlists);
-      videojs.players['my-video'].load();
+    if (response.description != lastStreamDescription) {
+      lastStreamDescription = response.description;
+      $( 'div.stream-description').html( linkifyHtml(escapehtml(response.description), linkifyOptions) );
     }
-  } ).fail(function(response) {
+  } else {
+    $( 'div.stream-count' ).text( '' );
+    $( 'div.stream-description').text( '' );
+  }
+
+  if (response.live != live) {
+    live = response.live;
+    videojs.players['my-video'].reset();
+    videojs.players['my-video'].src(playlists);
+    videojs.players['my-video'].load();
+  }
+}
+
+// Grab the stream information and display it. This also handles when a password is applied to
+// the stream that the viewer has not inputted, to kick anyone who joined before a password was set.
+var info = function() {
+  $.get("/" + streamer + "/info", {}, updatestatus).fail(function(response) {
     if (response.status == 403) {
       // Stream password was turned on, we don't have access.
       location.reload();
@@ -373,14 +387,15 @@ socket.on( 'connect', function() {
       username : username,
       streamer : streamer,
       color : color,
+      deltas : true,
+      batches : true,
     } );
     updateColor(color);
   } );
 
+  // Stream status is pushed to us whenever it changes, so we only need to keep our presence alive.
   ping();
-  info();
-  setInterval(ping, 5000);
-  setInterval(info, 5000);
+  setInterval(ping, 15000);
 } );
 
 socket.on( 'login key required', function( msg ) {
@@ -400,12 +415,22 @@ socket.on( 'login key required', function( msg ) {
       username : username,
       color : color,
       key : password,
+      deltas : true,
+      batches : true,
     } );
   } );
 });
 
 socket.on( 'login success', function( msg ) {
   username = msg.username;
+  users = msg.users;
+  userseq = msg.seq;
+  updateusers();
+
+  // Show what was said right before we joined.
+  if (msg.backlog) {
+    replay( msg.backlog );
+  }
 
   clearerror();
   $( '#login' ).remove();
@@ -439,6 +464,29 @@ socket.on( 'login success', function( msg ) {
   } );
 });
 
+// Apply a numbered userlist change from the server. If we notice that we missed one, throw our
+// copy away and ask the server for the whole list again.
+var userchange = function( msg, apply ) {
+  if( msg.seq <= userseq ) {
+    // Already covered by the snapshot we got when logging in or resyncing.
+    return;
+  }
+  if( msg.seq != userseq + 1 ) {
+    socket.emit( 'resync', {} );
+    return;
+  }
+
+  apply();
+  userseq = msg.seq;
+  updateusers();
+}
+
+socket.on( 'users', function( msg ) {
+  users = msg.users;
+  userseq = msg.seq;
+  updateusers();
+})
+
 socket.on( 'connected', function( msg ) {
   if( connected ) {
     add(
@@ -449,7 +497,7 @@ socket.on( 'connected', function( msg ) {
     );
   }
   if( msg.username == username && !connected ) {
-    var userlist = msg.users.map(function(user) {
+    var userlist = users.map(function(user) {
         return userify(iconify(user) + escapehtml(user.username), user.color);
     });
     add(
@@ -459,8 +507,41 @@ socket.on( 'connected', function( msg ) {
     );
     connected = true;
   }
-  users = msg.users;
-  updateusers();
+  userchange( msg, function() {
+    users.push({username: msg.username, type: msg.type, color: msg.color});
+  } );
+})
+
+socket.on( 'stream status', function( msg ) {
+  if (lastPasswordChanges !== null && msg.passwordchanges != lastPasswordChanges) {
+    // The password changed, so make sure we still have access. This reloads the page if we don't.
+    info();
+  }
+  lastPasswordChanges = msg.passwordchanges;
+  updatestatus(msg);
+})
+
+// Handle a list of events from the server as if each one was sent on its own, adding any chat
+// lines they produce to the chat box all at once.
+var replay = function( events ) {
+  batched = [];
+  events.forEach(function( item ) {
+    socket.listeners( item.event ).forEach(function( listener ) {
+      listener( item.data );
+    });
+  });
+
+  var lines = batched;
+  batched = null;
+  if (lines.length > 0) {
+    $( 'div.messages' ).append( lines.join('') );
+    ensureScrolled();
+  }
+}
+
+socket.on( 'batch', function( msg ) {
+  // Busy rooms send chat lines in batches.
+  replay( msg.events );
 })
 
 socket.on( 'server', function( msg ) {
@@ -476,8 +557,11 @@ socket.on( 'disconnected', function( msg ) {
       msg.color
     );
   }
-  users = msg.users;
-  updateusers();
+  userchange( msg, function() {
+    users = users.filter(function(user) {
+      return user.username != msg.username;
+    });
+  } );
 })
 
 socket.on( 'userlist', function( msg ) {
@@ -502,8 +586,13 @@ socket.on( 'rename', function( msg ) {
   if (msg.oldname == username) {
       username = msg.newname;
   }
-  users = msg.users;
-  updateusers();
+  userchange( msg, function() {
+    users.forEach(function(user) {
+      if( user.username == msg.oldname ) {
+        user.username = msg.newname;
+      }
+    });
+  } );
 })
 
 socket.on( 'recolor', function( msg ) {
@@ -518,6 +607,13 @@ socket.on( 'recolor', function( msg ) {
       msg.color
     );
   }
+  userchange( msg, function() {
+    users.forEach(function(user) {
+      if( user.username == msg.username ) {
+        user.color = msg.color;
+      }
+    });
+  } );
 })
 
 socket.on( 'message received', function( msg ) {
@@ -0,0 +1,154 @@
+import time
+from gevent.event import Event as GeventEvent  # type: ignore
+from typing import Dict, List, Optional
+
+from data import Data
+
+
+class StreamerSettings:
+    def __init__(
+        self,
+        username: str,
+        key: str,
+        chat: Optional[str],
+        description: Optional[str],
+        streampass: Optional[str],
+        mastodon: Optional[str],
+        backlog: Optional[int],
+    ) -> None:
+        self.username = username
+        self.key = key
+        self.chat = chat
+        self.description = description
+        self.streampass = streampass
+        self.mastodon = mastodon
+        self.backlog = backlog
+
+        # How many times we've seen the viewer password change, so viewers can tell when to recheck access.
+        self.password_changes = 0
+
+    def change_password(self, streampass: Optional[str]) -> None:
+        if streampass != self.streampass:
+            self.streampass = streampass
+            self.password_changes += 1
+
+
+class StreamerSettingsCache:
+    """
+    An in-memory copy of the streamersettings table, indexed by lowercase username and by stream
+    key. Changes made by this process are written through to the cached objects directly, and
+    changes made elsewhere (such as by the manage script) are picked up by periodically comparing
+    a cheap checksum of the table against the one we loaded. That check and any reload happen on a
+    service thread that calls wait() and refresh() in a loop, so lookups never touch the DB once
+    the cache has been loaded.
+    """
+
+    def __init__(self, data: Data, refresh_interval: float) -> None:
+        self.__data = data
+        self.__refresh_interval = refresh_interval
+        self.__by_username: Dict[str, StreamerSettings] = {}
+        self.__by_key: Dict[str, StreamerSettings] = {}
+        self.__version: Optional[int] = None
+        self.__loaded_at: Optional[float] = None
+
+        # Set when somebody looked up a key we don't know, so the service thread reloads right away.
+        self.__wakeup = GeventEvent()
+        self.__reload = False
+        self.__last_reload_request: Optional[float] = None
+
+    def __checksum(self) -> Optional[int]:
+        cursor = self.__data.execute("CHECKSUM TABLE streamersettings")
+        result = cursor.fetchone()
+        if result is None or result['Checksum'] is None:
+            return None
+        return int(result['Checksum'])
+
+    def load(self) -> None:
+        """
+        Unconditionally reload every streamer from the DB.
+        """
+
+        version = self.__checksum()
+        cursor = self.__data.execute(
+            "SELECT `username`, `key`, `chat`, `description`, `streampass`, `mastodon`, `backlog` FROM streamersettings",
+        )
+
+        by_username: Dict[str, StreamerSettings] = {}
+        by_key: Dict[str, StreamerSettings] = {}
+        for result in cursor:
+            settings = StreamerSettings(
+                result['username'],
+                result['key'],
+                result['chat'],
+                result['description'],
+                result['streampass'],
+                result['mastodon'],
+                result['backlog'],
+            )
+            previous = self.__by_username.get(settings.username.lower())
+            if previous is not None:
+                settings.password_changes = previous.password_changes
+                if previous.streampass != settings.streampass:
+                    settings.password_changes += 1
+            by_username[settings.username.lower()] = settings
+            by_key[settings.key] = settings
+
+        # Swap the whole index at once so readers never see a partially loaded table.
+        self.__by_username = by_username
+        self.__by_key = by_key
+        self.__version = version
+        self.__loaded_at = time.monotonic()
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Reload the cache if the table has changed underneath us, or unconditionally if forced or
+        if somebody asked for a reload with reload_soon().
+        """
+
+        if self.__reload:
+            self.__reload = False
+            force = True
+
+        if force or self.__loaded_at is None or self.__checksum() != self.__version:
+            self.load()
+
+    def wait(self) -> None:
+        """
+        Block the calling greenlet until the next check is due or somebody asks for a reload.
+        """
+
+        self.__wakeup.wait(timeout=self.__refresh_interval)
+        self.__wakeup.clear()
+
+    def reload_soon(self) -> None:
+        """
+        Ask the service thread to reload the cache without waiting for the refresh interval.
+        """
+
+        self.__reload = True
+        self.__wakeup.set()
+
+    def __ensure_loaded(self) -> None:
+        if self.__loaded_at is None:
+            # Only happens if somebody looks things up before the server finished starting.
+            self.load()
+
+    def by_username(self, username: str) -> Optional[StreamerSettings]:
+        self.__ensure_loaded()
+        return self.__by_username.get(username.lower())
+
+    def by_key(self, key: str) -> Optional[StreamerSettings]:
+        self.__ensure_loaded()
+        settings = self.__by_key.get(key)
+        if settings is None:
+            # A streamer could have just been given this key, so pick it up for when the encoder retries.
+            # This is rate limited since anybody can try to publish with any key they like.
+            timestamp = time.monotonic()
+            if self.__last_reload_request is None or (timestamp - self.__last_reload_request) >= 1.0:
+                self.__last_reload_request = timestamp
+                self.reload_soon()
+        return settings
+
+    def all(self) -> List[StreamerSettings]:
+        self.__ensure_loaded()
+        return list(self.__by_username.values())